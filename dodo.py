@@ -24,6 +24,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), "python"))
 import builder
 import cacher
 import pythonenv
+import scheduler
 
 # Sub-tasks.
 from common_tasks import *
@@ -33,6 +34,7 @@ from npcomp_tasks import *
 
 DOIT_CONFIG = {
     "default_tasks": [],
+    "reporter": scheduler.SchedulingReporter,
 }
 
 
@@ -16,29 +16,204 @@
 
 This script can be put in the root directory of a git repo, and once
 downloaded, will act as a call to the main entry point.
+
+The revision is MRT_MMR_REVISION (default 'main'), and the zip of it is
+taken from the first of:
+  - A vendored copy at third_party/git-mmrepo.zip (needs no network). It is
+    part of the checkout, so is used unpinned, and its own revision (the
+    commit recorded in the zip) is what gets extracted. If MRT_MMR_REVISION
+    is set, it must match.
+  - A previous download of the revision under .mmrepo.
+  - The shared cache dir ($MRT_SHARED_CACHE_DIR/mmr), where ephemeral VMs
+    leave it for each other, keyed by revision. Anyone with access to it
+    could replace it, so it is only used (and stored to) when pinned.
+  - A (streamed) download.
+To pin, set MRT_MMR_REVISION to a commit and MRT_MMR_ZIP_SHA256 to the hash
+printed by its first download: the zip must then match it wherever it came
+from.
 """
 
+import hashlib
 import os
-import urllib.request
+import re
+import shutil
 import sys
+import urllib.request
 from zipfile import ZipFile
 
-MMR_ZIP_URL = "https://github.com/google/git-mmrepo/archive/main.zip"
+MMR_REVISION_ENV_VAR = "MRT_MMR_REVISION"
+MMR_REVISION = os.environ.get(MMR_REVISION_ENV_VAR) or "main"
+MMR_ZIP_URL = "https://github.com/google/git-mmrepo/archive/{}.zip".format(
+    MMR_REVISION)
+# The sha256 of the zip at MMR_ZIP_URL (None if unpinned).
+MMR_ZIP_SHA256 = os.environ.get("MRT_MMR_ZIP_SHA256") or None
+SHARED_CACHE_DIR_ENV_VAR = "MRT_SHARED_CACHE_DIR"
 THIS_DIR = os.path.dirname(__file__)
-ARCHIVE_PATH = os.path.join(THIS_DIR, ".mmrepo", "mmr_dist.zip")
+# Revisions may be branch names (i.e. 'release/1.0').
+ARCHIVE_NAME = "git-mmrepo-{}.zip".format(MMR_REVISION.replace("/", "_"))
+VENDORED_ARCHIVE_PATH = os.path.join(THIS_DIR, "third_party", "git-mmrepo.zip")
+ARCHIVE_PATH = os.path.join(THIS_DIR, ".mmrepo", ARCHIVE_NAME)
 DIST_DIR = os.path.join(THIS_DIR, ".mmrepo", "mmr_dist")
+# Records the revision and sha256 of the zip that DIST_DIR was extracted
+# from.
+DIST_STAMP_PATH = os.path.join(DIST_DIR, ".stamp")
+
+
+def hash_file(path):
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(1024 * 1024), b""):
+      h.update(block)
+  return h.hexdigest()
+
+
+def read_dist_stamp():
+  """Reads the (revision, sha256) DIST_DIR was extracted from (or None)."""
+  try:
+    with open(DIST_STAMP_PATH, "rt") as f:
+      revision, sha256 = f.read().split()
+      return revision, sha256
+  except (OSError, ValueError):
+    return None
+
+
+def get_zip_revision(path):
+  """Gets the revision a GitHub archive zip was made from.
+
+  Its comment is the commit. Otherwise, the top-level dir is named after the
+  requested revision (i.e. 'git-mmrepo-main/').
+  """
+  with ZipFile(path, "r") as zf:
+    comment = zf.comment.decode("UTF-8", errors="replace").strip()
+    if re.match(r"^[0-9a-f]{40}$", comment):
+      return comment
+    for name in zf.namelist():
+      top_dir = name.split("/", 1)[0]
+      if top_dir.startswith("git-mmrepo-"):
+        return top_dir[len("git-mmrepo-"):]
+  return "unknown"
+
+
+def get_vendored_revision():
+  """Gets the revision of a usable vendored zip (None if there is none)."""
+  if not is_usable(VENDORED_ARCHIVE_PATH):
+    return None
+  revision = get_zip_revision(VENDORED_ARCHIVE_PATH)
+  requested_revision = os.environ.get(MMR_REVISION_ENV_VAR)
+  if requested_revision and not revision.startswith(requested_revision):
+    print("Ignoring {}: revision {} does not match {}".format(
+        VENDORED_ARCHIVE_PATH, revision, requested_revision),
+          file=sys.stderr)
+    return None
+  return revision
+
+
+def get_shared_archive_path():
+  """Gets the path of the zip in the shared cache dir (None if unpinned)."""
+  shared_cache_dir = os.environ.get(SHARED_CACHE_DIR_ENV_VAR)
+  if not shared_cache_dir or MMR_ZIP_SHA256 is None:
+    return None
+  return os.path.join(shared_cache_dir, "mmr", ARCHIVE_NAME)
 
-if not os.path.exists(DIST_DIR):
+
+def copy_atomic(src_path, dest_path):
+  dest_dir = os.path.dirname(dest_path)
+  tmp_path = os.path.join(dest_dir, "." + os.path.basename(dest_path) + ".tmp")
+  os.makedirs(dest_dir, exist_ok=True)
+  shutil.copyfile(src_path, tmp_path)
+  os.replace(tmp_path, dest_path)
+
+
+def is_usable(path):
+  """Checks if a zip exists and matches the pinned hash (if any)."""
+  if not os.path.exists(path):
+    return False
+  if MMR_ZIP_SHA256 is None:
+    return True
+  sha256 = hash_file(path)
+  if sha256 != MMR_ZIP_SHA256:
+    print("Ignoring {}: sha256 {} does not match {}".format(
+        path, sha256, MMR_ZIP_SHA256),
+          file=sys.stderr)
+    return False
+  return True
+
+
+def download(url, dest_path):
+  """Streams url to dest_path, returning its sha256."""
+  tmp_path = os.path.join(os.path.dirname(dest_path),
+                          "." + os.path.basename(dest_path) + ".tmp")
+  print("Fetching {} to {}...".format(url, dest_path), file=sys.stderr)
+  h = hashlib.sha256()
+  with urllib.request.urlopen(url) as infile:
+    with open(tmp_path, "wb") as outfile:
+      for block in iter(lambda: infile.read(1024 * 1024), b""):
+        h.update(block)
+        outfile.write(block)
+  sha256 = h.hexdigest()
+  if MMR_ZIP_SHA256 is not None and sha256 != MMR_ZIP_SHA256:
+    os.unlink(tmp_path)
+    raise RuntimeError("Downloaded {} has sha256 {}, expected {}".format(
+        url, sha256, MMR_ZIP_SHA256))
+  os.replace(tmp_path, dest_path)
+  if MMR_ZIP_SHA256 is None:
+    print("Fetched unpinned {} (sha256 {})".format(url, sha256),
+          file=sys.stderr)
+  return sha256
+
+
+def fetch_archive():
+  """Ensures a usable (downloaded) zip of MMR_REVISION, returning its path."""
+  if is_usable(ARCHIVE_PATH):
+    return ARCHIVE_PATH
   os.makedirs(os.path.dirname(ARCHIVE_PATH), exist_ok=True)
-  print("Fetching {} to {}...".format(MMR_ZIP_URL, ARCHIVE_PATH),
-        file=sys.stderr)
-  with urllib.request.urlopen(MMR_ZIP_URL) as infile:
-    with open(ARCHIVE_PATH, "wb") as outfile:
-      outfile.write(infile.read())
-  os.makedirs(DIST_DIR, exist_ok=True)
-  with ZipFile(ARCHIVE_PATH, "r") as zf:
-    zf.extractall(path=DIST_DIR)
-
-sys.path.insert(0, os.path.join(DIST_DIR, "git-mmrepo-main", "python"))
+  shared_path = get_shared_archive_path()
+  if shared_path is not None and is_usable(shared_path):
+    print("Using {}".format(shared_path), file=sys.stderr)
+    copy_atomic(shared_path, ARCHIVE_PATH)
+    return ARCHIVE_PATH
+  download(MMR_ZIP_URL, ARCHIVE_PATH)
+  # A mismatching copy (i.e. from before pinning) is replaced.
+  if shared_path is not None and not is_usable(shared_path):
+    try:
+      copy_atomic(ARCHIVE_PATH, shared_path)
+    except OSError as e:
+      print("Could not store {} (ignoring): {}".format(shared_path, e),
+            file=sys.stderr)
+  return ARCHIVE_PATH
+
+
+def extract_archive(archive_path, revision):
+  tmp_dir = DIST_DIR + ".tmp"
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  os.makedirs(tmp_dir)
+  with ZipFile(archive_path, "r") as zf:
+    zf.extractall(path=tmp_dir)
+  with open(os.path.join(tmp_dir, os.path.basename(DIST_STAMP_PATH)),
+            "wt") as f:
+    f.write("{} {}\n".format(revision, hash_file(archive_path)))
+  shutil.rmtree(DIST_DIR, ignore_errors=True)
+  os.rename(tmp_dir, DIST_DIR)
+
+
+def find_python_dir():
+  """Finds the python dir in the extracted zip (named after the revision)."""
+  for name in sorted(os.listdir(DIST_DIR)):
+    python_dir = os.path.join(DIST_DIR, name, "python")
+    if os.path.isdir(os.path.join(python_dir, "mmrepo")):
+      return python_dir
+  raise RuntimeError("No mmrepo package in {}".format(DIST_DIR))
+
+
+dist_stamp = read_dist_stamp()
+vendored_revision = get_vendored_revision()
+if vendored_revision is not None:
+  if dist_stamp != (vendored_revision, hash_file(VENDORED_ARCHIVE_PATH)):
+    extract_archive(VENDORED_ARCHIVE_PATH, vendored_revision)
+elif dist_stamp is None or dist_stamp[0] != MMR_REVISION or (
+    MMR_ZIP_SHA256 is not None and dist_stamp[1] != MMR_ZIP_SHA256):
+  extract_archive(fetch_archive(), MMR_REVISION)
+
+sys.path.insert(0, find_python_dir())
 from mmrepo import main
 main.main()
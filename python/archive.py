@@ -0,0 +1,735 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Seekable, indexed archives of file trees.
+
+Unlike a tar stream, members can be listed, extracted and verified without
+reading the whole archive. Layout:
+
+  header: 8 byte magic
+  frames: Independently zlib compressed frames of (at most) FRAME_SIZE
+    uncompressed bytes. Small files are packed together into a frame and
+    large files span several.
+  index: zlib compressed JSON listing the frames (offset, compressed size,
+    uncompressed size) and members (path, type, mode, mtime, size, sha256,
+    and the frame extents holding the data).
+  footer: 8 byte magic, index offset and index length.
+
+Reading any set of members costs the index plus the frames overlapping them,
+so is proportional to the bytes requested (at frame granularity).
+
+Files larger than CHUNK_MIN_SIZE are split into content-defined chunks
+(see iter_chunks), whose hashes are listed in the index. An archive may be
+a delta against a base archive (in the same directory):
+  - File members whose contents are unchanged from the base are marked
+    'base' and carry no extents, their data being read (streamed) from the
+    member of the base with the same sha256.
+  - Changed files are stored as 'parts': Chunks also found in the base
+    refer to a byte range of a base member, and only the others are stored.
+    Chunk boundaries depend on content only, so an edit (i.e. a changed
+    object in a static library) only changes the chunks around it.
+Bases may themselves be deltas; the index records the chain depth so that
+writers can bound it.
+
+Archives are reproducible: members are sorted, ownership is not recorded,
+modes are normalized (see normalize_mode), mtimes can be clamped to a
+SOURCE_DATE_EPOCH style timestamp and compression parameters are fixed. So
+archiving the same tree on two machines yields identical bytes (given the
+same zlib version).
+
+This file can also be run as a script to list/extract/verify/compare
+archives.
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import hashlib
+import json
+import os
+import struct
+import sys
+import zlib
+
+HEADER_MAGIC = b"MRTA\x00\x01\x00\x00"
+FOOTER_MAGIC = b"MRTAIDX1"
+FOOTER_FORMAT = "<8sQQ"
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+INDEX_VERSION = 1
+# Delta archives can not be read by older readers, so get a new version.
+DELTA_INDEX_VERSION = 2
+# Delta archives with members stored as parts.
+PARTS_INDEX_VERSION = 3
+SUPPORTED_INDEX_VERSIONS = (INDEX_VERSION, DELTA_INDEX_VERSION,
+                            PARTS_INDEX_VERSION)
+FRAME_SIZE = 1024 * 1024
+# Content-defined chunks are at least CHUNK_MIN_SIZE and at most FRAME_SIZE
+# (about 80KiB on average).
+CHUNK_MIN_SIZE = 16 * 1024
+# Chunk hashes are truncated sha256 (hex), to keep indexes small. Member
+# hashes are full, so any collision fails verification.
+CHUNK_DIGEST_LENGTH = 32
+DEFAULT_COMPRESS_LEVEL = 6
+# Fixed deflate parameters (zlib.compress defaults, pinned explicitly).
+_COMPRESS_WBITS = 15
+_COMPRESS_MEMLEVEL = 8
+
+TYPE_FILE = "f"
+TYPE_LINK = "l"
+TYPE_DIR = "d"
+
+# Kinds of parts: Local data ([PART_LOCAL, frame, offset, length]) and byte
+# ranges of base contents ([PART_BASE, sha256, offset, length]).
+PART_LOCAL = "x"
+PART_BASE = "b"
+
+# Chunk boundaries follow a fixed 16 bit pattern in the bytes mapped to bits
+# (by a fixed pseudo-random table), found at C speed by translate() and
+# find(). That is a rolling hash over a 16 byte window, which matches every
+# 64KiB on average.
+_CHUNK_BIT_TABLE = bytes(
+    b"01"[hashlib.sha256(bytes([b])).digest()[0] & 1] for b in range(256))
+_CHUNK_ANCHOR = b"0110100110010110"
+
+
+class ArchiveError(Exception):
+  pass
+
+
+def _compress(data, level):
+  c = zlib.compressobj(level, zlib.DEFLATED, _COMPRESS_WBITS,
+                       _COMPRESS_MEMLEVEL, zlib.Z_DEFAULT_STRATEGY)
+  return c.compress(data) + c.flush()
+
+
+def normalize_mode(member_type, mode):
+  """Normalizes permissions to 0755 (dirs and executables) or 0644."""
+  if member_type == TYPE_LINK:
+    return 0o777
+  if member_type == TYPE_DIR or mode & 0o111:
+    return 0o755
+  return 0o644
+
+
+class _FrameWriter:
+  """Packs data into frames, compressing them concurrently.
+
+  Frames are written to the file in order. At most max_pending frames are
+  held in memory waiting on compression.
+  """
+
+  def __init__(self, f, *, level, frame_size, executor, max_pending):
+    self.f = f
+    self.level = level
+    self.frame_size = frame_size
+    self.executor = executor
+    self.max_pending = max_pending
+    self.buffer = bytearray()
+    self.frames = []
+    self.num_frames = 0
+    self.pending = deque()
+
+  def add(self, data):
+    """Adds data, returning a list of [frame, offset, length] extents."""
+    extents = []
+    view = memoryview(data)
+    while view:
+      space = self.frame_size - len(self.buffer)
+      chunk = view[:space]
+      extents.append([self.num_frames, len(self.buffer), len(chunk)])
+      self.buffer += chunk
+      view = view[space:]
+      if len(self.buffer) >= self.frame_size:
+        self._flush()
+    return extents
+
+  def _flush(self):
+    if not self.buffer:
+      return
+    data = bytes(self.buffer)
+    self.buffer = bytearray()
+    self.num_frames += 1
+    self.pending.append(
+        (len(data), self.executor.submit(_compress, data, self.level)))
+    while len(self.pending) > self.max_pending:
+      self._write_one()
+
+  def _write_one(self):
+    usize, future = self.pending.popleft()
+    compressed = future.result()
+    self.frames.append([self.f.tell(), len(compressed), usize])
+    self.f.write(compressed)
+
+  def finish(self):
+    self._flush()
+    while self.pending:
+      self._write_one()
+    return self.frames
+
+
+def iter_chunks(f, max_size=FRAME_SIZE):
+  """Yields the content-defined chunks of a file object."""
+  buffer = b""
+  bits = b""
+  eof = False
+  while True:
+    while not eof and len(buffer) < max_size:
+      block = f.read(max_size)
+      if not block:
+        eof = True
+      else:
+        buffer += block
+        bits += block.translate(_CHUNK_BIT_TABLE)
+    if not buffer:
+      return
+    i = bits.find(_CHUNK_ANCHOR, CHUNK_MIN_SIZE - len(_CHUNK_ANCHOR), max_size)
+    cut = i + len(_CHUNK_ANCHOR) if i >= 0 else min(len(buffer), max_size)
+    yield buffer[:cut]
+    buffer = buffer[cut:]
+    bits = bits[cut:]
+
+
+def _get_chunk_digest(chunk):
+  return hashlib.sha256(chunk).hexdigest()[:CHUNK_DIGEST_LENGTH]
+
+
+def _walk_sorted(root_dir):
+  """Yields (relpath, lstat result) in sorted order for all entries."""
+  stack = [""]
+  while stack:
+    rel_dir = stack.pop()
+    with os.scandir(os.path.join(root_dir, rel_dir)) as it:
+      entries = sorted(it, key=lambda e: e.name)
+    subdirs = []
+    for entry in entries:
+      rel_path = entry.name if not rel_dir else rel_dir + "/" + entry.name
+      st = entry.stat(follow_symlinks=False)
+      yield rel_path, entry, st
+      if entry.is_dir(follow_symlinks=False):
+        subdirs.append(rel_path)
+    # Visit subdirectories in sorted order.
+    stack.extend(reversed(subdirs))
+
+
+def _hash_file(path, block_size):
+  h = hashlib.sha256()
+  size = 0
+  with open(path, "rb") as f:
+    while True:
+      block = f.read(block_size)
+      if not block:
+        break
+      h.update(block)
+      size += len(block)
+  return size, h.hexdigest()
+
+
+def create(archive_path,
+           root_dir,
+           *,
+           base_path=None,
+           mtime_epoch=None,
+           level=DEFAULT_COMPRESS_LEVEL,
+           frame_size=FRAME_SIZE,
+           max_workers=None):
+  """Creates an archive of all entries under root_dir.
+
+  If mtime_epoch is given, recorded mtimes are clamped to it. If base_path is
+  given, a delta archive is created against it (it must be in the same
+  directory as archive_path, where readers will look for it).
+  """
+  members = []
+  base_contents = dict()
+  base_chunks = dict()
+  base_depth = None
+  has_parts = False
+  if base_path is not None:
+    with ArchiveReader(base_path) as base_reader:
+      base_contents = {
+          sha256: m.get("chunks")
+          for sha256, m in base_reader.contents_by_sha256().items()
+      }
+      base_chunks = base_reader.chunks_by_digest()
+      base_depth = base_reader.depth
+  if max_workers is None:
+    max_workers = os.cpu_count() or 1
+  with open(archive_path, "wb") as f, \
+      ThreadPoolExecutor(max_workers=max_workers) as executor:
+    f.write(HEADER_MAGIC)
+    writer = _FrameWriter(f,
+                          level=level,
+                          frame_size=frame_size,
+                          executor=executor,
+                          max_pending=2 * max_workers)
+    for rel_path, entry, st in _walk_sorted(root_dir):
+      mtime = int(st.st_mtime)
+      if mtime_epoch is not None:
+        mtime = min(mtime, int(mtime_epoch))
+      member = {
+          "path": rel_path,
+          "mtime": mtime,
+      }
+      if entry.is_symlink():
+        member["type"] = TYPE_LINK
+        member["target"] = os.readlink(entry.path)
+      elif entry.is_dir(follow_symlinks=False):
+        member["type"] = TYPE_DIR
+      elif entry.is_file(follow_symlinks=False):
+        member["type"] = TYPE_FILE
+        if base_contents:
+          # Hashing first costs a second read of changed files, but unchanged
+          # ones (typically the majority) are never compressed.
+          size, digest = _hash_file(entry.path, frame_size)
+          if digest in base_contents:
+            member["size"] = size
+            member["sha256"] = digest
+            member["base"] = True
+            if base_contents[digest]:
+              # So that deltas against this archive can refer to them.
+              member["chunks"] = base_contents[digest]
+            member["mode"] = normalize_mode(member["type"], st.st_mode)
+            members.append(member)
+            continue
+        if st.st_size > CHUNK_MIN_SIZE:
+          _add_chunked_file(member, entry.path, writer, base_chunks, frame_size)
+          has_parts = has_parts or "parts" in member
+        else:
+          h = hashlib.sha256()
+          extents = []
+          size = 0
+          with open(entry.path, "rb") as mf:
+            while True:
+              block = mf.read(frame_size)
+              if not block:
+                break
+              h.update(block)
+              size += len(block)
+              extents.extend(writer.add(block))
+          member["size"] = size
+          member["sha256"] = h.hexdigest()
+          member["extents"] = extents
+      else:
+        # Sockets, fifos, etc are not archived.
+        continue
+      member["mode"] = normalize_mode(member["type"], st.st_mode)
+      members.append(member)
+    frames = writer.finish()
+
+    index = {
+        "version": INDEX_VERSION,
+        "frames": frames,
+        "members": members,
+    }
+    if base_path is not None:
+      index["version"] = (PARTS_INDEX_VERSION
+                          if has_parts else DELTA_INDEX_VERSION)
+      index["base"] = os.path.basename(base_path)
+      index["depth"] = base_depth + 1
+    index_data = _compress(
+        json.dumps(index, sort_keys=True,
+                   separators=(",", ":")).encode("UTF-8"), level)
+    index_offset = f.tell()
+    f.write(index_data)
+    f.write(
+        struct.pack(FOOTER_FORMAT, FOOTER_MAGIC, index_offset, len(index_data)))
+
+
+def _add_chunked_file(member, path, writer, base_chunks, frame_size):
+  """Stores a file as content-defined chunks, filling in its member.
+
+  Chunks found in base_chunks ({digest: (sha256, offset, length)}) refer to
+  the base, and the member is stored as parts if any do.
+  """
+  h = hashlib.sha256()
+  chunks = []
+  parts = []
+  size = 0
+  with open(path, "rb") as f:
+    for chunk in iter_chunks(f, frame_size):
+      h.update(chunk)
+      size += len(chunk)
+      digest = _get_chunk_digest(chunk)
+      chunks.append([digest, len(chunk)])
+      base_chunk = base_chunks.get(digest)
+      if base_chunk is None or base_chunk[2] != len(chunk):
+        parts.extend([PART_LOCAL] + e for e in writer.add(chunk))
+        continue
+      sha256, offset, length = base_chunk
+      last = parts[-1] if parts else None
+      if (last is not None and last[0] == PART_BASE and last[1] == sha256 and
+          last[2] + last[3] == offset):
+        # Contiguous in the base, so merge.
+        last[3] += length
+      else:
+        parts.append([PART_BASE, sha256, offset, length])
+  member["size"] = size
+  member["sha256"] = h.hexdigest()
+  member["chunks"] = chunks
+  if any(part[0] == PART_BASE for part in parts):
+    member["parts"] = parts
+  else:
+    member["extents"] = [part[1:] for part in parts]
+
+
+def _matches(path, patterns):
+  for pattern in patterns:
+    if pattern.endswith("/"):
+      if path.startswith(pattern) or path + "/" == pattern:
+        return True
+    elif fnmatch.fnmatchcase(path, pattern):
+      return True
+  return False
+
+
+def _check_safe_path(path):
+  if os.path.isabs(path) or ".." in path.split("/"):
+    raise ArchiveError("Unsafe member path: {}".format(path))
+
+
+class ArchiveReader:
+  """Random access reader for an archive."""
+
+  def __init__(self, archive_path):
+    self.archive_path = archive_path
+    self.f = open(archive_path, "rb")
+    try:
+      self._read_index()
+    except:
+      self.f.close()
+      raise
+    self._frame_cache = (None, None)
+    self.bytes_read = 0
+    self._base_reader = None
+    self._contents_by_sha256 = None
+    self._chunks_by_digest = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    if self._base_reader is not None:
+      self._base_reader.close()
+      self._base_reader = None
+    self.f.close()
+
+  def _read_index(self):
+    f = self.f
+    if f.read(len(HEADER_MAGIC)) != HEADER_MAGIC:
+      raise ArchiveError("Not an archive: {}".format(self.archive_path))
+    f.seek(-FOOTER_SIZE, os.SEEK_END)
+    magic, index_offset, index_length = struct.unpack(FOOTER_FORMAT,
+                                                      f.read(FOOTER_SIZE))
+    if magic != FOOTER_MAGIC:
+      raise ArchiveError("Truncated archive: {}".format(self.archive_path))
+    f.seek(index_offset)
+    index = json.loads(zlib.decompress(f.read(index_length)).decode("UTF-8"))
+    if index.get("version") not in SUPPORTED_INDEX_VERSIONS:
+      raise ArchiveError("Unsupported archive version: {}".format(
+          self.archive_path))
+    self.frames = index["frames"]
+    self.members = index["members"]
+    self.base_name = index.get("base")
+    self.depth = index.get("depth", 0)
+
+  @property
+  def base_path(self):
+    """Path of the base archive (None if this is a full archive)."""
+    if self.base_name is None:
+      return None
+    return os.path.join(os.path.dirname(self.archive_path), self.base_name)
+
+  @property
+  def base_reader(self):
+    if self._base_reader is None:
+      if self.base_path is None:
+        raise ArchiveError("Not a delta archive: {}".format(self.archive_path))
+      if not os.path.exists(self.base_path):
+        raise ArchiveError("Missing base archive {} of {}".format(
+            self.base_path, self.archive_path))
+      self._base_reader = ArchiveReader(self.base_path)
+    return self._base_reader
+
+  def contents_by_sha256(self):
+    """Gets a dict of {sha256: file member} of contents readable from here."""
+    if self._contents_by_sha256 is None:
+      self._contents_by_sha256 = {
+          m["sha256"]: m for m in self.members if m["type"] == TYPE_FILE
+      }
+    return self._contents_by_sha256
+
+  def chunks_by_digest(self):
+    """Gets a dict of {chunk digest: (sha256, offset, length)} of contents.
+
+    Members taken from the base carry the chunks of the base member, so
+    this covers all contents readable from here.
+    """
+    if self._chunks_by_digest is None:
+      self._chunks_by_digest = dict()
+      for m in self.members:
+        offset = 0
+        for digest, length in m.get("chunks", ()):
+          self._chunks_by_digest.setdefault(digest,
+                                            (m["sha256"], offset, length))
+          offset += length
+    return self._chunks_by_digest
+
+  def _resolve_base_member(self, member):
+    """Resolves a 'base' member to (reader, member) actually holding data."""
+    reader = self
+    while member.get("base"):
+      reader = reader.base_reader
+      base_member = reader.contents_by_sha256().get(member["sha256"])
+      if base_member is None:
+        raise ArchiveError("Member {} not found in base {}".format(
+            member["path"], reader.archive_path))
+      member = base_member
+    return reader, member
+
+  def list(self, patterns=None):
+    """Lists members, optionally filtered by path globs.
+
+    A pattern ending in '/' matches everything under that directory.
+    """
+    if not patterns:
+      return list(self.members)
+    return [m for m in self.members if _matches(m["path"], patterns)]
+
+  def _read_frame(self, frame_index):
+    cached_index, cached_data = self._frame_cache
+    if cached_index == frame_index:
+      return cached_data
+    offset, csize, usize = self.frames[frame_index]
+    self.f.seek(offset)
+    data = zlib.decompress(self.f.read(csize))
+    if len(data) != usize:
+      raise ArchiveError("Corrupt frame {} in {}".format(
+          frame_index, self.archive_path))
+    self.bytes_read += csize
+    self._frame_cache = (frame_index, data)
+    return data
+
+  def iter_member_data(self, member, offset=0, length=None):
+    """Yields the data of a file member (or a byte range of it) in chunks."""
+    if member.get("base"):
+      reader, member = self._resolve_base_member(member)
+      yield from reader.iter_member_data(member, offset, length)
+      return
+    end = member["size"] if length is None else offset + length
+    if "parts" in member:
+      parts = member["parts"]
+    else:
+      parts = [[PART_LOCAL] + e for e in member.get("extents", ())]
+    pos = 0
+    for kind, location, part_offset, part_length in parts:
+      if pos >= end:
+        break
+      if pos + part_length > offset:
+        begin = max(offset - pos, 0)
+        stop = min(end - pos, part_length)
+        if kind == PART_LOCAL:
+          frame = self._read_frame(location)
+          yield memoryview(frame)[part_offset + begin:part_offset + stop]
+        else:
+          yield from self.base_reader.iter_content(location,
+                                                   part_offset + begin,
+                                                   stop - begin)
+      pos += part_length
+
+  def iter_content(self, sha256, offset, length):
+    """Yields a byte range of the member with the given contents."""
+    member = self.contents_by_sha256().get(sha256)
+    if member is None:
+      raise ArchiveError("Contents {} not found in {}".format(
+          sha256, self.archive_path))
+    yield from self.iter_member_data(member, offset, length)
+
+  def read_member(self, member):
+    return b"".join(self.iter_member_data(member))
+
+  def _in_frame_order(self, members):
+    # Members read from bases are grouped after local ones, in base order.
+    def key(m):
+      if m.get("base"):
+        try:
+          reader, m = self._resolve_base_member(m)
+        except ArchiveError:
+          # Reported when the data is read.
+          return (-1, -1)
+        return (reader.depth, m["extents"][0][0] if m.get("extents") else -1)
+      if "parts" in m:
+        local = [p for p in m["parts"] if p[0] == PART_LOCAL]
+        return (-1, local[0][1] if local else -1)
+      return (-1, m["extents"][0][0] if m.get("extents") else -1)
+
+    return sorted(members, key=key)
+
+  def chain(self):
+    """Lists the archive paths this archive needs, itself first."""
+    paths = [self.archive_path]
+    reader = self
+    while reader.base_name is not None:
+      reader = reader.base_reader
+      paths.append(reader.archive_path)
+    return paths
+
+  def verify(self, patterns=None):
+    """Verifies member contents against their hashes.
+
+    Returns the list of paths which fail to verify.
+    """
+    bad = []
+    files = [m for m in self.list(patterns) if m["type"] == TYPE_FILE]
+    for member in self._in_frame_order(files):
+      h = hashlib.sha256()
+      size = 0
+      try:
+        for chunk in self.iter_member_data(member):
+          h.update(chunk)
+          size += len(chunk)
+      except (ArchiveError, zlib.error):
+        bad.append(member["path"])
+        continue
+      if size != member["size"] or h.hexdigest() != member["sha256"]:
+        bad.append(member["path"])
+    return sorted(bad)
+
+  def extract(self, dest_dir, patterns=None):
+    """Extracts members (all or those matching patterns) into dest_dir.
+
+    Returns the list of extracted members.
+    """
+    members = self.list(patterns)
+    os.makedirs(dest_dir, exist_ok=True)
+    dirs = []
+    for member in self._in_frame_order(members):
+      path = member["path"]
+      _check_safe_path(path)
+      dest_path = os.path.join(dest_dir, path)
+      member_type = member["type"]
+      if member_type == TYPE_DIR:
+        os.makedirs(dest_path, exist_ok=True)
+        dirs.append((dest_path, member))
+        continue
+      os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+      if os.path.lexists(dest_path) and not os.path.isdir(dest_path):
+        os.unlink(dest_path)
+      if member_type == TYPE_LINK:
+        os.symlink(member["target"], dest_path)
+        continue
+      with open(dest_path, "wb") as f:
+        for chunk in self.iter_member_data(member):
+          f.write(chunk)
+      os.chmod(dest_path, member["mode"])
+      os.utime(dest_path, (member["mtime"], member["mtime"]))
+    # Directory attributes last, since populating them changes mtime.
+    for dest_path, member in dirs:
+      os.chmod(dest_path, member["mode"])
+      os.utime(dest_path, (member["mtime"], member["mtime"]))
+    return members
+
+
+def compare(archive_path_a, archive_path_b):
+  """Compares two archives.
+
+  Returns a list of human readable differences (empty if bit-identical).
+  If the bytes differ, differences are reported per member.
+  """
+  with open(archive_path_a, "rb") as fa, open(archive_path_b, "rb") as fb:
+    while True:
+      block_a = fa.read(FRAME_SIZE)
+      block_b = fb.read(FRAME_SIZE)
+      if block_a != block_b:
+        break
+      if not block_a:
+        return []
+
+  differences = []
+  with ArchiveReader(archive_path_a) as ra, ArchiveReader(archive_path_b) as rb:
+    members_a = {m["path"]: m for m in ra.members}
+    members_b = {m["path"]: m for m in rb.members}
+    for path in sorted(set(members_a) | set(members_b)):
+      a = members_a.get(path)
+      b = members_b.get(path)
+      if a is None or b is None:
+        differences.append("{}: only in {}".format(
+            path, archive_path_a if b is None else archive_path_b))
+        continue
+      for key in ("type", "mode", "mtime", "size", "sha256", "target", "base",
+                  "parts"):
+        if a.get(key) != b.get(key):
+          differences.append("{}: {} differs ({} vs {})".format(
+              path, key, a.get(key), b.get(key)))
+  if not differences:
+    differences.append("Members are identical but archive layout differs "
+                       "(different compression settings or zlib version?)")
+  return differences
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="archive",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  list_parser = subparsers.add_parser("list", help="Lists members")
+  list_parser.add_argument("archive", type=str)
+  list_parser.add_argument("patterns", nargs="*", type=str)
+  extract_parser = subparsers.add_parser("extract", help="Extracts members")
+  extract_parser.add_argument("archive", type=str)
+  extract_parser.add_argument("dest_dir", type=str)
+  extract_parser.add_argument("patterns", nargs="*", type=str)
+  verify_parser = subparsers.add_parser("verify", help="Verifies members")
+  verify_parser.add_argument("archive", type=str)
+  verify_parser.add_argument("patterns", nargs="*", type=str)
+  compare_parser = subparsers.add_parser(
+      "compare", help="Checks that two archives are bit-identical")
+  compare_parser.add_argument("archive", type=str)
+  compare_parser.add_argument("other_archive", type=str)
+  return parser
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  if parser.command == "compare":
+    differences = compare(parser.archive, parser.other_archive)
+    for difference in differences:
+      print(difference)
+    print("IDENTICAL" if not differences else "DIFFERENT")
+    return 1 if differences else 0
+  with ArchiveReader(parser.archive) as reader:
+    if parser.command == "list":
+      for member in reader.list(parser.patterns):
+        print("{} {:o} {:>12} {}".format(member["type"], member["mode"],
+                                         member.get("size", 0), member["path"]))
+    elif parser.command == "extract":
+      members = reader.extract(parser.dest_dir, parser.patterns)
+      print("Extracted {} members ({} compressed bytes read)".format(
+          len(members), reader.bytes_read))
+    elif parser.command == "verify":
+      bad = reader.verify(parser.patterns)
+      for path in bad:
+        print("BAD:", path)
+      print("Verified {} bytes read, {} bad".format(reader.bytes_read,
+                                                    len(bad)))
+      return 1 if bad else 0
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
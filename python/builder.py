@@ -14,15 +14,47 @@
 """Utilities for invoking builds."""
 
 from pathlib import *
+import fcntl
+import fnmatch
 import json
 import os
 import shutil
 import subprocess
 import sys
+import time
+import traceback
+
+import litrunner
+import logcapture
+import taskhistory
+import toolchain
 
 TOP_DIR = Path.cwd()
 DEFAULT_BUILD_ROOT = TOP_DIR.joinpath("build").resolve()
 DEFAULT_INSTALL_ROOT = TOP_DIR.joinpath("install").resolve()
+DEFAULT_LOG_ROOT = TOP_DIR.joinpath("logs").resolve()
+DEFAULT_CMAKE_BUILD_TYPE = "Release"
+LOG_DIR_ENV_VAR = "MRT_LOG_DIR"
+# Set to 0 to stream subprocess output to the console instead of capturing.
+LOG_CAPTURE_ENV_VAR = "MRT_LOG_CAPTURE"
+# Comma separated identifier patterns (i.e. "llvm-*,iree_tf_bazel") whose
+# build dirs are placed on a memory backed filesystem, when there is room.
+RAM_BUILD_ENV_VAR = "MRT_RAM_BUILD"
+RAM_BUILD_ROOT_ENV_VAR = "MRT_RAM_BUILD_ROOT"
+DEFAULT_RAM_BUILD_ROOT = Path("/dev/shm/mrt-build")
+# Required room over the historical peak size of a build dir.
+RAM_BUILD_HEADROOM = 1.25
+# Assumed size of a build dir without history.
+DEFAULT_BUILD_SIZE_ESTIMATE = 16 * 1024 * 1024 * 1024
+BUILD_SIZES_FILE_NAME = ".build_sizes.json"
+
+# Bytes of memory claimed by RAM build dirs placed by this process, which
+# have not grown to their size yet.
+_RAM_RESERVED_BYTES = 0
+# Identifiers whose build dir size was measured by this process.
+_MEASURED_BUILD_SIZES = set()
+# Locks held on the build dirs used by this process, by identifier.
+_BUILD_DIR_LOCKS = dict()
 
 
 def get_build_root():
@@ -33,14 +65,297 @@ def get_install_root():
   return DEFAULT_INSTALL_ROOT
 
 
+def get_log_root():
+  env_value = os.environ.get(LOG_DIR_ENV_VAR)
+  if env_value:
+    return Path(env_value)
+  else:
+    return DEFAULT_LOG_ROOT
+
+
+def get_ram_build_root():
+  env_value = os.environ.get(RAM_BUILD_ROOT_ENV_VAR)
+  if env_value:
+    return Path(env_value)
+  else:
+    return DEFAULT_RAM_BUILD_ROOT
+
+
+def is_ram_build_selected(identifier):
+  patterns = [
+      p.strip() for p in os.environ.get(RAM_BUILD_ENV_VAR, "").split(",")
+  ]
+  return any(fnmatch.fnmatchcase(identifier, p) for p in patterns if p)
+
+
+def get_tree_size(path):
+  """Gets the bytes allocated by a tree (following a symlinked root).
+
+  Uses du where available, which is much faster than walking the tree here.
+  """
+  try:
+    result = subprocess.run(
+        ["du", "-s", "--block-size=1", "--dereference-args",
+         str(path)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    # du still prints the total if some entries could not be read.
+    return int(result.stdout.split()[0])
+  except (OSError, ValueError, IndexError):
+    pass
+  total = 0
+  for dirpath, dirnames, filenames in os.walk(str(path)):
+    for name in filenames + dirnames:
+      try:
+        total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+      except OSError:
+        pass
+  return total
+
+
+def get_available_memory():
+  """Gets the available memory in bytes (None if unknown)."""
+  try:
+    with open("/proc/meminfo", "rt") as f:
+      for line in f:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError):
+    pass
+  return None
+
+
+def read_build_sizes():
+  """Reads the history of build dir sizes.
+
+  Returns {identifier: {"peak", "last", "time", "used"}}, where time is when
+  the size was last measured and used when a build last started.
+  """
+  try:
+    return json.loads(
+        get_build_root().joinpath(BUILD_SIZES_FILE_NAME).read_text(
+            encoding="UTF-8"))
+  except (OSError, ValueError):
+    return {}
+
+
+def update_build_sizes(update_fn):
+  """Updates the history of build dir sizes with update_fn(sizes).
+
+  Concurrent doit processes (i.e. 'doit -n') may update it, so this holds a
+  lock for the update.
+  """
+  sizes_path = get_build_root().joinpath(BUILD_SIZES_FILE_NAME)
+  # The history file is hidden already.
+  lock_path = sizes_path.parent.joinpath(sizes_path.name + ".lock")
+  tmp_path = sizes_path.parent.joinpath(sizes_path.name +
+                                        ".{}.tmp".format(os.getpid()))
+  os.makedirs(sizes_path.parent, exist_ok=True)
+  with open(lock_path, "a") as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    sizes = read_build_sizes()
+    update_fn(sizes)
+    tmp_path.write_text(json.dumps(sizes, indent=2, sort_keys=True),
+                        encoding="UTF-8")
+    os.replace(tmp_path, sizes_path)
+
+
+def record_build_size(identifier, build_dir):
+  """Records the current size of a build dir in the history.
+
+  Measuring reads the whole tree, so is only done the first time per run
+  for each identifier (i.e. after the main build, and not again after the
+  install and test builds, which add little).
+  """
+  if identifier in _MEASURED_BUILD_SIZES:
+    return
+  _MEASURED_BUILD_SIZES.add(identifier)
+  try:
+    size = get_tree_size(build_dir)
+
+    def update(sizes):
+      entry = sizes.setdefault(identifier, {})
+      entry["last"] = size
+      entry["peak"] = max(size, entry.get("peak", 0))
+      entry["time"] = int(time.time())
+
+    update_build_sizes(update)
+  except:
+    print("Failed to record build size of {} (ignoring)".format(identifier))
+    traceback.print_exc()
+
+
+def get_build_dir_lock_path(build_dir):
+  build_dir = Path(build_dir)
+  return build_dir.parent.joinpath(".in_use_" + build_dir.name + ".lock")
+
+
+def mark_build_dir_in_use(identifier, build_dir):
+  """Marks a build dir as in use, so that it is not reclaimed (see diskgc).
+
+  The start of the use is recorded in the build size history, and a shared
+  lock on the build dir is held until this process exits.
+  """
+  try:
+    if identifier not in _BUILD_DIR_LOCKS:
+      lock_path = get_build_dir_lock_path(build_dir)
+      os.makedirs(lock_path.parent, exist_ok=True)
+      lock_file = open(lock_path, "a")
+      fcntl.flock(lock_file, fcntl.LOCK_SH)
+      _BUILD_DIR_LOCKS[identifier] = lock_file
+
+    def update(sizes):
+      sizes.setdefault(identifier, {})["used"] = int(time.time())
+
+    update_build_sizes(update)
+  except:
+    print("Failed to mark build dir of {} in use (ignoring)".format(identifier))
+    traceback.print_exc()
+
+
+def is_build_dir_in_use(build_dir):
+  """Checks if a process holds the lock of a build dir."""
+  try:
+    lock_file = open(get_build_dir_lock_path(build_dir), "r")
+  except OSError:
+    return False
+  with lock_file:
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return True
+    return False
+
+
+def choose_ram_build_dir(identifier):
+  """Chooses a memory backed dir for a new build dir (None for disk).
+
+  A dir is chosen if the identifier is selected (MRT_RAM_BUILD) and both the
+  free space of the RAM build root and the available memory exceed the
+  historical peak size of the build dir, with some headroom.
+  """
+  global _RAM_RESERVED_BYTES
+  if not is_ram_build_selected(identifier):
+    return None
+  ram_root = get_ram_build_root()
+  # The RAM build root itself may not exist yet (i.e. /dev/shm/mrt-build).
+  fs_dir = ram_root
+  while not fs_dir.exists() and fs_dir != fs_dir.parent:
+    fs_dir = fs_dir.parent
+  try:
+    free_bytes = shutil.disk_usage(str(fs_dir)).free
+  except OSError:
+    print("RAM build root {} is not usable: Building {} on disk".format(
+        ram_root, identifier))
+    return None
+  available_bytes = get_available_memory()
+  if available_bytes is not None:
+    free_bytes = min(free_bytes, available_bytes)
+  free_bytes -= _RAM_RESERVED_BYTES
+  peak_bytes = read_build_sizes().get(identifier,
+                                      {}).get("peak",
+                                              DEFAULT_BUILD_SIZE_ESTIMATE)
+  required_bytes = int(peak_bytes * RAM_BUILD_HEADROOM)
+  if free_bytes < required_bytes:
+    print("Not enough memory for a RAM build of {} ({:.1f}GiB needed, "
+          "{:.1f}GiB free): Building on disk".format(identifier,
+                                                     required_bytes / 2**30,
+                                                     free_bytes / 2**30))
+    return None
+  _RAM_RESERVED_BYTES += required_bytes
+  print("Building {} in RAM ({:.1f}GiB needed, {:.1f}GiB free)".format(
+      identifier, required_bytes / 2**30, free_bytes / 2**30))
+  return ram_root.joinpath(identifier)
+
+
+def prepare_build_dir(identifier, build_dir):
+  """Creates a build dir, placing it in RAM if selected and there is room.
+
+  A RAM build dir is linked from its usual place under the build root, so
+  paths do not change. Only the build dir is in RAM: installs go to the
+  install root on disk, so they (and nothing else) persist. A build dir
+  which already exists is kept wherever it is, so that incremental builds
+  keep working until it is cleaned (or lost with the RAM contents).
+  The build dir is marked in use first (see mark_build_dir_in_use).
+  """
+  build_dir = Path(build_dir)
+  mark_build_dir_in_use(identifier, build_dir)
+  if build_dir.is_symlink() and not build_dir.exists():
+    # The RAM contents are gone (i.e. after a reboot).
+    print("RAM build dir of {} is gone: Starting over".format(identifier))
+    build_dir.unlink()
+  if build_dir.exists():
+    return
+  ram_build_dir = choose_ram_build_dir(identifier)
+  if ram_build_dir is None:
+    os.makedirs(build_dir, exist_ok=True)
+    return
+  shutil.rmtree(ram_build_dir, ignore_errors=True)
+  os.makedirs(ram_build_dir)
+  os.makedirs(build_dir.parent, exist_ok=True)
+  build_dir.symlink_to(ram_build_dir, target_is_directory=True)
+
+
+def remove_build_dir(build_dir):
+  """Removes a build dir, including its contents in RAM."""
+  build_dir = Path(build_dir)
+  if build_dir.is_symlink():
+    shutil.rmtree(os.path.realpath(build_dir), ignore_errors=True)
+    build_dir.unlink()
+  else:
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def get_toolchain():
+  """Gets the probed toolchain (None if disabled). See toolchain.py."""
+  return toolchain.get_toolchain(get_build_root().joinpath(
+      toolchain.PROBE_FILE_NAME))
+
+
+def get_task_history_store():
+  """Gets the history of task durations and resource use (see taskhistory)."""
+  return taskhistory.HistoryStore(get_build_root().joinpath(
+      taskhistory.HISTORY_FILE_NAME))
+
+
+def record_resource_use(identifier, capture):
+  """Records the resource use of a captured command of an identifier."""
+  if capture is None or capture.rusage is None:
+    return
+  try:
+    get_task_history_store().record(
+        "resources",
+        identifier=identifier,
+        seconds=time.time() - capture.start_time,
+        cpu_seconds=capture.rusage.ru_utime + capture.rusage.ru_stime,
+        # Linux reports KiB.
+        max_rss_bytes=capture.rusage.ru_maxrss * 1024)
+  except:
+    print("Failed to record resource use of {} (ignoring)".format(identifier))
+    traceback.print_exc()
+
+
 def subcommand(args, cwd, env=None):
+  """Runs a command, raising CalledProcessError on failure.
+
+  Output is captured to a compressed log per command (see logcapture), with
+  only progress (and errors on failure) printed, unless MRT_LOG_CAPTURE=0.
+  Returns the LogCapture (None if not captured).
+  """
   if env is not None:
-    sub_env = dict(os.environ)
-    sub_env.update(env)
+    sub_env = {k: str(v) for k, v in os.environ.items()}
+    sub_env.update({k: str(v) for k, v in env.items()})
     env = sub_env
   args = [str(c) for c in args]
   print("++ EXEC:", " ".join(args))
-  subprocess.check_call(args, cwd=cwd, env=env)
+  if os.environ.get(LOG_CAPTURE_ENV_VAR, "1") == "0":
+    subprocess.check_call(args, cwd=cwd, env=env)
+    return None
+  return logcapture.check_call_captured(args,
+                                        cwd=cwd,
+                                        env=env,
+                                        log_path=logcapture.get_next_log_path(
+                                            get_log_root(), args, cwd))
 
 
 class BuildConfig:
@@ -49,15 +364,31 @@ class BuildConfig:
   The base class delegates based on the 'build_type' key.
   """
 
-  def __init__(self, *, identifier, json_dict, source_dir):
+  def __init__(self,
+               *,
+               identifier,
+               source_dir,
+               json_dict=None,
+               json_dict_lambda=None):
     super().__init__()
     self.identifier = identifier
-    self.json_dict = json_dict
     self.source_dir = source_dir
+    # Configs which are expensive to compute (i.e. probe python interpreters)
+    # should be passed as a lambda so that they are only evaluated when a task
+    # actually executes, not when tasks are loaded.
+    self._json_dict = json_dict
+    self._json_dict_lambda = json_dict_lambda
 
   def __repr__(self):
     return "BuildConfig({}, {})".format(self.identifier, self.json_dict)
 
+  @property
+  def json_dict(self):
+    if self._json_dict is None:
+      self._json_dict = (self._json_dict_lambda()
+                         if self._json_dict_lambda is not None else {})
+    return self._json_dict
+
   @classmethod
   def load(cls, *, config_file, **kwargs):
     with open(config_file, "rt") as f:
@@ -66,17 +397,17 @@ class BuildConfig:
 
   @property
   def build_dir(self):
-    """Gets the build directory for this config."""
-    path = get_build_root().joinpath(self.identifier)
-    os.makedirs(path, exist_ok=True)
-    return path
+    """Gets the build directory for this config.
+
+    The directory is not created here: tasks are generated for every command
+    (including 'doit list'), and must not touch the filesystem.
+    """
+    return get_build_root().joinpath(self.identifier)
 
   @property
   def install_dir(self):
     """Gets the install directory for this config."""
-    path = get_install_root().joinpath(self.identifier)
-    os.makedirs(path, exist_ok=True)
-    return path
+    return get_install_root().joinpath(self.identifier)
 
   def yield_tasks(self):
     """Yields tasks for the build."""
@@ -88,8 +419,8 @@ class CMakeBuildConfig(BuildConfig):
 
   def __init__(self, configure_dir=None, **kwargs):
     super().__init__(**kwargs)
-    self.configure_dir = Path(
-        self.source_dir if configure_dir is None else configure_dir)
+    self.configure_dir = Path(self.source_dir if configure_dir is
+                              None else configure_dir)
 
   def yield_tasks(self,
                   *,
@@ -97,14 +428,19 @@ class CMakeBuildConfig(BuildConfig):
                   basename=None,
                   install_target=None,
                   test_target=None,
-                  task_dep=()):
-    """Performs a CMake build."""
+                  task_dep=(),
+                  post_install_actions=()):
+    """Performs a CMake build.
+
+    post_install_actions are appended to the install task (i.e. to add
+    artifacts built from the build tree to the install).
+    """
 
     def clean_build():
-      shutil.rmtree(self.build_dir)
+      remove_build_dir(self.build_dir)
 
     def clean_install():
-      shutil.rmtree(self.install_dir)
+      shutil.rmtree(self.install_dir, ignore_errors=True)
 
     def subtask(suffix, qualified=False):
       subtask_name = basename + ":" + suffix if basename is not None else suffix
@@ -141,7 +477,7 @@ class CMakeBuildConfig(BuildConfig):
     if test_target:
       yield {
           "name": subtask("test"),
-          "actions": [(self.build, [test_target])],
+          "actions": [(self.test, [test_target])],
           "file_dep": [self.build_dir.joinpath("CMakeCache.txt")],
           "task_dep": [subtask("build", qualified=True)],
       }
@@ -154,8 +490,10 @@ class CMakeBuildConfig(BuildConfig):
     # Install.
     if install_target:
       yield {
-          "name": subtask("install"),
-          "actions": [(self.build, [install_target])],
+          "name":
+              subtask("install"),
+          "actions": [(self.build, [install_target])] +
+                     list(post_install_actions),
           "file_dep": [self.build_dir.joinpath("CMakeCache.txt")],
           "clean": [clean_install],
           "task_dep": [subtask("test", qualified=True)],
@@ -163,12 +501,43 @@ class CMakeBuildConfig(BuildConfig):
     else:
       yield {
           "name": subtask("install"),
-          "actions": None,
+          "actions": list(post_install_actions) or None,
           "task_dep": [subtask("test", qualified=True)],
       }
 
+  def test(self, target):
+    """Runs a test target.
+
+    Check targets running lit are driven directly, with sharding and
+    results cached across runs (see litrunner), unless MRT_TEST_RUNNER=cmake.
+    Other targets are just built.
+    """
+    if litrunner.get_runner() == litrunner.RUNNER_LIT:
+      command = None
+      try:
+        command = litrunner.find_lit_command(self.build_dir, target)
+      except:
+        print("Could not find the lit command of {} (ignoring)".format(target))
+        traceback.print_exc()
+      if command is not None:
+        deps = litrunner.find_test_deps(self.build_dir, target)
+        if deps:
+          self.build(*deps)
+        junit_name = "{}_{}.xml".format(self.identifier.replace("/", "_"),
+                                        target)
+        litrunner.run_tests(command,
+                            self.build_dir,
+                            name="{}:{}".format(self.identifier, target),
+                            junit_path=get_log_root().joinpath(
+                                "junit", junit_name),
+                            log_root=get_log_root())
+        return
+    self.build(target)
+
   def _exec_cmake(self, cmake_args):
-    subcommand(cmake_args, cwd=self.build_dir)
+    prepare_build_dir(self.identifier, self.build_dir)
+    record_resource_use(self.identifier,
+                        subcommand(cmake_args, cwd=self.build_dir))
 
   @property
   def canonical_cmake_args(self):
@@ -176,6 +545,25 @@ class CMakeBuildConfig(BuildConfig):
     value = self.json_dict.get("canonical_cmake_args")
     return value if value else []
 
+  @property
+  def build_type(self):
+    """Gets the CMAKE_BUILD_TYPE (the last one in the canonical cmake args)."""
+    build_type = DEFAULT_CMAKE_BUILD_TYPE
+    for arg in self.canonical_cmake_args:
+      if arg.startswith("-DCMAKE_BUILD_TYPE="):
+        build_type = arg.split("=", 1)[1]
+    return build_type
+
+  @property
+  def toolchain_cmake_args(self):
+    """Gets the cmake args selecting the toolchain (i.e. a faster linker).
+
+    These are probed on first use, so must not be accessed while loading
+    tasks.
+    """
+    tc = get_toolchain()
+    return tc.get_cmake_args(self.build_type) if tc is not None else []
+
   def configure_and_build(self, extra_configure_args=(), targets=()):
     self.configure(extra_args=extra_configure_args)
     self.build(targets=targets)
@@ -189,9 +577,9 @@ class CMakeBuildConfig(BuildConfig):
         "-GNinja",
         "-S{}".format(self.configure_dir),
         "-B{}".format(build_dir),
-        "-DCMAKE_BUILD_TYPE=Release",
+        "-DCMAKE_BUILD_TYPE={}".format(DEFAULT_CMAKE_BUILD_TYPE),
         "-DCMAKE_INSTALL_PREFIX={}".format(self.install_dir),
-    ] + self.canonical_cmake_args + list(extra_args)
+    ] + self.toolchain_cmake_args + self.canonical_cmake_args + list(extra_args)
     self._exec_cmake(cmake_args)
 
   def build(self, *targets):
@@ -205,3 +593,4 @@ class CMakeBuildConfig(BuildConfig):
     for target in targets:
       cmake_args.extend(["--target", target])
     self._exec_cmake(cmake_args)
+    record_build_size(self.identifier, build_dir)
@@ -12,16 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
+import glob
 import hashlib
+import json
 import os
 from pathlib import Path
+import re
 import shutil
+import socket
 import subprocess
+import time
 import traceback
 
+import archive
 import builder
+import cachestats
+import manifest
+import toolchain
+import versionmap
+import workqueue
 
 CACHE_DIR_ENV_VAR = "MRT_CACHE_DIR"
+VERIFY_ENV_VAR = "MRT_INSTALL_VERIFY"
+ANCESTOR_DISTANCE_ENV_VAR = "MRT_CACHE_ANCESTOR_DISTANCE"
+DEFAULT_ANCESTOR_DISTANCE = 64
+PREFETCH_JOBS_ENV_VAR = "MRT_PREFETCH_JOBS"
+DEFAULT_PREFETCH_JOBS = 4
+# Maximum length of a chain of delta archives (0 disables deltas). A full
+# snapshot is stored whenever a delta would exceed it, which bounds the
+# archives an extraction reads.
+DELTA_DEPTH_ENV_VAR = "MRT_CACHE_DELTA_DEPTH"
+DEFAULT_DELTA_DEPTH = 4
+# Set to "0" to archive and publish synchronously (before dependents run)
+# instead of in a separate publish task.
+PUBLISH_ASYNC_ENV_VAR = "MRT_CACHE_PUBLISH_ASYNC"
+# Same meaning as for other reproducible build tools: archived mtimes are
+# clamped to this. Defaults to the commit time of the source dir.
+SOURCE_DATE_EPOCH_ENV_VAR = "SOURCE_DATE_EPOCH"
+
+# Registered InstallCache instances, keyed by their main task name (i.e.
+# "llvm:mlir-generic-rtti"). Populated as tasks are generated.
+_INSTALL_CACHES = dict()
+# Task names of consumers -> list of the cache task names they need.
+_CACHE_CONSUMERS = dict()
+_WORK_QUEUE = None
 
 
 def get_cache_root():
@@ -32,17 +69,38 @@ def get_cache_root():
     return builder.TOP_DIR.joinpath("cache").resolve()
 
 
+def is_checked_out(src_dir):
+  return Path(src_dir).joinpath(".git").exists()
+
+
 def read_git_state(src_dir):
-  """Generates git state suitable for hashing as a version spec."""
+  """Generates git state suitable for hashing as a version spec.
+
+  A clean checkout (no local changes, submodules at their recorded commits
+  or not initialized) is fully determined by its commit, so is identified by
+  that alone. This lets the state of a source dir which is not checked out
+  be derived from the commit pinned in the version map (see versionmap.py).
+  """
+  if not is_checked_out(src_dir):
+    commit = versionmap.get_pinned_commit(src_dir)
+    if commit is None:
+      raise RuntimeError(
+          "Source dir {} is not checked out or pinned in {}".format(
+              src_dir, versionmap.get_version_map_file()))
+    return "commit={}".format(commit)
 
   def run(*args):
     return subprocess.check_output(args, cwd=str(src_dir)).decode("UTF-8")
 
-  state = "\n".join([
-      run("git", "rev-parse", "HEAD"),
-      run("git", "submodule", "status"),
-      run("git", "diff"),
-  ])
+  head = run("git", "rev-parse", "HEAD")
+  submodule_status = run("git", "submodule", "status")
+  diff = run("git", "diff")
+  # Submodules which are not initialized ('-', i.e. outside of a sparse
+  # checkout) are not built from, so do not make the state unclean.
+  if not diff and all(
+      line[:1] in (" ", "-") for line in submodule_status.splitlines()):
+    return "commit={}".format(head.strip())
+  state = "\n".join([head, submodule_status, diff])
   module_deps_path = Path(src_dir).joinpath("module_deps.json")
   if module_deps_path.exists():
     state += "\n"
@@ -50,27 +108,261 @@ def read_git_state(src_dir):
   return state
 
 
+def read_git_commit(src_dir):
+  """Reads the HEAD commit of a source directory."""
+  return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                 cwd=str(src_dir)).decode("UTF-8").strip()
+
+
+def read_git_commit_time(src_dir):
+  """Reads the committer timestamp of the HEAD commit of a source directory."""
+  return int(
+      subprocess.check_output(["git", "log", "-1", "--format=%ct", "HEAD"],
+                              cwd=str(src_dir)).decode("UTF-8").strip())
+
+
+def read_git_ancestors(src_dir, max_distance):
+  """Lists HEAD and its first-parent ancestors, nearest first.
+
+  At most max_distance + 1 commits are returned (HEAD is distance 0).
+  """
+  args = [
+      "git", "rev-list", "--first-parent",
+      "--max-count={}".format(max_distance + 1), "HEAD"
+  ]
+  output = subprocess.check_output(args, cwd=str(src_dir)).decode("UTF-8")
+  return output.split()
+
+
+def get_build_config_version_data(build_config):
+  """Gets version data for the cmake args of a build config.
+
+  Paths under the repo root are made relative so that builders with
+  different checkout locations agree. The toolchain settings are included,
+  if enabled, but not the probed toolchain: probing runs compilers, which
+  lookups must not need (see toolchain.py).
+  """
+  top_dir = str(builder.TOP_DIR)
+  args = [
+      arg.replace(top_dir, "$TOP_DIR")
+      for arg in build_config.canonical_cmake_args
+  ]
+  if not toolchain.is_enabled():
+    return json.dumps(args)
+  return json.dumps(args) + ":toolchain=" + toolchain.get_key_data(
+      build_config.build_type)
+
+
+def get_work_queue():
+  """Gets the (memoized) shared queue of cache builds, or None if disabled.
+
+  See workqueue.py.
+  """
+  global _WORK_QUEUE
+  if not workqueue.is_enabled():
+    return None
+  if _WORK_QUEUE is None:
+    _WORK_QUEUE = workqueue.WorkQueue(workqueue.get_shared_cache_dir())
+  return _WORK_QUEUE
+
+
+def get_stats_store():
+  """Gets the store of cache lookup statistics.
+
+  The local cache dir does not outlive ephemeral builders, so with a shared
+  cache dir, events are recorded there instead (in a file per host, so that
+  hosts never interleave appends) and summarized across hosts. Events
+  recorded locally are still read.
+  """
+  local_stats_dir = get_cache_root().joinpath(".stats")
+  shared_cache_dir = workqueue.get_shared_cache_dir()
+  if shared_cache_dir is None:
+    return cachestats.StatsStore(local_stats_dir.joinpath("events.jsonl"))
+  return cachestats.StatsStore(shared_cache_dir.joinpath(
+      ".stats", "events_{}.jsonl".format(socket.gethostname())),
+                               extra_dirs=[local_stats_dir])
+
+
+def get_verify_mode():
+  """Gets the install verification mode (one of manifest.VERIFY_MODES)."""
+  mode = os.environ.get(VERIFY_ENV_VAR, manifest.VERIFY_STAT)
+  if mode not in manifest.VERIFY_MODES:
+    raise ValueError("{} must be one of {}".format(VERIFY_ENV_VAR,
+                                                   manifest.VERIFY_MODES))
+  return mode
+
+
+def get_max_delta_depth():
+  env_value = os.environ.get(DELTA_DEPTH_ENV_VAR)
+  if env_value:
+    return int(env_value)
+  else:
+    return DEFAULT_DELTA_DEPTH
+
+
+def get_publish_async():
+  """Gets whether to archive and publish installs in a separate task.
+
+  See InstallCache.yield_tasks.
+  """
+  return os.environ.get(PUBLISH_ASYNC_ENV_VAR) != "0"
+
+
+def snapshot_tree(src_dir, dest_dir):
+  """Snapshots a tree as hardlinks (copying where that is not possible)."""
+  src_dir = str(src_dir)
+  dest_dir = str(dest_dir)
+  dirs = []
+  for dirpath, dirnames, filenames in os.walk(src_dir):
+    rel_dir = os.path.relpath(dirpath, src_dir)
+    out_dir = os.path.normpath(os.path.join(dest_dir, rel_dir))
+    os.makedirs(out_dir, exist_ok=True)
+    dirs.append((dirpath, out_dir))
+    # Symlinks to dirs are listed as dirs but not walked into.
+    names = filenames + [
+        d for d in dirnames if os.path.islink(os.path.join(dirpath, d))
+    ]
+    for name in names:
+      src_path = os.path.join(dirpath, name)
+      dest_path = os.path.join(out_dir, name)
+      if os.path.islink(src_path):
+        os.symlink(os.readlink(src_path), dest_path)
+        continue
+      try:
+        os.link(src_path, dest_path)
+      except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+          raise
+        shutil.copy2(src_path, dest_path)
+  # Creating entries changes dir mtimes, so restore them last.
+  for src_path, dest_path in reversed(dirs):
+    shutil.copystat(src_path, dest_path)
+
+
+def get_max_ancestor_distance():
+  env_value = os.environ.get(ANCESTOR_DISTANCE_ENV_VAR)
+  if env_value:
+    return int(env_value)
+  else:
+    return DEFAULT_ANCESTOR_DISTANCE
+
+
+class CacheIndex:
+  """Index of commit metadata for all cache entries of one cache_key.
+
+  Each cache entry has a metadata file next to its archive, recording the
+  git commit it was built from. Reading every metadata file on every lookup
+  does not scale, so the commit of each one is remembered in an index file
+  under the cache root and only metadata files not yet indexed are read.
+  """
+
+  def __init__(self, cache_key: str):
+    self.cache_key = cache_key
+    self._name_re = re.compile("^" + re.escape(cache_key) +
+                               r"_([0-9a-f]{56})\.json$")
+
+  @property
+  def index_file(self):
+    return get_cache_root().joinpath(".index", self.cache_key + ".json")
+
+  def _load(self):
+    try:
+      return json.loads(self.index_file.read_text(encoding="UTF-8"))
+    except (OSError, ValueError):
+      return {}
+
+  def _save(self, entries):
+    index_file = self.index_file
+    os.makedirs(index_file.parent, exist_ok=True)
+    tmp_file = index_file.parent.joinpath("." + index_file.name + ".tmp")
+    tmp_file.write_text(json.dumps(entries, sort_keys=True), encoding="UTF-8")
+    tmp_file.rename(index_file)
+
+  def refresh(self):
+    """Synchronizes the index with the metadata files in the cache root.
+
+    Returns a dict of {commit: [version_hash...]}.
+    """
+    cache_root = get_cache_root()
+    entries = self._load()
+    current = dict()
+    changed = False
+    if cache_root.exists():
+      with os.scandir(cache_root) as it:
+        for entry in it:
+          m = self._name_re.match(entry.name)
+          if not m:
+            continue
+          if entry.name in entries:
+            current[entry.name] = entries[entry.name]
+            continue
+          try:
+            metadata = json.loads(Path(entry.path).read_text(encoding="UTF-8"))
+          except (OSError, ValueError):
+            continue
+          current[entry.name] = metadata.get("commit")
+          changed = True
+    if changed or len(current) != len(entries):
+      self._save(current)
+
+    by_commit = dict()
+    for name, commit in current.items():
+      if commit:
+        version_hash = self._name_re.match(name).group(1)
+        by_commit.setdefault(commit, []).append(version_hash)
+    return by_commit
+
+
 class InstallCache:
   """Task generator for caching installation artifacts.
 
   This is typically used to generate cache tasks which delegate to a local
   build/install task as needed.
+
+  The version hash is a Merkle-style composition of the node's own version
+  data (typically its git state), the cmake args of its build_config (if
+  any) and the version hashes of the caches it depends on, so that a change
+  anywhere upstream invalidates it.
   """
 
-  def __init__(self, *, identifier: str, cache_key: str, install_task: str,
-               version_data_lambda):
+  def __init__(self,
+               *,
+               identifier: str,
+               cache_key: str,
+               install_task: str,
+               version_data_lambda,
+               source_dir=None,
+               build_config=None,
+               build_source_dirs=(),
+               deps=()):
     self.identifier = identifier
     self.cache_key = cache_key
     self.install_task = install_task
     self.version_data_lambda = version_data_lambda
+    self.build_config = build_config
+    self.deps = list(deps)
+    # If set, the git commit of the source dir is recorded with each cache
+    # entry, enabling nearest-ancestor lookup on an exact miss.
+    self.source_dir = source_dir
+    # Other source dirs needed to build locally (but which are not part of
+    # the version), i.e. tools used by tests.
+    self.build_source_dirs = list(build_source_dirs)
     self._version_hash = None
+    # Main task name, set when tasks are generated.
+    self.task_name = None
+    # Time at which a lookup missed, used to measure the local build.
+    self._miss_time = None
+    self._lookup_result = None
 
   @property
   def version_hash(self):
     if self._version_hash is None:
-      hash_data = ":".join(
-          [self.identifier, self.cache_key,
-           self.version_data_lambda()]).encode("UTF-8")
+      parts = [self.identifier, self.cache_key, self.version_data_lambda()]
+      if self.build_config is not None:
+        parts.append(get_build_config_version_data(self.build_config))
+      for dep in sorted(self.deps, key=lambda d: d.cache_key):
+        parts.append("{}={}".format(dep.cache_key, dep.version_hash))
+      hash_data = ":".join(parts).encode("UTF-8")
       self._version_hash = hashlib.sha224(hash_data).hexdigest()
     return self._version_hash
 
@@ -85,11 +377,104 @@ class InstallCache:
     install_dir = self.install_dir
     return install_dir.parent.joinpath(".installed_" + install_dir.name)
 
+  @property
+  def manifest_file(self):
+    """Manifest of the files in the install directory."""
+    install_dir = self.install_dir
+    return install_dir.parent.joinpath(".manifest_" + install_dir.name +
+                                       ".json")
+
+  @property
+  def seed_manifest_file(self):
+    """Manifest of the files seeded from an ancestor."""
+    install_dir = self.install_dir
+    return install_dir.parent.joinpath(".seed_" + install_dir.name + ".json")
+
+  def get_cache_archive_file(self, version_hash):
+    return get_cache_root().joinpath("{}_{}.mrta".format(
+        self.cache_key, version_hash))
+
   @property
   def cache_archive_file(self):
     """The installation cache archive file."""
-    return get_cache_root().joinpath("{}_{}.tar".format(self.cache_key,
-                                                        self.version_hash))
+    return self.get_cache_archive_file(self.version_hash)
+
+  @property
+  def cache_manifest_file(self):
+    """Manifest of the archive contents, stored alongside it."""
+    return get_cache_root().joinpath("{}_{}.manifest.json".format(
+        self.cache_key, self.version_hash))
+
+  @property
+  def queue_job_name(self):
+    """Name of the job building this install in the work queue."""
+    return "{}_{}".format(self.cache_key, self.version_hash)
+
+  @property
+  def snapshot_dir(self):
+    """Snapshot of the install dir, archived by the publish task."""
+    return get_cache_root().joinpath(
+        ".snapshots", "{}_{}".format(self.cache_key, self.version_hash))
+
+  @property
+  def cache_metadata_file(self):
+    """Metadata (i.e. git commit) recorded alongside the archive file."""
+    return get_cache_root().joinpath("{}_{}.json".format(
+        self.cache_key, self.version_hash))
+
+  @property
+  def build_task_prefix(self):
+    """The tasks building the install (i.e. 'build_llvm:<config>')."""
+    if self.install_task.endswith(":install"):
+      return self.install_task[:-len(":install")]
+    return self.install_task
+
+  def is_build_task(self, task_name):
+    prefix = self.build_task_prefix
+    return task_name == prefix or task_name.startswith(prefix + ":")
+
+  def get_miss_time(self):
+    """Gets when the last lookup of this version missed (None if never).
+
+    Under 'doit -n', the lookup may have run in another process, so this
+    falls back to the recorded stats.
+    """
+    if self._miss_time is not None:
+      return self._miss_time
+    miss_times = [
+        e["time"]
+        for e in get_stats_store().read_events()
+        if e.get("kind") == "lookup" and e.get("result") ==
+        cachestats.LOOKUP_MISS and e.get("version_hash") == self.version_hash
+    ]
+    return max(miss_times) if miss_times else None
+
+  def measure_build_seconds(self):
+    """Measures the local build from the task history (None if unknown).
+
+    Sums the recorded durations of the tasks building the install (see
+    scheduler.SchedulingReporter) which ran since the lookup missed, so
+    unrelated tasks running meanwhile are not counted.
+    """
+    miss_time = self.get_miss_time()
+    if miss_time is None:
+      return None
+    seconds = [
+        e["seconds"]
+        for e in builder.get_task_history_store().read_events()
+        if e.get("kind") == "task" and e.get("succeeded") and
+        e["time"] >= miss_time and self.is_build_task(e["name"])
+    ]
+    return sum(seconds) if seconds else None
+
+  def is_cached_locally(self):
+    """Checks (without side effects) if the install or its archive exist."""
+    try:
+      if self.marker_file.read_text(encoding="UTF-8") == self.version_hash:
+        return True
+    except OSError:
+      pass
+    return self.cache_archive_file.exists()
 
   def install_is_ok(self):
     if not self.marker_file.exists() or not self.install_dir.exists():
@@ -103,58 +488,659 @@ class InstallCache:
       if self.cache_archive_file.exists():
         self.cache_archive_file.unlink()
       return False
+    return self.verify_install()
+
+  def verify_install(self, mode=None):
+    """Verifies the install directory against its manifest.
+
+    Damaged files are re-extracted from the cache archive if it is present.
+    Returns whether the install is intact.
+    """
+    if mode is None:
+      mode = get_verify_mode()
+    if mode == manifest.VERIFY_NONE or not self.manifest_file.exists():
+      return True
+    install_manifest = manifest.Manifest.load(self.manifest_file)
+    damaged = install_manifest.verify(self.install_dir, mode)
+    if not damaged:
+      return True
+    print("Install {} has {} damaged files (of {})".format(
+        self.identifier, len(damaged), len(install_manifest)))
+    if not self.cache_archive_file.exists():
+      return False
+    try:
+      self.repair_from_archive_file(self.cache_archive_file, damaged)
+    except:
+      print("Failed to repair {} (ignoring)".format(self.identifier))
+      traceback.print_exc()
+      return False
+    damaged = install_manifest.verify(self.install_dir, mode)
+    if damaged:
+      print("Install {} still has {} damaged files after repair".format(
+          self.identifier, len(damaged)))
+      return False
     return True
 
+  def repair_from_archive_file(self, archive_path, rel_paths):
+    """Re-extracts only the given paths from an archive."""
+    install_dir = self.install_dir
+    print("Repairing {} files of {} from {}".format(len(rel_paths),
+                                                    self.identifier,
+                                                    archive_path))
+    with archive.ArchiveReader(archive_path) as reader:
+      reader.extract(install_dir, rel_paths)
+
+  @property
+  def source_date_epoch(self):
+    """Gets the timestamp that archived mtimes are clamped to.
+
+    Derived from the sources (not the time of the build), so that independent
+    builds of the same key archive identically. Without a source dir, the
+    latest epoch of the deps is used.
+    """
+    env_value = os.environ.get(SOURCE_DATE_EPOCH_ENV_VAR)
+    if env_value:
+      return int(env_value)
+    if self.source_dir is not None:
+      return read_git_commit_time(self.source_dir)
+    return max([dep.source_date_epoch for dep in self.deps], default=0)
+
+  def write_manifest_file(self, root_dir=None):
+    """Writes the install and archive manifests from the install dir.
+
+    root_dir overrides the install dir (i.e. for a snapshot of it). The
+    install dir itself is left as built (so that incremental builds into it
+    stay up to date), so only the archive manifest has its mtimes clamped
+    like the archive, to apply as-is to an extraction of it.
+    """
+    install_manifest = manifest.Manifest.create(self.install_dir if root_dir is
+                                                None else root_dir)
+    install_manifest.save(self.manifest_file)
+    install_manifest.clamp_mtimes(self.source_date_epoch).save(
+        self.cache_manifest_file)
+
   def touch_marker_file(self):
     self.marker_file.write_text(self.version_hash, encoding="UTF-8")
 
-  def create_cache_archive_file(self):
-    # Create the tarfile.
+  def create_cache_archive_file(self, root_dir=None):
     archive_path = self.cache_archive_file
     archive_tmp_path = archive_path.parent.joinpath("." + archive_path.name +
                                                     ".tmp")
-    install_dir = self.install_dir
+    install_dir = self.install_dir if root_dir is None else root_dir
 
     if archive_path.exists():
       return
     if archive_tmp_path.exists():
       archive_tmp_path.unlink()
 
-    print("Creating archive cache file:", archive_path)
+    base_path = self.find_delta_base_archive_file()
+    if base_path is not None:
+      print("Creating delta archive cache file: {} (base {})".format(
+          archive_path, base_path.name))
+    else:
+      print("Creating archive cache file:", archive_path)
     os.makedirs(archive_tmp_path.parent, exist_ok=True)
-    subprocess.check_call(
-        ["tar", "cf", str(archive_tmp_path), install_dir.name],
-        cwd=str(install_dir.parent))
+    archive.create(archive_tmp_path,
+                   install_dir,
+                   base_path=base_path,
+                   mtime_epoch=self.source_date_epoch)
     # Atomic rename into place.
     archive_tmp_path.rename(archive_path)
 
-  def expand_cache_archive_file(self):
-    archive_path = self.cache_archive_file
-    if not archive_path.exists():
+  def find_delta_base_archive_file(self):
+    """Finds a recent archive of the same cache_key to store a delta against.
+
+    Prefers the nearest cached ancestor, falling back to the most recently
+    used archive of the family. Returns None (store a full snapshot) if
+    deltas are disabled, there is no candidate or the chain would get too
+    deep.
+    """
+    max_depth = get_max_delta_depth()
+    if max_depth <= 0:
+      return None
+    base_path = self.find_ancestor_archive_file()
+    if base_path is None:
+      candidates = [
+          p for p in get_cache_root().glob(
+              glob.escape(self.cache_key) + "_*.mrta")
+          if p.name != self.cache_archive_file.name and
+          re.match(r"^_[0-9a-f]{56}\.mrta$", p.name[len(self.cache_key):])
+      ]
+      if not candidates:
+        return None
+      base_path = max(candidates, key=lambda p: p.stat().st_mtime)
+    try:
+      with archive.ArchiveReader(base_path) as reader:
+        depth = reader.depth
+        # Make sure that the whole chain is present.
+        reader.chain()
+    except:
+      print("Unusable delta base {} (ignoring)".format(base_path))
+      traceback.print_exc()
+      return None
+    if depth + 1 > max_depth:
+      # Periodic full snapshot.
+      return None
+    return base_path
+
+  def write_cache_metadata_file(self):
+    metadata = {
+        "identifier": self.identifier,
+        "cache_key": self.cache_key,
+        "version_hash": self.version_hash,
+        "created": int(time.time()),
+    }
+    if self.source_dir is not None:
+      metadata["commit"] = read_git_commit(self.source_dir)
+    if self.build_config is not None:
+      # Probed when the build was configured, so loaded from the probe file.
+      tc = builder.get_toolchain()
+      if tc is not None:
+        metadata["toolchain"] = json.loads(
+            tc.get_version_data(self.build_config.build_type))
+    metadata_path = self.cache_metadata_file
+    metadata_tmp_path = metadata_path.parent.joinpath("." + metadata_path.name +
+                                                      ".tmp")
+    metadata_tmp_path.write_text(json.dumps(metadata, sort_keys=True),
+                                 encoding="UTF-8")
+    metadata_tmp_path.rename(metadata_path)
+
+  def find_ancestor_archive_file(self):
+    """Finds the archive built from the nearest cached ancestor of HEAD.
+
+    Lookup cost is bounded by the ancestor distance, not by the number of
+    cache entries. Returns None if there is no such archive.
+    """
+    if self.source_dir is None:
+      return None
+    max_distance = get_max_ancestor_distance()
+    if max_distance < 0:
+      return None
+    by_commit = CacheIndex(self.cache_key).refresh()
+    if not by_commit:
+      return None
+    for distance, commit in enumerate(
+        read_git_ancestors(self.source_dir, max_distance)):
+      for version_hash in by_commit.get(commit, ()):
+        if version_hash == self.version_hash:
+          continue
+        archive_path = self.get_cache_archive_file(version_hash)
+        if archive_path.exists():
+          print("Found cached ancestor {} at distance {}: {}".format(
+              commit, distance, archive_path))
+          return archive_path
+    return None
+
+  def clear_install_dir(self):
+    """Removes a partial or outdated install (and any seed of it)."""
+    for path in (self.marker_file, self.manifest_file, self.seed_manifest_file):
+      if path.exists():
+        path.unlink()
+    if self.install_dir.exists():
+      print("Removing outdated install of {}".format(self.identifier))
+      shutil.rmtree(self.install_dir)
+
+  def seed_from_ancestor(self):
+    """Seeds the install directory from the nearest cached ancestor.
+
+    The seeded install is not marked as installed, so the local build still
+    runs, but installs over the ancestor's tree instead of into an empty one.
+    A (stat only) manifest of the seed is kept, so that files which the
+    build no longer installs are pruned before it is archived (see
+    prune_seed).
+    """
+    if self.install_dir.exists():
+      return
+    archive_path = self.find_ancestor_archive_file()
+    if archive_path is None:
       return
+    print("Seeding {} from ancestor archive".format(self.identifier))
+    self.extract_archive_file(archive_path)
+    manifest.Manifest.create(self.install_dir,
+                             hash_contents=False).save(self.seed_manifest_file)
+
+  def read_installed_paths(self):
+    """Reads the relpaths written by the last install step (None if unknown).
+
+    These are listed in the install_manifest.txt that CMake writes to the
+    build dir, which only counts if it was written after the seed.
+    """
+    if self.build_config is None:
+      return None
+    path = Path(self.build_config.build_dir).joinpath("install_manifest.txt")
+    try:
+      if path.stat().st_mtime < self.seed_manifest_file.stat().st_mtime:
+        return None
+      lines = path.read_text(encoding="UTF-8").splitlines()
+    except OSError:
+      return None
+    install_dir = str(self.install_dir)
+    return set(
+        os.path.relpath(line, install_dir) for line in lines if line.strip())
+
+  def prune_seed(self):
+    """Removes files seeded from an ancestor which the build did not install.
+
+    A seeded file is kept if the build wrote it: Its stat changed, or the
+    install step listed it (CMake skips copying files which are up to date).
+    Returns the number of files removed.
+    """
+    seed_manifest_file = self.seed_manifest_file
+    if not seed_manifest_file.exists():
+      return 0
+    seed_manifest = manifest.Manifest.load(seed_manifest_file)
+    written = set(seed_manifest.verify_stat(self.install_dir))
+    written.update(self.read_installed_paths() or ())
+    stale = [
+        rel_path for rel_path in list(seed_manifest.files) +
+        list(seed_manifest.links) if rel_path not in written
+    ]
+    for rel_path in stale:
+      path = self.install_dir.joinpath(rel_path)
+      path.unlink()
+      # Remove dirs which only held stale files.
+      parent = path.parent
+      while parent != self.install_dir and not any(parent.iterdir()):
+        parent.rmdir()
+        parent = parent.parent
+    if stale:
+      print("Pruned {} files of {} left from the ancestor seed".format(
+          len(stale), self.identifier))
+    seed_manifest_file.unlink()
+    return len(stale)
+
+  def extract_archive_file(self, archive_path):
     install_dir = self.install_dir
     os.makedirs(install_dir.parent, exist_ok=True)
     print("Extracting cache archive file:", archive_path)
     try:
-      subprocess.check_call(
-          ["tar", "xf", str(archive_path), install_dir.name],
-          cwd=str(install_dir.parent))
+      with archive.ArchiveReader(archive_path) as reader:
+        reader.extract(install_dir)
     except:
       if install_dir.exists():
         shutil.rmtree(install_dir)
       raise
+
+  def list_cache_archive(self, patterns=None):
+    """Lists archive members, optionally filtered by path globs."""
+    with archive.ArchiveReader(self.cache_archive_file) as reader:
+      return reader.list(patterns)
+
+  def extract_from_cache_archive(self, dest_dir, patterns):
+    """Extracts the members matching path globs (i.e. 'include/') only."""
+    with archive.ArchiveReader(self.cache_archive_file) as reader:
+      return reader.extract(dest_dir, patterns)
+
+  def verify_cache_archive(self, patterns=None):
+    """Verifies archive member hashes, returning the paths that fail."""
+    with archive.ArchiveReader(self.cache_archive_file) as reader:
+      return reader.verify(patterns)
+
+  def expand_cache_archive_file(self):
+    archive_path = self.cache_archive_file
+    if not archive_path.exists():
+      return
+    self.extract_archive_file(archive_path)
+    # Extraction restores mtimes, so the archived manifest applies as-is.
+    if self.cache_manifest_file.exists():
+      shutil.copyfile(self.cache_manifest_file, self.manifest_file)
     else:
-      self.touch_marker_file()
-      # We touch the archive as a primitive LRU (old items will be expired).
-      archive_path.touch()
+      manifest.Manifest.create(self.install_dir,
+                               hash_contents=False).save(self.manifest_file)
+    self.touch_marker_file()
+    # We touch the archive (and any delta bases it needs) as a primitive LRU
+    # (old items will be expired).
+    with archive.ArchiveReader(archive_path) as reader:
+      chain = reader.chain()
+    for path in chain:
+      Path(path).touch()
+
+  def check_reproducible(self):
+    """Re-archives the install dir and compares to the cached archive.
+
+    Returns a list of differences (empty if bit-identical). Run on a second
+    builder (or after fetching) to prove that stores of this key are
+    reproducible.
+    """
+    archive_path = self.cache_archive_file
+    if not archive_path.exists():
+      return ["No cache archive {}".format(archive_path)]
+    check_path = archive_path.parent.joinpath("." + archive_path.name +
+                                              ".check")
+    with archive.ArchiveReader(archive_path) as reader:
+      base_path = reader.base_path
+    try:
+      archive.create(check_path,
+                     self.install_dir,
+                     base_path=base_path,
+                     mtime_epoch=self.source_date_epoch)
+      return archive.compare(archive_path, check_path)
+    finally:
+      if check_path.exists():
+        check_path.unlink()
 
   def store_install_to_cache(self):
+    self.prune_seed()
+    self.write_manifest_file()
     self.create_cache_archive_file()
-    # TODO: Publish to shared cache.
+    self.write_cache_metadata_file()
+
+  def snapshot_install(self):
+    """Snapshots the install dir, to be published by publish_snapshot.
+
+    The snapshot is made of hardlinks, so is cheap, but shares file contents
+    with the install dir. A (stat only) manifest of it is saved as the
+    manifest of the install, to check that nothing changed it before the
+    archive is done. The snapshot only appears once complete.
+    """
+    self.prune_seed()
+    snapshot_dir = self.snapshot_dir
+    tmp_dir = snapshot_dir.parent.joinpath("." + snapshot_dir.name + ".tmp")
+    for path in (snapshot_dir, tmp_dir):
+      if path.exists():
+        shutil.rmtree(path)
+    os.makedirs(snapshot_dir.parent, exist_ok=True)
+    snapshot_tree(self.install_dir, tmp_dir)
+    # Replace any stale manifest of a previous install (a full one, with
+    # hashes, is written once published).
+    manifest.Manifest.create(tmp_dir,
+                             hash_contents=False).save(self.manifest_file)
+    tmp_dir.rename(snapshot_dir)
+
+  def publish_pending_snapshot(self):
+    """Archives and publishes the snapshot of the install, if there is one.
+
+    Returns whether there was one. Both the publish task and a later lookup
+    (if that task did not run) may try, so this holds a lock.
+    """
+    snapshot_dir = self.snapshot_dir
+    lock_path = snapshot_dir.parent.joinpath("." + self.cache_key + ".lock")
+    os.makedirs(snapshot_dir.parent, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      if not snapshot_dir.exists():
+        return False
+      start_time = time.time()
+      try:
+        self.publish_snapshot(manifest.Manifest.load(self.manifest_file))
+      except:
+        # The install itself is fine, but was not published, so make sure
+        # the next run stores it again.
+        if self.marker_file.exists():
+          self.marker_file.unlink()
+        raise
+    try:
+      build_seconds = self.measure_build_seconds()
+    except:
+      print("Failed to measure the build of {} (ignoring)".format(
+          self.identifier))
+      traceback.print_exc()
+      build_seconds = None
+    self.record_store(bytes=self.get_archive_size(),
+                      build_seconds=build_seconds,
+                      store_seconds=time.time() - start_time)
+    print("Published {} to cache".format(self.identifier))
+    return True
+
+  def publish_snapshot(self, snapshot_manifest):
+    """Archives the snapshot made by snapshot_install, then removes it."""
+    snapshot_dir = self.snapshot_dir
+
+    def check_unchanged():
+      changed = snapshot_manifest.verify_stat(snapshot_dir)
+      if changed:
+        raise RuntimeError(
+            "Install {} changed while publishing ({} files, i.e. {})".format(
+                self.identifier, len(changed), changed[0]))
+
+    try:
+      check_unchanged()
+      self.write_manifest_file(snapshot_dir)
+      self.create_cache_archive_file(snapshot_dir)
+      check_unchanged()
+      self.write_cache_metadata_file()
+    except:
+      # Never leave an archive of a tree which was modified half way.
+      if self.cache_archive_file.exists():
+        self.cache_archive_file.unlink()
+      raise
+    finally:
+      shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+  def _get_archive_chain_names(self, cache_dir):
+    """Gets the names of the archive and its delta bases in a cache dir."""
+    names = []
+    name = self.cache_archive_file.name
+    while name is not None and name not in names:
+      names.append(name)
+      with archive.ArchiveReader(Path(cache_dir).joinpath(name)) as reader:
+        name = reader.base_name
+    return names
+
+  def fetch_from_shared_cache(self):
+    """Copies the archive (and what it needs) from the shared cache dir.
+
+    Returns whether the archive is in the local cache now.
+    """
+    if self.cache_archive_file.exists():
+      return True
+    shared_cache_dir = workqueue.get_shared_cache_dir()
+    if (shared_cache_dir is None or
+        not shared_cache_dir.joinpath(self.cache_archive_file.name).exists()):
+      return False
+    cache_root = get_cache_root()
+    for path in (self.cache_manifest_file, self.cache_metadata_file):
+      shared_path = shared_cache_dir.joinpath(path.name)
+      if shared_path.exists():
+        workqueue.copy_file(shared_path, cache_root)
+    # Bases first, so that the archive is only present once usable.
+    for name in reversed(self._get_archive_chain_names(shared_cache_dir)):
+      workqueue.copy_file(shared_cache_dir.joinpath(name), cache_root)
+    return True
+
+  def publish_to_shared_cache(self):
+    """Publishes the archive to the shared cache dir, completing its job.
+
+    The archive is copied last, as its presence marks the entry complete.
+    """
+    shared_cache_dir = workqueue.get_shared_cache_dir()
+    if shared_cache_dir is None or not self.cache_archive_file.exists():
+      return
+    for path in (self.cache_manifest_file, self.cache_metadata_file):
+      if path.exists():
+        workqueue.copy_file(path, shared_cache_dir)
+    for name in reversed(self._get_archive_chain_names(get_cache_root())):
+      workqueue.copy_file(get_cache_root().joinpath(name), shared_cache_dir)
+    queue = get_work_queue()
+    if queue is not None:
+      # Also ends the lease, which the claiming process stops renewing.
+      queue.complete(self.queue_job_name)
+      print("Published {} to the shared cache".format(self.identifier))
+
+  def share(self):
+    """Publishes to the shared cache dir, if the work queue is enabled."""
+    if not workqueue.is_enabled():
+      return
+    try:
+      self.publish_to_shared_cache()
+    except:
+      print("Error publishing {} to the shared cache (ignoring)".format(
+          self.cache_key))
+      traceback.print_exc()
+
+  def post_to_work_queue(self):
+    """Posts a job to build this (missing) install, if the queue is enabled."""
+    queue = get_work_queue()
+    if queue is None:
+      return
+    if queue.post(self.queue_job_name,
+                  task=self.task_name,
+                  identifier=self.identifier,
+                  cache_key=self.cache_key,
+                  version_hash=self.version_hash):
+      print("Posted {} to the work queue".format(self.queue_job_name))
+
+  def wait_for_queued_build(self):
+    """Waits for a missing install if another builder is building it.
+
+    Returns True once it was published to the shared cache dir (and has been
+    installed from it). Returns False if this process must build it: it
+    claimed the job, the job failed elsewhere or the queue is disabled.
+    A claimed lease is renewed by this process until release_queue_claim.
+    """
+    queue = get_work_queue()
+    if queue is None:
+      return False
+    name = self.queue_job_name
+    waiting_for = None
+    while True:
+      if self.fetch_from_shared_cache():
+        # Replace any partial (or seeded) install.
+        self.clear_install_dir()
+        self.expand_cache_archive_file()
+        if self.install_is_ok():
+          print("Installed {} from the shared cache".format(self.identifier))
+          self._lookup_result = True
+          return True
+        return False
+      job = queue.read_job(name)
+      if job is None:
+        # Completed, but the archive is gone (i.e. pruned).
+        self.post_to_work_queue()
+        continue
+      if queue.is_failed(job):
+        print("Queued build of {} failed ({}): Building locally".format(
+            name, job.get("last_error")))
+        return False
+      if queue.claim(name):
+        workqueue.hold_lease(queue, name)
+        return False
+      lease = queue.read_lease(name)
+      owner = lease["owner"] if lease is not None else None
+      if owner != waiting_for:
+        print("Waiting for {} (being built on {})".format(
+            self.identifier, owner))
+        waiting_for = owner
+      time.sleep(workqueue.get_poll_seconds())
+
+  def release_queue_claim(self):
+    """Ends a lease claimed by wait_for_queued_build in this process.
+
+    If the job was not completed (the build or its publish failed or did
+    not run), the failed attempt is recorded so that others retry it.
+    """
+    queue = get_work_queue()
+    if queue is None:
+      return
+    workqueue.finish_lease(queue, self.queue_job_name, "not published")
 
   def fetch_install_from_cache(self):
-    # TODO: Fetch from shared cache.
+    """Fetches and extracts the install, returning a dict of timings."""
+    start_time = time.time()
+    fetch_seconds = 0.0
+    if workqueue.is_enabled():
+      self.fetch_from_shared_cache()
+      fetch_seconds = time.time() - start_time
+    extract_start_time = time.time()
     self.expand_cache_archive_file()
+    return {
+        "fetch_seconds": fetch_seconds,
+        "extract_seconds": time.time() - extract_start_time,
+    }
+
+  def record_lookup(self, result, **fields):
+    try:
+      get_stats_store().record("lookup",
+                               cache_key=self.cache_key,
+                               identifier=self.identifier,
+                               version_hash=self.version_hash,
+                               result=result,
+                               **fields)
+    except:
+      print("Failed to record cache stats (ignoring)")
+      traceback.print_exc()
+
+  def record_store(self, **fields):
+    try:
+      get_stats_store().record("store",
+                               cache_key=self.cache_key,
+                               identifier=self.identifier,
+                               version_hash=self.version_hash,
+                               **fields)
+    except:
+      print("Failed to record cache stats (ignoring)")
+      traceback.print_exc()
+
+  def get_archive_size(self):
+    archive_path = self.cache_archive_file
+    return archive_path.stat().st_size if archive_path.exists() else None
+
+  def lookup(self):
+    """Ensures the install is present, fetching from the cache if possible.
+
+    Returns whether the install is ok. If not, the caller must build it
+    locally. The result is remembered, so that a prefetch and the later
+    calc_dep of the task share a single lookup.
+    """
+    if self._lookup_result is not None:
+      return self._lookup_result
+
+    # Skip if ok.
+    if self.install_is_ok():
+      print("Not fetching/building {}: Already exists".format(self.identifier))
+      # The mtime of the marker records the last use (see diskgc).
+      self.marker_file.touch()
+      try:
+        # Left over if the publish task of the run that built it did not run
+        # (i.e. it was not selected).
+        if self.publish_pending_snapshot():
+          self.share()
+      except:
+        print("Error publishing {} to cache (ignoring)".format(self.cache_key))
+        traceback.print_exc()
+      self.record_lookup(cachestats.LOOKUP_INSTALLED)
+      self._lookup_result = True
+      return True
+
+    # Try to fetch.
+    print("Fetching {} from cache".format(self.identifier))
+    fetch_stats = {}
+    try:
+      fetch_stats = self.fetch_install_from_cache()
+    except:
+      print("Failed to fetch {} from cache (ignoring)".format(self.cache_key))
+      traceback.print_exc()
+
+    # Branch based on fetched.
+    if self.install_is_ok():
+      # Fetch succeeded. No deps.
+      print("Install is ok. Not building deps.")
+      self.record_lookup(cachestats.LOOKUP_HIT,
+                         bytes=self.get_archive_size(),
+                         **fetch_stats)
+      self._lookup_result = True
+    else:
+      # Fetch did not succeed.
+      print("Could not fetch cached {}: Building locally".format(
+          self.identifier))
+      self.record_lookup(cachestats.LOOKUP_MISS, **fetch_stats)
+      self._miss_time = time.time()
+      try:
+        self.post_to_work_queue()
+      except:
+        print("Failed to post {} to the work queue (ignoring)".format(
+            self.cache_key))
+        traceback.print_exc()
+      self.clear_install_dir()
+      try:
+        self.seed_from_ancestor()
+      except:
+        print("Failed to seed {} from an ancestor (ignoring)".format(
+            self.cache_key))
+        traceback.print_exc()
+        self.clear_install_dir()
+      self._lookup_result = False
+    return self._lookup_result
 
   def yield_tasks(self, *, taskname=None, basename="default"):
     """Yields all tasks to cache and locally build as necessary."""
@@ -167,44 +1153,74 @@ class InstallCache:
         return subtask_name
 
     def fetch_cache():
-      # Skip if ok.
-      if self.install_is_ok():
-        print("Not fetching/building {}: Already exists".format(
-            self.identifier))
-        return
-
-      # Try to fetch.
-      print("Fetching {} from cache".format(self.identifier))
-      try:
-        self.fetch_install_from_cache()
-      except:
-        print("Failed to fetch {} from cache (ignoring)".format(self.cache_key))
-        traceback.print_exc()
-
-      # Branch based on fetched.
-      if self.install_is_ok():
-        # Fetch succeeded. No deps.
-        print("Install is ok. Not building deps.")
+      if self.lookup() or self.wait_for_queued_build():
         return {
             "task_dep": [subtask("install_ok", qualified=True)],
         }
       else:
-        # Fetch did not succeed. Delegate to the install task.
-        print("Could not fetch cached {}: Building locally".format(
-            self.identifier))
+        # Building locally needs the deps, so look them up concurrently now
+        # (instead of one at a time in front of each build). Lookups are
+        # remembered, so the fetch_cache of each dep reuses the result.
+        deps = {d.task_name: d for d in self.deps if d.task_name is not None}
+        if deps:
+          prefetch(deps)
+        # Delegate to the install task.
         return {
             "task_dep": [subtask("store_cache", qualified=True),],
         }
 
     def store_cache():
+      if get_publish_async():
+        try:
+          self.snapshot_install()
+        except:
+          print("Error snapshotting {} (skipping cache)".format(self.cache_key))
+          traceback.print_exc()
+          return
+        # Dependents can use the install right away, while the publish task
+        # archives the snapshot.
+        self.touch_marker_file()
+        return
+      start_time = time.time()
+      try:
+        build_seconds = self.measure_build_seconds()
+      except:
+        print("Failed to measure the build of {} (ignoring)".format(
+            self.identifier))
+        traceback.print_exc()
+        build_seconds = None
       try:
         self.store_install_to_cache()
+        self.record_store(bytes=self.get_archive_size(),
+                          build_seconds=build_seconds,
+                          store_seconds=time.time() - start_time)
       except:
         print("Error installing {} to cache (skipping cache)".format(
             self.cache_key))
         traceback.print_exc()
       else:
         self.touch_marker_file()
+        self.share()
+
+    def plan_publish(fetch_deps):
+      # Only an install built (so stored) by this run is published. Its deps
+      # are published first, so that selecting it publishes all it needed.
+      if subtask("store_cache", qualified=True) not in fetch_deps:
+        return {}
+      return {
+          "task_dep": [subtask("store_cache", qualified=True)] + [
+              d.task_name + ":publish"
+              for d in self.deps
+              if d.task_name is not None
+          ],
+      }
+
+    def publish():
+      if self.publish_pending_snapshot():
+        self.share()
+
+    register_install_cache(
+        basename if taskname is None else taskname + ":" + basename, self)
 
     # Main task that delegates dep calculation to fetch_cache.
     yield {
@@ -219,9 +1235,137 @@ class InstallCache:
     yield {
         "name": subtask("fetch_cache"),
         "actions": [fetch_cache],
+        # Runs at the end of the run (even if it failed) in the process which
+        # ran fetch_cache, so holds any lease it claimed.
+        "teardown": [self.release_queue_claim],
     }
     yield {
         "name": subtask("store_cache"),
         "actions": [store_cache],
         "task_dep": [self.install_task],
     }
+    # Not a dep of the main task, so dependents do not wait for it.
+    yield {
+        "name": subtask("plan_publish"),
+        "actions": [plan_publish],
+        "getargs": {
+            "fetch_deps": (subtask("fetch_cache", qualified=True), "task_dep")
+        },
+    }
+    yield {
+        "name": subtask("publish"),
+        "actions": [publish],
+        "calc_dep": [subtask("plan_publish", qualified=True)],
+    }
+
+
+def register_install_cache(task_name, install_cache):
+  install_cache.task_name = task_name
+  _INSTALL_CACHES[task_name] = install_cache
+
+
+def declare_cache_deps(task_name, cache_task_names):
+  """Declares that a task needs the given cache tasks.
+
+  Returns the list of cache task names, for use as a task_dep.
+  """
+  _CACHE_CONSUMERS[task_name] = list(cache_task_names)
+  return list(cache_task_names)
+
+
+def resolve_install_caches(task_names=()):
+  """Resolves the InstallCaches needed by the given tasks.
+
+  Names may be cache tasks ("llvm:mlir-generic-rtti"), cache task groups
+  ("llvm") or consumers declared with declare_cache_deps. With no names,
+  all registered caches are returned. Returns a dict of {task_name: cache}.
+  """
+  if not task_names:
+    return dict(_INSTALL_CACHES)
+  resolved = dict()
+  pending = list(task_names)
+  seen = set()
+  while pending:
+    name = pending.pop()
+    if name in seen:
+      continue
+    seen.add(name)
+    pending.extend(_CACHE_CONSUMERS.get(name, ()))
+    for cache_name, install_cache in _INSTALL_CACHES.items():
+      if cache_name == name or cache_name.startswith(name + ":"):
+        resolved[cache_name] = install_cache
+  return resolved
+
+
+def get_required_source_dirs(install_caches):
+  """Finds the source dirs needed to provide the given caches.
+
+  Caches which hit need no sources. Those which miss must be built, which
+  needs their own sources (and any others they build with), as well as
+  their deps (which may hit in turn). Versions of sources which are not
+  checked out are taken from the version map, so this can run before
+  checking out. Returns a dict of {source_dir: [identifiers needing it]}.
+  """
+  required = dict()
+  pending = list(install_caches.values())
+  seen = set()
+  while pending:
+    install_cache = pending.pop()
+    if id(install_cache) in seen:
+      continue
+    seen.add(id(install_cache))
+    if install_cache.is_cached_locally():
+      continue
+    source_dirs = [install_cache.source_dir] + install_cache.build_source_dirs
+    if install_cache.build_config is not None:
+      source_dirs.append(install_cache.build_config.source_dir)
+    for source_dir in source_dirs:
+      if source_dir is None:
+        continue
+      identifiers = required.setdefault(Path(source_dir), [])
+      if install_cache.identifier not in identifiers:
+        identifiers.append(install_cache.identifier)
+    pending.extend(install_cache.deps)
+  return required
+
+
+def get_prefetch_jobs():
+  env_value = os.environ.get(PREFETCH_JOBS_ENV_VAR)
+  if env_value:
+    return int(env_value)
+  else:
+    return DEFAULT_PREFETCH_JOBS
+
+
+def prefetch(install_caches, max_workers=None):
+  """Looks up (fetching and extracting) the given caches concurrently.
+
+  Caches which miss must be built locally, which requires their deps, so
+  those are then looked up as well.
+  Returns a dict of {task_name: bool} of whether each install is ok.
+  """
+  if max_workers is None:
+    max_workers = get_prefetch_jobs()
+  results = dict()
+  pending = dict(install_caches)
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    while pending:
+      futures = {
+          task_name: executor.submit(install_cache.lookup)
+          for task_name, install_cache in pending.items()
+      }
+      next_pending = dict()
+      for task_name, future in futures.items():
+        try:
+          results[task_name] = future.result()
+        except:
+          print("Failed to prefetch {} (ignoring)".format(task_name))
+          traceback.print_exc()
+          results[task_name] = False
+        if results[task_name]:
+          continue
+        for dep in pending[task_name].deps:
+          if dep.task_name is not None and dep.task_name not in results:
+            next_pending[dep.task_name] = dep
+      pending = next_pending
+  return results
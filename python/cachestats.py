@@ -0,0 +1,157 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records and summarizes cache lookups.
+
+Events are appended as JSON lines to a stats file, and read from all stats
+files beside it (i.e. one per host in the shared cache dir, see
+cacher.get_stats_store). There are two kinds:
+  lookup: One per cache lookup, with a result of 'hit' (fetched from the
+    cache), 'miss' (must build locally) or 'installed' (already installed,
+    no fetch needed), plus bytes and fetch/extract durations.
+  store: One per local build that was stored to the cache, with the build
+    duration (of the tasks building it, from the task history) and the
+    duration/bytes of storing it.
+
+Summaries are aggregated per cache_key family (i.e. 'llvm-project__<config>'),
+and estimate time saved as hits times the mean recorded build duration.
+"""
+
+import json
+import os
+from pathlib import Path
+import time
+
+LOOKUP_HIT = "hit"
+LOOKUP_MISS = "miss"
+LOOKUP_INSTALLED = "installed"
+
+
+class StatsStore:
+  """Append-only store of cache events.
+
+  Events are recorded to path, and read from all stats files in its dir and
+  in extra_dirs.
+  """
+
+  def __init__(self, path, extra_dirs=()):
+    self.path = Path(path)
+    self.extra_dirs = [Path(d) for d in extra_dirs]
+
+  def record(self, kind, **fields):
+    event = dict(fields)
+    event["kind"] = kind
+    event["time"] = time.time()
+    line = json.dumps(event, sort_keys=True) + "\n"
+    os.makedirs(self.path.parent, exist_ok=True)
+    # Single appends of a short line are atomic enough for concurrent writers.
+    with open(self.path, "at", encoding="UTF-8") as f:
+      f.write(line)
+
+  def get_read_paths(self):
+    paths = set([self.path]) if self.path.exists() else set()
+    for d in [self.path.parent] + self.extra_dirs:
+      if d.is_dir():
+        paths.update(d.glob("*.jsonl"))
+    return sorted(paths)
+
+  def read_events(self):
+    for path in self.get_read_paths():
+      with open(path, "rt", encoding="UTF-8") as f:
+        for line in f:
+          try:
+            yield json.loads(line)
+          except ValueError:
+            # Tolerate a torn trailing line from an interrupted writer.
+            continue
+
+  def summarize(self):
+    """Summarizes events as a dict of {cache_key: summary dict}."""
+    families = dict()
+
+    def family(cache_key):
+      if cache_key not in families:
+        families[cache_key] = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "installed": 0,
+            "bytes_fetched": 0,
+            "bytes_stored": 0,
+            "fetch_seconds": 0.0,
+            "extract_seconds": 0.0,
+            "store_seconds": 0.0,
+            "builds": 0,
+            "build_seconds": 0.0,
+        }
+      return families[cache_key]
+
+    for event in self.read_events():
+      f = family(event.get("cache_key"))
+      if event["kind"] == "lookup":
+        f["lookups"] += 1
+        result = event.get("result")
+        if result == LOOKUP_HIT:
+          f["hits"] += 1
+          f["bytes_fetched"] += event.get("bytes") or 0
+        elif result == LOOKUP_MISS:
+          f["misses"] += 1
+        elif result == LOOKUP_INSTALLED:
+          f["installed"] += 1
+        f["fetch_seconds"] += event.get("fetch_seconds") or 0.0
+        f["extract_seconds"] += event.get("extract_seconds") or 0.0
+      elif event["kind"] == "store":
+        f["bytes_stored"] += event.get("bytes") or 0
+        f["store_seconds"] += event.get("store_seconds") or 0.0
+        if event.get("build_seconds") is not None:
+          f["builds"] += 1
+          f["build_seconds"] += event["build_seconds"]
+
+    for f in families.values():
+      cache_lookups = f["hits"] + f["misses"]
+      f["hit_rate"] = (f["hits"] / cache_lookups) if cache_lookups else None
+      f["mean_build_seconds"] = (f["build_seconds"] /
+                                 f["builds"]) if f["builds"] else None
+      if f["mean_build_seconds"] is not None:
+        f["estimated_seconds_saved"] = (f["hits"] * f["mean_build_seconds"] -
+                                        f["fetch_seconds"] -
+                                        f["extract_seconds"])
+      else:
+        f["estimated_seconds_saved"] = None
+    return families
+
+
+def format_summary_text(summary):
+  """Formats a summary from StatsStore.summarize() for humans."""
+
+  def fmt_bytes(n):
+    return "{:.1f}MiB".format(n / (1024 * 1024))
+
+  def fmt_seconds(s):
+    return "n/a" if s is None else "{:.0f}s".format(s)
+
+  lines = []
+  for cache_key in sorted(summary):
+    f = summary[cache_key]
+    hit_rate = ("n/a"
+                if f["hit_rate"] is None else "{:.0%}".format(f["hit_rate"]))
+    lines.append(cache_key)
+    lines.append("  lookups: {} (hits {}, misses {}, installed {}), "
+                 "hit rate {}".format(f["lookups"], f["hits"], f["misses"],
+                                      f["installed"], hit_rate))
+    lines.append("  bytes fetched {}, stored {}".format(
+        fmt_bytes(f["bytes_fetched"]), fmt_bytes(f["bytes_stored"])))
+    lines.append("  mean build {}, estimated saved {}".format(
+        fmt_seconds(f["mean_build_seconds"]),
+        fmt_seconds(f["estimated_seconds_saved"])))
+  return "\n".join(lines)
@@ -0,0 +1,433 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks out the deps of module_deps.json concurrently from a local mirror.
+
+Deps (and their submodules, recursively) are materialized as independent
+jobs on a bounded pool, so that i.e. the many submodules of IREE are cloned
+while llvm-project is still checking out:
+  - Revisions come from the version map (VERSION_MAP.txt) if pinned there,
+    else from module_deps.json.
+  - Repos are cloned with '--shared' from a bare repo in the mirror dir
+    (default ~/.mrtmirror), so no objects are copied. The mirror is found
+    at <mirror>/<host>/<path>.git (i.e. github.com/llvm/llvm-project.git)
+    or <mirror>/<name>.git. Without a mirror, the upstream url is cloned.
+  - Revisions missing from the mirror are fetched from upstream.
+  - Existing checkouts are updated in place.
+  - Deps with a sparse checkout profile (see get_sparse_profiles) only
+    materialize the dirs of their cone, and submodules outside of it are
+    skipped.
+The time taken per repo is reported (and optionally written as JSON).
+
+Point --module-deps, --version-map and --mirror at local bare repos to try
+it without network access.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+import os
+from pathlib import Path
+import re
+import subprocess
+import sys
+import time
+import traceback
+from urllib.parse import urlparse
+
+import versionmap
+
+MIRROR_ENV_VAR = "MRT_MIRROR_DIR"
+DEFAULT_MIRROR_DIR = Path.home().joinpath(".mrtmirror")
+JOBS_ENV_VAR = "MRT_CHECKOUT_JOBS"
+DEFAULT_JOBS = 8
+MODULE_DEPS_FILE_NAME = "module_deps.json"
+# Set to "0" to check out whole trees.
+SPARSE_ENV_VAR = "MRT_SPARSE_CHECKOUT"
+
+
+class CheckoutError(Exception):
+  pass
+
+
+class CheckoutJob:
+  """A repo to materialize at a revision (a dep or a submodule of one)."""
+
+  def __init__(self, *, dest_dir, url, rev, label, sparse_dirs=None):
+    self.dest_dir = Path(dest_dir)
+    self.url = url
+    self.rev = rev
+    self.label = label
+    # Dirs of a cone mode sparse checkout (None for the whole tree).
+    self.sparse_dirs = sparse_dirs
+
+  def __repr__(self):
+    return "CheckoutJob({} {}@{})".format(self.label, self.url, self.rev)
+
+
+def get_mirror_root():
+  env_value = os.environ.get(MIRROR_ENV_VAR)
+  if env_value:
+    return Path(env_value)
+  else:
+    return DEFAULT_MIRROR_DIR
+
+
+def get_jobs():
+  env_value = os.environ.get(JOBS_ENV_VAR)
+  if env_value:
+    return int(env_value)
+  else:
+    return DEFAULT_JOBS
+
+
+def get_sparse_profiles():
+  """Gets the sparse checkout dirs of deps, as {dep path: [dirs]}.
+
+  Only llvm-project has a profile: the projects enabled by the configs in
+  llvm-configs/ (see llvm_tasks.get_sparse_checkout_dirs).
+  """
+  if os.environ.get(SPARSE_ENV_VAR) == "0":
+    return {}
+  # Imported here: llvm_tasks pulls in the build modules, which the checkout
+  # itself does not need.
+  import builder
+  import llvm_tasks
+  dirs = llvm_tasks.get_sparse_checkout_dirs()
+  if dirs is None:
+    return {}
+  path = llvm_tasks.get_source_dir().relative_to(builder.TOP_DIR).as_posix()
+  return {path: dirs}
+
+
+def read_deps(top_dir,
+              module_deps_file=None,
+              version_map=None,
+              sparse_profiles=None):
+  """Reads the top level CheckoutJobs from module_deps.json.
+
+  Revisions pinned in the version map (a dict of {name: rev}) take
+  precedence. sparse_profiles is a dict of {dep path: [dirs]}.
+  """
+  top_dir = Path(top_dir)
+  if module_deps_file is None:
+    module_deps_file = top_dir.joinpath(MODULE_DEPS_FILE_NAME)
+  if version_map is None:
+    version_map = dict()
+  if sparse_profiles is None:
+    sparse_profiles = dict()
+  with open(module_deps_file, "rt") as f:
+    module_deps = json.load(f)
+  jobs = []
+  for dep in module_deps["deps"]:
+    path = dep["path"]
+    rev = version_map.get(path, version_map.get(Path(path).name))
+    if rev is None:
+      rev = dep.get("version", "HEAD")
+    jobs.append(
+        CheckoutJob(dest_dir=top_dir.joinpath(path),
+                    url=dep["url"],
+                    rev=rev,
+                    label=path,
+                    sparse_dirs=sparse_profiles.get(path)))
+  return jobs
+
+
+def resolve_url(base_url, url):
+  """Resolves a (possibly relative, i.e. '../foo.git') submodule url."""
+  if not url.startswith("./") and not url.startswith("../"):
+    return url
+  base = base_url.rstrip("/")
+  for part in url.split("/"):
+    if part == "..":
+      base = base.rsplit("/", 1)[0]
+    elif part and part != ".":
+      base = base + "/" + part
+  return base
+
+
+def find_mirror_dir(mirror_root, url):
+  """Finds the bare repo mirroring a url (None if not mirrored)."""
+  if mirror_root is None:
+    return None
+  mirror_root = Path(mirror_root)
+  parsed = urlparse(url)
+  if parsed.scheme and parsed.netloc:
+    host = parsed.netloc.rsplit("@", 1)[-1]
+    path = parsed.path
+  else:
+    # scp-like (git@github.com:org/repo.git) or a local path.
+    m = re.match(r"^(?:[^@/]+@)?([^:/]+):(.+)$", url)
+    host, path = (m.group(1), m.group(2)) if m else ("", url)
+  path = path.strip("/")
+  if not path.endswith(".git"):
+    path += ".git"
+  candidates = [
+      mirror_root.joinpath(host, path),
+      mirror_root.joinpath(os.path.basename(path)),
+  ]
+  for candidate in candidates:
+    if candidate.is_dir():
+      return candidate
+  return None
+
+
+def _git(args, cwd):
+  """Runs git, returning its stripped stdout. Raises CheckoutError."""
+  result = subprocess.run(["git"] + list(args),
+                          cwd=str(cwd),
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+  if result.returncode != 0:
+    raise CheckoutError("git {} failed in {}:\n{}".format(
+        " ".join(args), cwd,
+        result.stderr.decode("UTF-8", errors="replace").strip()))
+  return result.stdout.decode("UTF-8").strip()
+
+
+def _resolve_commit(job):
+  """Resolves the job's revision in its repo, fetching it if missing."""
+  try:
+    return _git(["rev-parse", "--verify", "--quiet", job.rev + "^{commit}"],
+                cwd=job.dest_dir)
+  except CheckoutError:
+    pass
+  # Not in the mirror (or a moved branch): fetch from upstream.
+  _git(["fetch", "--quiet", job.url, job.rev], cwd=job.dest_dir)
+  return _git(["rev-parse", "--verify", "FETCH_HEAD^{commit}"],
+              cwd=job.dest_dir)
+
+
+def _is_in_cone(path, sparse_dirs):
+  if sparse_dirs is None:
+    return True
+  return any(path == d or path.startswith(d + "/") for d in sparse_dirs)
+
+
+def list_submodules(repo_dir, url, sparse_dirs=None):
+  """Lists CheckoutJobs for the submodules of a checked out repo.
+
+  Submodules outside of the sparse checkout dirs (if any) are skipped.
+  """
+  repo_dir = Path(repo_dir)
+  if not repo_dir.joinpath(".gitmodules").exists():
+    return []
+  try:
+    config = _git([
+        "config", "-f", ".gitmodules", "--get-regexp",
+        r"^submodule\..*\.(path|url)$"
+    ],
+                  cwd=repo_dir)
+  except CheckoutError:
+    return []
+  modules = dict()
+  for line in config.splitlines():
+    key, value = line.split(" ", 1)
+    name, attr = key[len("submodule."):].rsplit(".", 1)
+    modules.setdefault(name, dict())[attr] = value
+  # Commits recorded in the superproject (gitlinks have mode 160000).
+  gitlinks = dict()
+  for line in _git(["ls-files", "--stage"], cwd=repo_dir).splitlines():
+    if line.startswith("160000 "):
+      info, path = line.split("\t", 1)
+      gitlinks[path] = info.split()[1]
+  jobs = []
+  for name, module in sorted(modules.items()):
+    path = module.get("path")
+    if path not in gitlinks or "url" not in module:
+      continue
+    if not _is_in_cone(path, sparse_dirs):
+      continue
+    jobs.append(
+        CheckoutJob(dest_dir=repo_dir.joinpath(path),
+                    url=resolve_url(url, module["url"]),
+                    rev=gitlinks[path],
+                    label=name))
+  return jobs
+
+
+def materialize(job, mirror_root=None):
+  """Clones (or updates) a repo and checks out its revision.
+
+  Returns CheckoutJobs for its submodules, which are then initialized in
+  the superproject.
+  """
+  dest_dir = job.dest_dir
+  if not dest_dir.joinpath(".git").exists():
+    mirror_dir = find_mirror_dir(mirror_root, job.url)
+    os.makedirs(dest_dir.parent, exist_ok=True)
+    if mirror_dir is not None:
+      # Borrow the objects of the mirror (via alternates) instead of copying.
+      _git([
+          "clone", "--quiet", "--no-checkout", "--shared",
+          str(mirror_dir),
+          str(dest_dir)
+      ],
+           cwd=dest_dir.parent)
+      _git(["remote", "set-url", "origin", job.url], cwd=dest_dir)
+    else:
+      _git(["clone", "--quiet", "--no-checkout", job.url,
+            str(dest_dir)],
+           cwd=dest_dir.parent)
+  if job.sparse_dirs is not None:
+    # Set before checking out, so that other dirs are never written.
+    _git(["sparse-checkout", "init", "--cone"], cwd=dest_dir)
+    _git(["sparse-checkout", "set"] + list(job.sparse_dirs), cwd=dest_dir)
+  commit = _resolve_commit(job)
+  _git(["checkout", "--quiet", "--force", "--detach", commit], cwd=dest_dir)
+  submodules = list_submodules(dest_dir, job.url, job.sparse_dirs)
+  if submodules:
+    # Registers the submodules, so that git treats the nested clones as such.
+    _git(["submodule", "init", "--quiet"], cwd=dest_dir)
+  for submodule in submodules:
+    submodule.label = "{}/{}".format(
+        job.label,
+        submodule.dest_dir.relative_to(dest_dir).as_posix())
+  return submodules
+
+
+def checkout_all(jobs, *, mirror_root=None, max_workers=None):
+  """Materializes jobs (and their submodules) concurrently.
+
+  Returns a dict of {label: seconds} of the jobs which succeeded. Raises
+  CheckoutError (after all other jobs finish) if any failed.
+  """
+  if max_workers is None:
+    max_workers = get_jobs()
+  timings = dict()
+  failures = []
+
+  def run(job):
+    start_time = time.time()
+    submodules = materialize(job, mirror_root)
+    return submodules, time.time() - start_time
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    pending = {executor.submit(run, job): job for job in jobs}
+    while pending:
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        job = pending.pop(future)
+        try:
+          submodules, seconds = future.result()
+        except:
+          print("Failed to check out {}:".format(job.label))
+          traceback.print_exc()
+          failures.append(job.label)
+          continue
+        timings[job.label] = seconds
+        print("Checked out {} ({:.1f}s)".format(job.label, seconds))
+        for submodule in submodules:
+          pending[executor.submit(run, submodule)] = submodule
+  if failures:
+    raise CheckoutError("Failed to check out: {}".format(", ".join(failures)))
+  return timings
+
+
+def format_status(top_dir, jobs):
+  """Formats the checked out commit of each job (as 'path commit' lines)."""
+  lines = []
+  for job in jobs:
+    try:
+      commit = _git(["rev-parse", "HEAD"], cwd=job.dest_dir)
+    except CheckoutError:
+      commit = "(missing)"
+    lines.append("{} {}".format(
+        job.dest_dir.relative_to(top_dir).as_posix(), commit))
+  return "\n".join(lines)
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="checkout",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--top-dir",
+                      help="Directory that dep paths are relative to",
+                      type=str,
+                      default=".")
+  parser.add_argument("--module-deps",
+                      help="module_deps.json (default in --top-dir)",
+                      type=str)
+  parser.add_argument("--version-map",
+                      help="Version map (default VERSION_MAP.txt if present)",
+                      type=str)
+  parser.add_argument("--mirror",
+                      help="Local mirror dir of bare repos",
+                      type=str,
+                      default=str(get_mirror_root()))
+  parser.add_argument("--jobs",
+                      help="Maximum concurrent repo checkouts",
+                      type=int,
+                      default=get_jobs())
+  parser.add_argument("--timings-file",
+                      help="File to write per repo timings to (JSON)",
+                      type=str)
+  parser.add_argument("--status-file",
+                      help="File to write the checked out commits to",
+                      type=str)
+  parser.add_argument("--no-sparse",
+                      help="Check out whole trees (no sparse profiles)",
+                      action="store_true")
+  parser.add_argument("paths",
+                      help="Dep paths to check out (default all)",
+                      nargs="*")
+  return parser
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  top_dir = Path(parser.top_dir).resolve()
+  version_map_file = (Path(parser.version_map) if parser.version_map else
+                      top_dir.joinpath(versionmap.VERSION_MAP_FILE_NAME))
+  version_map = dict()
+  if version_map_file.exists():
+    version_map = versionmap.parse_version_map(
+        version_map_file.read_text(encoding="UTF-8"))
+  sparse_profiles = {} if parser.no_sparse else get_sparse_profiles()
+  for path, dirs in sorted(sparse_profiles.items()):
+    print("Sparse checkout of {}: {}".format(path, " ".join(dirs)))
+  jobs = read_deps(top_dir, parser.module_deps, version_map, sparse_profiles)
+  if parser.paths:
+    paths = set(p.rstrip("/") for p in parser.paths)
+    jobs = [job for job in jobs if job.label in paths]
+  mirror_root = Path(parser.mirror) if parser.mirror else None
+
+  start_time = time.time()
+  try:
+    timings = checkout_all(jobs,
+                           mirror_root=mirror_root,
+                           max_workers=parser.jobs)
+  except CheckoutError as e:
+    print(e)
+    return 1
+  print("Checked out {} repos in {:.1f}s. Slowest:".format(
+      len(timings),
+      time.time() - start_time))
+  for label, seconds in sorted(timings.items(), key=lambda t: -t[1])[:10]:
+    print("  {:8.1f}s {}".format(seconds, label))
+  if parser.timings_file:
+    with open(parser.timings_file, "wt") as f:
+      json.dump(timings, f, indent=2, sort_keys=True)
+  status = format_status(top_dir, jobs)
+  print(status)
+  if parser.status_file:
+    with open(parser.status_file, "wt") as f:
+      f.write(status + "\n")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -12,11 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+
 import builder
 import cacher
+import cachestats
+import checkout
+import diskgc
+import planner
+import versionmap
+import workqueue
 
 __all__ = [
     "task_envinfo",
+    "task_cache_stats",
+    "task_cache_prefetch",
+    "task_cache_check_reproducible",
+    "task_cache_plan_checkout",
+    "task_plan",
+    "task_gc",
+    "task_cache_worker",
+    "task_checkout_deps",
     "task_pybind11",
     "task_build_pybind11",
 ]
@@ -28,6 +49,7 @@ def task_envinfo():
   def print_envinfo():
     print("BUILD_ROOT:", builder.get_build_root())
     print("INSTALL_ROOT:", builder.get_install_root())
+    print("RAM_BUILD_ROOT:", builder.get_ram_build_root())
 
   return {
       "actions": [print_envinfo],
@@ -36,20 +58,428 @@ def task_envinfo():
   }
 
 
+def task_cache_stats():
+  """Reports cache hit rate, bytes moved and build time saved per cache key.
+
+  Use '--format json' (optionally with '--output FILE') for machine-readable
+  output.
+  """
+
+  def report(output_format, output):
+    summary = cacher.get_stats_store().summarize()
+    if output_format == "json":
+      text = json.dumps(summary, indent=2, sort_keys=True)
+    else:
+      text = cachestats.format_summary_text(summary)
+    if output:
+      with open(output, "wt", encoding="UTF-8") as f:
+        f.write(text + "\n")
+    else:
+      print(text)
+
+  return {
+      "actions": [report],
+      "params": [
+          {
+              "name": "output_format",
+              "long": "format",
+              "type": str,
+              "default": "text",
+              "choices": (("text", ""), ("json", "")),
+              "help": "Output format",
+          },
+          {
+              "name": "output",
+              "long": "output",
+              "type": str,
+              "default": "",
+              "help": "File to write to (default stdout)",
+          },
+      ],
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_cache_prefetch():
+  """Concurrently fetches all cached installs needed by the given tasks.
+
+  Builds already do this for the deps of an install which misses (in the
+  same process, so each is looked up once), so this is only needed to
+  populate a cache dir without building (i.e. 'doit cache_prefetch
+  npcomp_default'). Running it in front of a build in a separate doit
+  invocation looks everything up twice. With no arguments, all cached
+  installs are prefetched. The number of concurrent fetches is bounded by
+  --jobs (or $MRT_PREFETCH_JOBS).
+  """
+
+  def prefetch(jobs, pos):
+    install_caches = cacher.resolve_install_caches(pos)
+    print("Prefetching:", ", ".join(sorted(install_caches)))
+    results = cacher.prefetch(install_caches, max_workers=jobs or None)
+    for task_name in sorted(results):
+      print("  {}: {}".format(task_name,
+                              "ok" if results[task_name] else "must build"))
+
+  return {
+      "actions": [prefetch],
+      "params": [{
+          "name": "jobs",
+          "long": "jobs",
+          "type": int,
+          "default": 0,
+          "help": "Maximum concurrent fetches",
+      }],
+      "pos_arg": "pos",
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_cache_check_reproducible():
+  """Checks that installs re-archive bit-identically to the cached archives.
+
+  Running this on a builder that independently built (or fetched) an install
+  proves that two stores of the same key produce identical bytes. Takes the
+  same arguments as cache_prefetch. Fails if any archive differs.
+  """
+
+  def check(pos):
+    install_caches = cacher.resolve_install_caches(pos)
+    ok = True
+    for task_name in sorted(install_caches):
+      install_cache = install_caches[task_name]
+      if not install_cache.install_is_ok():
+        print("  {}: not installed (skipping)".format(task_name))
+        continue
+      differences = install_cache.check_reproducible()
+      if differences:
+        ok = False
+        print("  {}: DIFFERENT".format(task_name))
+        for difference in differences:
+          print("    {}".format(difference))
+      else:
+        print("  {}: identical".format(task_name))
+    return ok
+
+  return {
+      "actions": [check],
+      "pos_arg": "pos",
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_cache_plan_checkout():
+  """Plans which source dirs must be checked out for the given tasks.
+
+  Takes the same arguments as cache_prefetch. Source dirs are only needed
+  to build installs which are not cached, and cache keys of clean checkouts
+  are derived from VERSION_MAP.txt, so this can run before checking out.
+  Writes the required dep paths, one per line, to --output (i.e. for
+  step_checkout_version_map.sh).
+  """
+
+  def plan(output, pos):
+    install_caches = cacher.resolve_install_caches(pos)
+    for task_name in sorted(install_caches):
+      print("  {}: {}".format(
+          task_name, "cached"
+          if install_caches[task_name].is_cached_locally() else "must build"))
+    required = cacher.get_required_source_dirs(install_caches)
+    lines = []
+    for source_dir in sorted(required):
+      print("Checkout needed: {} (for {})".format(
+          source_dir, ", ".join(required[source_dir])))
+      try:
+        lines.append(source_dir.relative_to(builder.TOP_DIR).as_posix())
+      except ValueError:
+        lines.append(str(source_dir))
+    if not required:
+      print("No checkout needed")
+    if output:
+      with open(output, "wt", encoding="UTF-8") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+  return {
+      "actions": [plan],
+      "params": [{
+          "name": "output",
+          "long": "output",
+          "type": str,
+          "default": "",
+          "help": "File to write the required dep paths to",
+      }],
+      "pos_arg": "pos",
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_plan():
+  """Estimates the cost of providing the installs needed by the given tasks.
+
+  Takes the same arguments as cache_prefetch. Resolves each install as
+  installed, in the local or shared cache, or to be built, and prints the
+  bytes to fetch/extract, the build time (from recorded history), the
+  critical path and the total cost. Nothing is fetched or built (see
+  planner.py). Use '--format json' for machine-readable output.
+  """
+
+  def plan(output_format, output, pos):
+    result = planner.make_plan(cacher.resolve_install_caches(pos))
+    if output_format == "json":
+      text = json.dumps(result, indent=2, sort_keys=True)
+    else:
+      text = planner.format_plan_text(result)
+    if output:
+      with open(output, "wt", encoding="UTF-8") as f:
+        f.write(text + "\n")
+    else:
+      print(text)
+
+  return {
+      "actions": [plan],
+      "params": [
+          {
+              "name": "output_format",
+              "long": "format",
+              "type": str,
+              "default": "text",
+              "choices": (("text", ""), ("json", "")),
+              "help": "Output format",
+          },
+          {
+              "name": "output",
+              "long": "output",
+              "type": str,
+              "default": "",
+              "help": "File to write to (default stdout)",
+          },
+      ],
+      "pos_arg": "pos",
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_gc():
+  """Reclaims build and install trees under a disk budget.
+
+  Removes trees of identifiers no longer defined (i.e. LLVM configs removed
+  from llvm-configs/) and installs of older versions, then the least
+  recently used trees while over --budget-gb (or $MRT_DISK_BUDGET_GB). Trees
+  used within --min-age-hours are kept. See diskgc.py. Use '--dry-run' to
+  only print what would be removed.
+  """
+
+  def gc(budget_gb, min_age_hours, dry_run):
+    install_caches = {
+        install_cache.identifier: install_cache
+        for install_cache in cacher.resolve_install_caches().values()
+    }
+    budget_bytes = (int(budget_gb * 1024**3)
+                    if budget_gb else diskgc.get_disk_budget_bytes())
+    diskgc.collect(install_caches,
+                   budget_bytes=budget_bytes,
+                   min_age_seconds=min_age_hours * 3600,
+                   dry_run=dry_run)
+
+  return {
+      "actions": [gc],
+      "params": [
+          {
+              "name": "budget_gb",
+              "long": "budget-gb",
+              "type": float,
+              "default": 0.0,
+              "help": "Disk budget of the build and install trees in GiB",
+          },
+          {
+              "name": "min_age_hours",
+              "long": "min-age-hours",
+              "type": float,
+              "default": diskgc.DEFAULT_MIN_AGE_HOURS,
+              "help": "Keep trees used within this many hours",
+          },
+          {
+              "name": "dry_run",
+              "long": "dry-run",
+              "type": bool,
+              "default": False,
+              "help": "Only print what would be removed",
+          },
+      ],
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_cache_worker():
+  """Builds installs posted to the shared work queue by other builders.
+
+  Requires MRT_CACHE_QUEUE=1 and MRT_SHARED_CACHE_DIR (see workqueue.py).
+  Claims jobs whose version this checkout builds, runs their cache task in a
+  child doit run and publishes the result to the shared cache dir. Exits
+  after --max-jobs jobs or when idle for --idle-exit seconds (0 for never).
+  """
+
+  def work(idle_exit, max_jobs):
+    queue = cacher.get_work_queue()
+    if queue is None:
+      print("The work queue is disabled (set {}=1 and {})".format(
+          workqueue.QUEUE_ENV_VAR, workqueue.SHARED_CACHE_DIR_ENV_VAR))
+      return False
+    install_caches = cacher.resolve_install_caches()
+    by_job_name = {
+        install_cache.queue_job_name: (task_name, install_cache)
+        for task_name, install_cache in install_caches.items()
+    }
+    print("Worker {} serving {} cache tasks".format(queue.owner,
+                                                    len(by_job_name)))
+    env = dict(os.environ)
+    env[workqueue.OWNER_ENV_VAR] = queue.owner
+    idle_since = time.time()
+    done = 0
+    while not max_jobs or done < max_jobs:
+      claimed = None
+      for name in queue.list_jobs():
+        job = queue.read_job(name)
+        if (name not in by_job_name or job is None or queue.is_failed(job) or
+            queue.read_lease(name) is not None):
+          continue
+        if queue.claim(name):
+          claimed = name
+          break
+      if claimed is None:
+        if idle_exit and time.time() - idle_since > idle_exit:
+          print("Idle for {}s: Exiting".format(idle_exit))
+          break
+        time.sleep(workqueue.get_poll_seconds())
+        continue
+
+      task_name, install_cache = by_job_name[claimed]
+      print("Building {} ({})".format(claimed, task_name))
+      workqueue.hold_lease(queue, claimed)
+      try:
+        if install_cache.cache_archive_file.exists():
+          # Built here before, but not published.
+          install_cache.publish_to_shared_cache()
+        else:
+          # A separate dep file, as this doit run holds the main one.
+          subprocess.check_call([
+              sys.executable, "-m", "doit", "--db-file", ".doit_worker.db",
+              task_name
+          ],
+                                cwd=str(builder.TOP_DIR),
+                                env=env)
+        if queue.read_job(claimed) is not None:
+          queue.fail(claimed, "not published")
+      except:
+        print("Failed to build {} (ignoring)".format(claimed))
+        traceback.print_exc()
+        queue.fail(claimed, "build failed")
+      finally:
+        workqueue.drop_lease(queue, claimed)
+      done += 1
+      idle_since = time.time()
+    return True
+
+  return {
+      "actions": [work],
+      "params": [
+          {
+              "name": "idle_exit",
+              "long": "idle-exit",
+              "type": int,
+              "default": 0,
+              "help": "Exit after this many seconds without jobs",
+          },
+          {
+              "name": "max_jobs",
+              "long": "max-jobs",
+              "type": int,
+              "default": 0,
+              "help": "Exit after this many jobs",
+          },
+      ],
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+def task_checkout_deps():
+  """Checks out the deps of module_deps.json concurrently.
+
+  Revisions pinned in VERSION_MAP.txt are used, from the local mirror
+  ($MRT_MIRROR_DIR, default ~/.mrtmirror) where possible. Takes optional dep
+  paths (i.e. 'external/llvm-project'), defaulting to all. llvm-project is
+  a sparse checkout of what llvm-configs/ build. See checkout.py.
+  """
+
+  def checkout_deps(jobs, pos):
+    deps = checkout.read_deps(builder.TOP_DIR,
+                              version_map=versionmap.load_version_map(),
+                              sparse_profiles=checkout.get_sparse_profiles())
+    if pos:
+      deps = [dep for dep in deps if dep.label in pos]
+    timings = checkout.checkout_all(deps,
+                                    mirror_root=checkout.get_mirror_root(),
+                                    max_workers=jobs or None)
+    for label, seconds in sorted(timings.items(), key=lambda t: -t[1]):
+      print("  {:8.1f}s {}".format(seconds, label))
+
+  return {
+      "actions": [checkout_deps],
+      "params": [{
+          "name": "jobs",
+          "long": "jobs",
+          "type": int,
+          "default": 0,
+          "help": "Maximum concurrent repo checkouts",
+      }],
+      "pos_arg": "pos",
+      "uptodate": [False],
+      "verbosity": 2,
+  }
+
+
+_PYBIND11_INSTALL_CACHE = None
+
+
+def get_pybind11_source_dir():
+  return builder.TOP_DIR.joinpath("external/pybind11")
+
+
+def get_pybind11_build_config():
+  return builder.CMakeBuildConfig(
+      identifier="pybind11",
+      source_dir=get_pybind11_source_dir(),
+      json_dict={"canonical_cmake_args": ["-DPYBIND11_TEST=OFF"]})
+
+
+def get_pybind11_install_cache():
+  """Gets the (shared) InstallCache for pybind11."""
+  global _PYBIND11_INSTALL_CACHE
+  if _PYBIND11_INSTALL_CACHE is None:
+    _PYBIND11_INSTALL_CACHE = cacher.InstallCache(
+        identifier="pybind11",
+        cache_key="pybind11",
+        install_task="build_pybind11:install",
+        version_data_lambda=lambda: cacher.read_git_state(
+            get_pybind11_source_dir()),
+        source_dir=get_pybind11_source_dir(),
+        build_config=get_pybind11_build_config())
+  return _PYBIND11_INSTALL_CACHE
+
+
 def task_pybind11():
   """Installs a cached pybind11 or builds locally."""
-  ic = cacher.InstallCache(
-      identifier="pybind11",
-      cache_key="pybind11",
-      install_task="build_pybind11:install",
-      version_data_lambda=lambda: cacher.read_git_state("external/pybind11"))
+  ic = get_pybind11_install_cache()
   yield ic.yield_tasks(taskname="pybind11")
 
 
 def task_build_pybind11():
   """Builds and Installs pybind11."""
-  bc = builder.CMakeBuildConfig(
-      identifier="pybind11",
-      source_dir=builder.TOP_DIR.joinpath("external/pybind11"),
-      json_dict={"canonical_cmake_args": ["-DPYBIND11_TEST=OFF"]})
+  bc = get_pybind11_build_config()
   yield bc.yield_tasks(taskname="build_pybind11", install_target="install")
@@ -0,0 +1,247 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reclaims build and install trees under a disk budget.
+
+Trees are the per-identifier dirs under the build and install roots (i.e.
+build/llvm-project/<config>, build/iree_tf_bazel, install/pybind11). For
+each, the size and last use are taken from what is already recorded:
+  build: The build size history, which records the size after every build
+    (see builder.record_build_size) and the use when a build starts (see
+    builder.mark_build_dir_in_use), else the tree itself.
+  install: The manifest (sizes) and the mtime of the marker file, which is
+    touched whenever a lookup finds the install in place.
+
+Trees used within the minimum age (i.e. incremental build dirs being iterated
+on) and build dirs locked by a running build are hot and never reclaimed. Others
+are reclaimed in order:
+  1. Orphans: trees of identifiers which are no longer defined (i.e. LLVM
+     configs removed from llvm-configs/).
+  2. Stale installs: installs of an older version than is now needed (or
+     never completed), which would be replaced anyway.
+  3. While over the budget, the least recently used trees.
+Build dirs in RAM (see builder.prepare_build_dir) use no disk, so do not
+count against the budget (but are reclaimed if orphaned).
+"""
+
+import json
+import os
+from pathlib import Path
+import time
+
+import builder
+
+DISK_BUDGET_ENV_VAR = "MRT_DISK_BUDGET_GB"
+DEFAULT_MIN_AGE_HOURS = 2.0
+
+KIND_BUILD = "build"
+KIND_INSTALL = "install"
+
+REASON_ORPHANED = "orphaned"
+REASON_STALE = "stale"
+REASON_BUDGET = "over budget"
+
+
+def get_disk_budget_bytes():
+  """Gets the disk budget in bytes (None if unlimited)."""
+  env_value = os.environ.get(DISK_BUDGET_ENV_VAR)
+  if env_value:
+    return int(float(env_value) * 1024**3)
+  return None
+
+
+def get_groups(defined_identifiers):
+  """Gets the top-level dirs holding a tree per child (i.e. llvm-project)."""
+  identifiers = list(defined_identifiers) + list(builder.read_build_sizes())
+  return set(i.split("/")[0] for i in identifiers if "/" in i)
+
+
+class Tree:
+  """A build or install tree of an identifier."""
+
+  def __init__(self, kind, identifier, path):
+    self.kind = kind
+    self.identifier = identifier
+    self.path = Path(path)
+    self.size_bytes = 0
+    self.last_used = 0.0
+    self.in_use = False
+    # Build dirs in RAM are symlinks from the build root.
+    self.in_ram = self.path.is_symlink()
+
+  def __repr__(self):
+    return "Tree({}, {})".format(self.kind, self.identifier)
+
+  @property
+  def marker_file(self):
+    return self.path.parent.joinpath(".installed_" + self.path.name)
+
+  @property
+  def manifest_file(self):
+    return self.path.parent.joinpath(".manifest_" + self.path.name + ".json")
+
+
+def find_trees(root_dir, kind, groups):
+  """Finds the trees under a root.
+
+  Top-level dirs named in groups (i.e. 'llvm-project') hold one tree per
+  child. Hidden entries (markers, manifests, histories) are not trees.
+  """
+  root_dir = Path(root_dir)
+  if not root_dir.is_dir():
+    return []
+  trees = []
+  for path in sorted(root_dir.iterdir()):
+    if path.name.startswith(".") or not path.is_dir():
+      continue
+    if path.name in groups and not path.is_symlink():
+      for child in sorted(path.iterdir()):
+        if not child.name.startswith(".") and child.is_dir():
+          trees.append(Tree(kind, "{}/{}".format(path.name, child.name), child))
+    else:
+      trees.append(Tree(kind, path.name, path))
+  return trees
+
+
+def _read_install_size(tree):
+  try:
+    d = json.loads(tree.manifest_file.read_text(encoding="UTF-8"))
+    return sum(entry[0] for entry in d["files"].values())
+  except (OSError, ValueError, KeyError, TypeError):
+    return builder.get_tree_size(tree.path)
+
+
+def measure_trees(trees):
+  """Fills in the size and last use of trees."""
+  build_sizes = builder.read_build_sizes()
+  for tree in trees:
+    if tree.kind == KIND_BUILD:
+      recorded = build_sizes.get(tree.identifier, {})
+      if "time" in recorded:
+        tree.size_bytes = recorded.get("last", 0)
+      else:
+        tree.size_bytes = builder.get_tree_size(tree.path)
+      times = [recorded[k] for k in ("time", "used") if k in recorded]
+      tree.last_used = max(times) if times else tree.path.stat().st_mtime
+      tree.in_use = builder.is_build_dir_in_use(tree.path)
+    else:
+      tree.size_bytes = _read_install_size(tree)
+      try:
+        tree.last_used = tree.marker_file.stat().st_mtime
+      except OSError:
+        tree.last_used = tree.path.stat().st_mtime
+
+
+def get_stale_reason(tree, install_caches, groups):
+  """Gets why a tree is reclaimed regardless of the budget (None if not)."""
+  group = tree.identifier.split("/")[0]
+  if group in groups and tree.identifier not in install_caches:
+    return REASON_ORPHANED
+  if tree.kind != KIND_INSTALL or tree.identifier not in install_caches:
+    return None
+  try:
+    marker_version_hash = tree.marker_file.read_text(encoding="UTF-8")
+  except OSError:
+    return REASON_STALE
+  try:
+    version_hash = install_caches[tree.identifier].version_hash
+  except RuntimeError:
+    # The version cannot be resolved (i.e. not checked out).
+    return None
+  return REASON_STALE if marker_version_hash != version_hash else None
+
+
+def plan_gc(trees, install_caches, groups, *, budget_bytes, min_age_seconds,
+            now):
+  """Plans which trees to reclaim.
+
+  install_caches is a dict of {identifier: InstallCache} of the caches now
+  defined. Returns a list of (tree, reason), in order.
+  """
+
+  def is_hot(tree):
+    # Also covers installs in progress, and builds started recently.
+    return tree.in_use or now - tree.last_used < min_age_seconds
+
+  reclaimed = []
+  kept = []
+  for tree in trees:
+    reason = None
+    if not is_hot(tree):
+      reason = get_stale_reason(tree, install_caches, groups)
+    if reason is not None:
+      reclaimed.append((tree, reason))
+    else:
+      kept.append(tree)
+  if budget_bytes is None:
+    return reclaimed
+
+  used_bytes = sum(tree.size_bytes for tree in kept if not tree.in_ram)
+  for tree in sorted(kept, key=lambda t: t.last_used):
+    if used_bytes <= budget_bytes:
+      break
+    if tree.in_ram or is_hot(tree):
+      continue
+    reclaimed.append((tree, REASON_BUDGET))
+    used_bytes -= tree.size_bytes
+  return reclaimed
+
+
+def remove_tree(tree):
+  if tree.kind == KIND_BUILD:
+    builder.remove_build_dir(tree.path)
+  else:
+    # Without its marker, the install is fetched or built again when needed.
+    for path in (tree.marker_file, tree.manifest_file):
+      if path.exists():
+        path.unlink()
+    builder.remove_build_dir(tree.path)
+
+
+def collect(install_caches, *, budget_bytes, min_age_seconds, dry_run=False):
+  """Reclaims trees under the build and install roots.
+
+  install_caches is a dict of {identifier: InstallCache} of the caches now
+  defined. Returns the list of (tree, reason) reclaimed (or that would be,
+  on a dry run).
+  """
+  groups = get_groups(install_caches)
+  trees = (find_trees(builder.get_build_root(), KIND_BUILD, groups) +
+           find_trees(builder.get_install_root(), KIND_INSTALL, groups))
+  measure_trees(trees)
+  now = time.time()
+  reclaimed = plan_gc(trees,
+                      install_caches,
+                      groups,
+                      budget_bytes=budget_bytes,
+                      min_age_seconds=min_age_seconds,
+                      now=now)
+  for tree, reason in reclaimed:
+    print("{} {} {} ({:.1f}GiB, last used {:.1f}h ago): {}".format(
+        "Would remove" if dry_run else "Removing", tree.kind, tree.identifier,
+        tree.size_bytes / 1024**3, (now - tree.last_used) / 3600, reason))
+    if not dry_run:
+      remove_tree(tree)
+
+  total_bytes = sum(tree.size_bytes for tree in trees if not tree.in_ram)
+  reclaimed_bytes = sum(
+      tree.size_bytes for tree, _ in reclaimed if not tree.in_ram)
+  print("{} {:.1f}GiB of {:.1f}GiB in {} trees{}".format(
+      "Would reclaim" if dry_run else "Reclaimed", reclaimed_bytes / 1024**3,
+      total_bytes / 1024**3, len(trees), "" if budget_bytes is None else
+      " (budget {:.1f}GiB)".format(budget_bytes / 1024**3)))
+  if (budget_bytes is not None and
+      total_bytes - reclaimed_bytes > budget_bytes):
+    print("Still over budget: The remaining trees are hot (used within "
+          "{:.1f}h)".format(min_age_seconds / 3600))
+  return reclaimed
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import os
 from pathlib import *
 import shutil
@@ -20,15 +21,25 @@ import sys
 
 import builder
 import cacher
+import llvm_tasks
 import pythonenv
+import wheelwriter
 
 __all__ = [
     "task_iree_python_deps",
     "task_iree_default",
+    "task_build_iree_default",
     "task_iree_tf_default",
 ]
 
 LLVM_CONFIG = "mlir-generic-rtti"
+# How pyiree wheels are built: "direct" (assembled by wheelwriter),
+# "setuptools" (setup.py bdist_wheel) or "compare" (assembled, then checked
+# against bdist_wheel's).
+WHEEL_BUILDER_ENV_VAR = "MRT_PYIREE_WHEEL_BUILDER"
+WHEEL_BUILDERS = ("direct", "setuptools", "compare")
+# Python packages are staged here (relative to the cmake build dir).
+PYIREE_PACKAGE_SUBDIR = "bindings/python"
 
 
 def get_src_dir():
@@ -41,13 +52,14 @@ def get_llvm_install_dir():
 
 def get_base_cmake_config():
   llvm_install_path = get_llvm_install_dir().joinpath("lib/cmake/mlir")
-  config = dict(BASE_CMAKE_PROTOTYPE)
+  config = copy.deepcopy(BASE_CMAKE_PROTOTYPE)
   add_cmake_args(config, "-DMLIR_DIR={}".format(llvm_install_path))
   return config
 
 
 def task_iree_python_deps():
   """Installs required deps for all python versions."""
+
   def deps():
     pythonenv.pip_install("absl-py", "numpy")
 
@@ -100,37 +112,80 @@ def get_python_cmake_config():
   return config
 
 
+_BUILD_CONFIG = None
+_INSTALL_CACHE = None
+
+
+def get_default_build_config():
+  global _BUILD_CONFIG
+  if _BUILD_CONFIG is None:
+    _BUILD_CONFIG = builder.CMakeBuildConfig(
+        identifier="iree_default",
+        source_dir=get_src_dir(),
+        json_dict_lambda=get_python_cmake_config)
+  return _BUILD_CONFIG
+
+
+def get_default_install_cache():
+  """Gets the (shared) InstallCache for the IREE default build.
+
+  The install includes the python wheels (under dist/), and the key covers
+  the LLVM install it builds against.
+  """
+  global _INSTALL_CACHE
+  if _INSTALL_CACHE is None:
+    _INSTALL_CACHE = cacher.InstallCache(
+        identifier="iree_default",
+        cache_key="iree_default",
+        install_task="build_iree_default",
+        version_data_lambda=lambda: cacher.read_git_state(get_src_dir()),
+        source_dir=get_src_dir(),
+        build_config=get_default_build_config(),
+        deps=[llvm_tasks.get_install_cache(LLVM_CONFIG)])
+  return _INSTALL_CACHE
+
+
 def task_iree_default():
+  """Installs a cached IREE default build (with wheels) or builds locally."""
+  ic = get_default_install_cache()
+  yield ic.yield_tasks(taskname="iree_default")
+
+
+def task_build_iree_default():
   """Builds the IREE default configration."""
-  taskname = "iree_default"
-  config = get_python_cmake_config()
-  bc = builder.CMakeBuildConfig(identifier=taskname,
-                                source_dir=get_src_dir(),
-                                json_dict=config)
+  taskname = "build_iree_default"
+  bc = get_default_build_config()
   yield bc.yield_tasks(taskname=taskname,
                        install_target="install",
-                       task_dep=["llvm:" + LLVM_CONFIG])
+                       task_dep=cacher.declare_cache_deps(
+                           taskname, ["llvm:" + LLVM_CONFIG]))
 
   # Generate python wheel targets.
-  python_configs = pythonenv.get_python_target_configs()
-  for python_config in python_configs:
-    yield distribute_pyiree(taskname=taskname,
-                            label="pyiree_{}".format(python_config.ident),
-                            python_config=python_config,
-                            src_dir=bc.source_dir,
-                            build_dir=bc.build_dir,
-                            install_dir=bc.install_dir)
-
-
-def distribute_pyiree(taskname, label, python_config, src_dir, build_dir,
-                      install_dir):
-  """Creates tasks to install pyiree."""
-  pyiree_build_dir = builder.get_build_root().joinpath("{}_{}".format(
-      taskname, label))
+  yield distribute_pyiree(taskname=taskname,
+                          src_dir=bc.source_dir,
+                          build_dir=bc.build_dir,
+                          install_dir=bc.install_dir)
+
+
+def distribute_pyiree(taskname, src_dir, build_dir, install_dir):
+  """Creates tasks to install pyiree.
+
+  There is a task per python target (so that they build in parallel under
+  'doit -n'), named without probing interpreters: Each looks up its full
+  python target config when it executes. By default, wheels are assembled
+  directly by wheelwriter (with setup.py only run for egg_info), reusing
+  compressed members across interpreters. Set
+  MRT_PYIREE_WHEEL_BUILDER=setuptools to use bdist_wheel instead, or
+  MRT_PYIREE_WHEEL_BUILDER=compare to fail if the wheels differ from
+  bdist_wheel's.
+  """
   packaging_src_dir = Path(src_dir).joinpath("packaging/python")
-  dist_wheel_dir = Path(install_dir).joinpath("dist/{}".format(label))
+  package_root = Path(build_dir).joinpath(PYIREE_PACKAGE_SUBDIR)
+  setup_env = {
+      "PYIREE_CMAKE_BUILD_ROOT": build_dir,
+  }
 
-  def install_wheels(setup_dir):
+  def install_wheels(setup_dir, dist_wheel_dir):
     os.makedirs(dist_wheel_dir, exist_ok=True)
     for file in setup_dir.joinpath("dist").glob("*.whl"):
       dist_wheel_file = dist_wheel_dir.joinpath(file.name)
@@ -143,30 +198,99 @@ def distribute_pyiree(taskname, label, python_config, src_dir, build_dir,
                            cwd=dist_wheel_dir)
         os.remove(dist_wheel_file)
 
-  def setup(setup_py):
+  def setup(python_config, label, setup_py, wheel_builder, member_cache):
+    pyiree_build_dir = builder.get_build_root().joinpath("{}_{}".format(
+        Path(build_dir).name, label))
+    dist_wheel_dir = Path(install_dir).joinpath("dist/{}".format(label))
     setup_dir = pyiree_build_dir.joinpath(setup_py)
     shutil.rmtree(setup_dir, ignore_errors=True)
     os.makedirs(setup_dir, exist_ok=True)
+    if wheel_builder == "setuptools":
+      bdist_wheel(python_config, setup_py, setup_dir)
+    else:
+      assemble_wheel(python_config, setup_py, setup_dir, member_cache)
+    if wheel_builder == "compare":
+      check_wheel(python_config, setup_py, setup_dir)
+    install_wheels(setup_dir, dist_wheel_dir)
+
+  def bdist_wheel(python_config, setup_py, setup_dir):
     args = [
         python_config.exe,
         packaging_src_dir.joinpath(setup_py),
         "bdist_wheel",
     ]
-    builder.subcommand(args,
-                       env={
-                           "PYIREE_CMAKE_BUILD_ROOT": build_dir,
-                       },
-                       cwd=setup_dir)
-    install_wheels(setup_dir)
-
-  yield {
-      "name": label,
-      "actions": [
-          (setup, ["setup_compiler.py"]),
-          (setup, ["setup_rt.py"]),
-      ],
-      "task_dep": [taskname + ":install"],
-  }
+    builder.subcommand(args, env=setup_env, cwd=setup_dir)
+
+  def check_wheel(python_config, setup_py, setup_dir):
+    """Checks an assembled wheel against the one bdist_wheel builds."""
+    reference_dir = setup_dir.joinpath("setuptools")
+    os.makedirs(reference_dir)
+    bdist_wheel(python_config, setup_py, reference_dir)
+    wheel_path = next(setup_dir.joinpath("dist").glob("*.whl"))
+    reference_path = next(reference_dir.joinpath("dist").glob("*.whl"))
+    differences = wheelwriter.compare_contents(wheel_path, reference_path)
+    if wheel_path.name != reference_path.name:
+      differences.insert(0,
+                         "Named {} by bdist_wheel".format(reference_path.name))
+    if differences:
+      raise RuntimeError(
+          "Assembled wheel {} differs from bdist_wheel's:\n{}".format(
+              wheel_path, "\n".join(differences)))
+    print("Checked wheel {} against bdist_wheel".format(wheel_path))
+
+  def assemble_wheel(python_config, setup_py, setup_dir, member_cache):
+    args = [
+        python_config.exe,
+        packaging_src_dir.joinpath(setup_py),
+        "egg_info",
+        "--egg-base",
+        setup_dir,
+    ]
+    builder.subcommand(args, env=setup_env, cwd=setup_dir)
+    egg_info = wheelwriter.read_egg_info(next(setup_dir.glob("*.egg-info")))
+    rel_paths = wheelwriter.get_package_sources(egg_info, package_root,
+                                                setup_dir)
+    if not rel_paths:
+      raise RuntimeError("No sources of {} found under {}".format(
+          setup_py, package_root))
+    files = wheelwriter.collect_files(package_root, rel_paths)
+    reused_before = member_cache.hits
+    tag = subprocess.check_output(
+        [python_config.exe, "-c",
+         wheelwriter.get_wheel_tag_script()]).decode("UTF-8").strip()
+    wheel_path = wheelwriter.write_wheel(
+        setup_dir.joinpath("dist"),
+        name=egg_info.name,
+        version=egg_info.version,
+        tag=tag,
+        files=files,
+        metadata=egg_info.metadata,
+        dist_info_files=egg_info.dist_info_files,
+        member_cache=member_cache)
+    print("Assembled wheel {} ({} members, {} reused)".format(
+        wheel_path, len(files), member_cache.hits - reused_before))
+
+  def build_wheels(exe):
+    wheel_builder = os.environ.get(WHEEL_BUILDER_ENV_VAR, "direct")
+    if wheel_builder not in WHEEL_BUILDERS:
+      raise ValueError("{} must be one of {}".format(WHEEL_BUILDER_ENV_VAR,
+                                                     ", ".join(WHEEL_BUILDERS)))
+    # Stored on disk, so that identical files are compressed once across the
+    # interpreters (whose wheels are built by separate doit workers).
+    member_cache = wheelwriter.MemberCache(builder.get_build_root().joinpath(
+        "{}_wheel_members".format(Path(build_dir).name)))
+    python_config = pythonenv.get_python_target_config(exe)
+    label = "pyiree_{}".format(python_config.ident)
+    setup(python_config, label, "setup_compiler.py", wheel_builder,
+          member_cache)
+    setup(python_config, label, "setup_rt.py", wheel_builder, member_cache)
+
+  for name, exe in pythonenv.get_python_target_names():
+    yield {
+        "name": "pyiree_{}".format(name),
+        "actions": [(build_wheels, [exe])],
+        "task_dep": [taskname + ":install"],
+    }
 
 
 ################################################################################
@@ -208,7 +332,6 @@ def task_iree_tf_default():
   """
   build_dir = builder.get_build_root().joinpath("iree_tf_bazel")
   python_build_dir = build_dir.joinpath("python")
-  os.makedirs(build_dir, exist_ok=True)
   install_dir = builder.get_install_root().joinpath("iree_tf")
   packaging_src_dir = get_src_dir().joinpath("packaging", "python")
 
@@ -217,7 +340,11 @@ def task_iree_tf_default():
   if output_base is None:
     output_base = build_dir.joinpath("bazel-out")
 
-  def exec_build(python_config, flags):
+  def exec_build(exe):
+    # Python target configs are only probed once the task executes.
+    python_config = pythonenv.get_python_target_config(exe)
+    flags = get_bazel_python_build_flags(python_config)
+    builder.prepare_build_dir(build_dir.name, build_dir)
     dist_wheel_dir = install_dir.joinpath("dist/{}".format(python_config.ident))
     os.makedirs(dist_wheel_dir, exist_ok=True)
 
@@ -233,6 +360,7 @@ def task_iree_tf_default():
         "//packaging/python:all_pyiree_packages",
     ]
     builder.subcommand(bazel_args, cwd=get_src_dir())
+    builder.record_build_size(build_dir.name, build_dir)
 
     # Now, using the identified python, copy from the runfiles to a proper
     # python path layout (normalizing filenames in a way that bazel can't do).
@@ -271,15 +399,10 @@ def task_iree_tf_default():
                            cwd=dist_wheel_dir)
         os.remove(dist_wheel_file)
 
-  python_configs = pythonenv.get_python_target_configs()
-  for python_config in python_configs:
+  for name, exe in pythonenv.get_python_target_names():
     yield {
-        "name": ("build-" + python_config.ident),
-        "actions": [
-            (exec_build,
-             [python_config,
-              get_bazel_python_build_flags(python_config)])
-        ],
+        "name": "build-" + name,
+        "actions": [(exec_build, [exe])],
     }
 
     # TODO: Enable all of the python configs once stable.
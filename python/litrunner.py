@@ -0,0 +1,506 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the lit tests of a CMake check target directly.
+
+Building a check target (i.e. 'check-npcomp') runs every lit test, every
+time. Instead, the lit command of the target is taken from the build
+('ninja -t commands') and driven directly:
+  - Tests are discovered with 'lit --show-suites --show-tests'.
+  - Each test gets a key: the hash of its input file, the lit configs of its
+    suite (and the lit.local.cfg files above it), the source files its RUN
+    lines read (i.e. %S/Inputs/x.mlir, or its whole dir for a bare %S) and
+    the binaries of the tools its RUN lines invoke (from the build and the
+    suite's tools dirs). Tests which passed with the same key are not run
+    again. Tests invoking no known tool (i.e. python tests) or reading a
+    source path which does not exist are always run.
+  - The remaining tests are split into shards balanced by their durations
+    in earlier runs, and the shards run as concurrent lit processes.
+  - Results and durations are persisted in the build dir, and written as
+    JUnit XML (including tests skipped as unchanged).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import json
+import os
+from pathlib import Path
+import re
+import shlex
+import subprocess
+import time
+from xml.etree import ElementTree
+
+import logcapture
+
+RUNNER_ENV_VAR = "MRT_TEST_RUNNER"
+RUNNER_LIT = "lit"
+RUNNER_CMAKE = "cmake"
+SHARDS_ENV_VAR = "MRT_LIT_SHARDS"
+RESULTS_FILE_NAME = ".lit_results.json"
+RESULTS_VERSION = 1
+# Result codes which need not be run again for the same key.
+PASSING_CODES = ("PASS", "XFAIL", "UNSUPPORTED")
+FAILING_CODES = ("FAIL", "XPASS", "UNRESOLVED", "TIMEOUT")
+# Assumed duration of tests which have not run before.
+DEFAULT_DURATION = 1.0
+
+_LIT_NAMES = ("lit.py", "llvm-lit", "lit")
+_SUITE_RE = re.compile(r"^  (\S.*) - \d+ tests$")
+_ROOT_RE = re.compile(r"^    (Source|Exec) Root\s*: (.*)$")
+_TEST_RE = re.compile(r"^  (\S.*?) :: (.*)$")
+_RUN_RE = re.compile(r"RUN:(.*)$", re.MULTILINE)
+_TOOLS_DIR_RE = re.compile(r"config\.\w*tools_dir\s*=\s*[\"']([^\"']+)[\"']")
+_WORD_RE = re.compile(r"[\w.+-]+")
+# References to the source dir of a test (%S, %p and their %/ forms), with
+# the path under it, if any.
+_SOURCE_DIR_RE = re.compile(r"%/?[Sp](/[^\s\"';|&<>(),]*)?")
+_GLOB_CHARS = ("*", "?", "[")
+
+
+def get_runner():
+  return os.environ.get(RUNNER_ENV_VAR, RUNNER_LIT)
+
+
+def get_shard_count():
+  env_value = os.environ.get(SHARDS_ENV_VAR)
+  if env_value:
+    return int(env_value)
+  else:
+    return os.cpu_count() or 1
+
+
+class LitCommand:
+  """The lit invocation of a check target."""
+
+  def __init__(self, prefix, options, paths, cwd):
+    # Interpreter and lit script (i.e. [python, .../lit.py]).
+    self.prefix = prefix
+    self.options = options
+    # Test dirs (or files) to run.
+    self.paths = paths
+    self.cwd = cwd
+
+  def __repr__(self):
+    return "LitCommand({} {} {})".format(" ".join(self.prefix),
+                                         " ".join(self.options),
+                                         " ".join(self.paths))
+
+
+class LitTest:
+
+  def __init__(self, suite, path_in_suite, source_root, exec_root):
+    self.suite = suite
+    self.path_in_suite = path_in_suite
+    self.source_root = source_root
+    self.source_path = os.path.join(source_root, path_in_suite)
+    # The path to pass to lit (mapped to the source by the site config).
+    self.exec_path = os.path.join(exec_root, path_in_suite)
+
+  @property
+  def name(self):
+    return "{} :: {}".format(self.suite, self.path_in_suite)
+
+
+def find_lit_command(build_dir, target):
+  """Finds the lit command run by a check target (None if there is none)."""
+  output = subprocess.check_output(
+      ["ninja", "-C", str(build_dir), "-t", "commands", target]).decode("UTF-8")
+  for line in reversed(output.splitlines()):
+    cwd = str(build_dir)
+    for part in line.split(" && "):
+      args = shlex.split(part)
+      if len(args) == 2 and args[0] == "cd":
+        cwd = args[1]
+        continue
+      lit_index = None
+      for i, arg in enumerate(args):
+        if os.path.basename(arg) in _LIT_NAMES:
+          lit_index = i
+          break
+      if lit_index is None:
+        continue
+      options = []
+      paths = []
+      for arg in args[lit_index + 1:]:
+        if not arg.startswith("-") and os.path.exists(os.path.join(cwd, arg)):
+          paths.append(os.path.join(cwd, arg))
+        else:
+          options.append(arg)
+      if paths:
+        return LitCommand(args[:lit_index + 1], options, paths, cwd)
+  return None
+
+
+def find_test_deps(build_dir, target):
+  """Finds what a check target builds before running lit.
+
+  These are the inputs of the custom command(s) of the target (tools,
+  generated site configs, ...).
+  """
+
+  def query(name):
+    output = subprocess.check_output(
+        ["ninja", "-C", str(build_dir), "-t", "query", name]).decode("UTF-8")
+    inputs = []
+    section = None
+    for line in output.splitlines()[1:]:
+      stripped = line.strip()
+      if line.startswith("  ") and not line.startswith("    "):
+        section = stripped.split(":", 1)[0]
+      elif section == "input" and stripped:
+        # Implicit ('| x') and order-only ('|| x') inputs are needed too.
+        inputs.append(stripped.lstrip("|").strip())
+    return inputs
+
+  deps = []
+  for name in query(target):
+    if name.startswith("CMakeFiles/"):
+      deps.extend(query(name))
+    else:
+      deps.append(name)
+  return sorted(set(d for d in deps if not d.startswith("CMakeFiles/")))
+
+
+def discover_tests(command):
+  """Discovers tests. Returns (tests, {suite: (source_root, exec_root)})."""
+  args = command.prefix + command.options + ["--show-suites", "--show-tests"
+                                            ] + command.paths
+  output = subprocess.check_output(args, cwd=command.cwd).decode("UTF-8")
+  suites = dict()
+  tests = []
+  section = None
+  suite = None
+  roots = dict()
+  for line in output.splitlines():
+    if line.startswith("-- "):
+      section = line
+      continue
+    if section == "-- Test Suites --":
+      m = _SUITE_RE.match(line)
+      if m:
+        suite = m.group(1)
+        roots = suites.setdefault(suite, dict())
+        continue
+      m = _ROOT_RE.match(line)
+      if m and suite is not None:
+        roots[m.group(1)] = m.group(2).strip()
+    elif section == "-- Available Tests --":
+      m = _TEST_RE.match(line)
+      if m and m.group(1) in suites:
+        roots = suites[m.group(1)]
+        tests.append(
+            LitTest(m.group(1), m.group(2), roots["Source"], roots["Exec"]))
+  return tests, {
+      name: (roots["Source"], roots["Exec"]) for name, roots in suites.items()
+  }
+
+
+def _hash_file(path, h=None):
+  h = h if h is not None else hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      h.update(chunk)
+  return h
+
+
+class TestKeyer:
+  """Computes the keys of tests, hashing each tool binary once."""
+
+  def __init__(self, build_dir, suites):
+    self._suite_hashes = dict()
+    tool_dirs = [Path(build_dir).joinpath("bin")]
+    for suite, (source_root, exec_root) in suites.items():
+      h = hashlib.sha256()
+      configs = sorted(
+          list(Path(exec_root).glob("lit.site.cfg*")) +
+          list(Path(source_root).glob("lit.cfg*")))
+      for config in configs:
+        h.update(config.name.encode("UTF-8"))
+        _hash_file(config, h)
+        if config.name.startswith("lit.site.cfg"):
+          text = config.read_text(encoding="UTF-8", errors="replace")
+          tool_dirs.extend(Path(d) for d in _TOOLS_DIR_RE.findall(text))
+      self._suite_hashes[suite] = h.hexdigest()
+    # Tools by name (first dir wins, as on a PATH).
+    self._tools = dict()
+    for tool_dir in tool_dirs:
+      if not tool_dir.is_dir():
+        continue
+      for entry in os.scandir(tool_dir):
+        if entry.is_file() and os.access(entry.path, os.X_OK):
+          self._tools.setdefault(entry.name, entry.path)
+    self._tool_hashes = dict()
+    self._source_hashes = dict()
+
+  def _get_tool_hash(self, name):
+    if name not in self._tool_hashes:
+      self._tool_hashes[name] = _hash_file(self._tools[name]).hexdigest()
+    return self._tool_hashes[name]
+
+  def _get_source_hash(self, path):
+    """Hashes a source file or dir (recursively), or None if missing."""
+    if path not in self._source_hashes:
+      h = None
+      if path.is_file():
+        h = _hash_file(path)
+      elif path.is_dir():
+        h = hashlib.sha256()
+        for dir_path, dir_names, file_names in os.walk(str(path)):
+          dir_names.sort()
+          for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            h.update(os.path.relpath(file_path, str(path)).encode("UTF-8"))
+            _hash_file(file_path, h)
+      self._source_hashes[path] = h.hexdigest() if h is not None else None
+    return self._source_hashes[path]
+
+  def get_source_paths(self, test, run_text):
+    """Gets the source paths a test reads besides itself.
+
+    These are the lit.local.cfg files from its dir up to the suite root and
+    the paths its RUN lines reference under its dir. A reference with glob
+    chars is taken as the dir holding them.
+    """
+    test_dir = Path(test.source_path).parent
+    paths = []
+    config_dir = test_dir
+    source_root = Path(test.source_root)
+    while True:
+      local_config = config_dir.joinpath("lit.local.cfg")
+      if local_config.exists():
+        paths.append(local_config)
+      if config_dir == source_root or config_dir == config_dir.parent:
+        break
+      config_dir = config_dir.parent
+    for m in _SOURCE_DIR_RE.finditer(run_text):
+      parts = []
+      for part in (m.group(1) or "").split("/"):
+        if any(c in part for c in _GLOB_CHARS):
+          break
+        if part:
+          parts.append(part)
+      paths.append(Path(os.path.normpath(str(test_dir.joinpath(*parts)))))
+    return sorted(set(paths))
+
+  def get_key(self, test):
+    """Gets the key of a test (None if it cannot be cached)."""
+    try:
+      with open(test.source_path, "rb") as f:
+        contents = f.read()
+    except OSError:
+      return None
+    run_text = "\n".join(
+        m.group(1)
+        for m in _RUN_RE.finditer(contents.decode("UTF-8", errors="replace")))
+    tools = sorted(
+        set(w for w in _WORD_RE.findall(run_text) if w in self._tools))
+    if not tools:
+      return None
+    h = hashlib.sha256()
+    h.update(self._suite_hashes.get(test.suite, "").encode("UTF-8"))
+    h.update(contents)
+    for tool in tools:
+      h.update("{}={}".format(tool, self._get_tool_hash(tool)).encode("UTF-8"))
+    for path in self.get_source_paths(test, run_text):
+      source_hash = self._get_source_hash(path)
+      if source_hash is None:
+        return None
+      h.update("{}={}".format(path, source_hash).encode("UTF-8"))
+    return h.hexdigest()
+
+
+def load_results(build_dir):
+  path = Path(build_dir).joinpath(RESULTS_FILE_NAME)
+  try:
+    d = json.loads(path.read_text(encoding="UTF-8"))
+    if d.get("version") == RESULTS_VERSION:
+      return d["tests"]
+  except (OSError, ValueError, KeyError):
+    pass
+  return {}
+
+
+def save_results(build_dir, results):
+  path = Path(build_dir).joinpath(RESULTS_FILE_NAME)
+  tmp_path = path.parent.joinpath("." + path.name + ".tmp")
+  tmp_path.write_text(json.dumps({
+      "version": RESULTS_VERSION,
+      "tests": results
+  },
+                                 sort_keys=True),
+                      encoding="UTF-8")
+  tmp_path.rename(path)
+
+
+def make_shards(tests, durations, shard_count):
+  """Splits tests into shards of balanced total duration.
+
+  Longest first, each onto the least loaded shard. Returns a list of
+  (predicted seconds, [tests]).
+  """
+  shard_count = max(1, min(shard_count, len(tests)))
+  heap = [(0.0, i) for i in range(shard_count)]
+  shards = [[] for _ in range(shard_count)]
+  loads = [0.0] * shard_count
+  for test in sorted(tests,
+                     key=lambda t: durations.get(t.name, DEFAULT_DURATION),
+                     reverse=True):
+    load, i = heapq.heappop(heap)
+    shards[i].append(test)
+    loads[i] = load + durations.get(test.name, DEFAULT_DURATION)
+    heapq.heappush(heap, (loads[i], i))
+  return [(loads[i], shards[i]) for i in range(shard_count) if shards[i]]
+
+
+def run_shard(command, tests, output_path, log_path):
+  """Runs a shard of tests in one lit process, returning its results."""
+  args = command.prefix + command.options + ["-j1", "-o",
+                                             str(output_path)
+                                            ] + [t.exec_path for t in tests]
+  try:
+    logcapture.check_call_captured(args, cwd=command.cwd, log_path=log_path)
+  except subprocess.CalledProcessError:
+    # Failures are reported from the results.
+    pass
+  try:
+    with open(output_path, "rt") as f:
+      return json.load(f)["tests"]
+  except (OSError, ValueError, KeyError):
+    raise RuntimeError("lit did not write results (see {})".format(log_path))
+
+
+def write_junit(path, name, results):
+  """Writes results ({test name: {"code", "elapsed", ...}}) as JUnit XML."""
+  failures = sum(1 for r in results.values() if r["code"] in FAILING_CODES)
+  skipped = sum(1 for r in results.values() if r["code"] == "UNSUPPORTED")
+  suite_element = ElementTree.Element(
+      "testsuite", {
+          "name":
+              name,
+          "tests":
+              str(len(results)),
+          "failures":
+              str(failures),
+          "skipped":
+              str(skipped),
+          "time":
+              "{:.3f}".format(
+                  sum(r.get("elapsed") or 0.0 for r in results.values())),
+      })
+  for test_name in sorted(results):
+    result = results[test_name]
+    suite, _, path_in_suite = test_name.partition(" :: ")
+    case = ElementTree.SubElement(
+        suite_element, "testcase", {
+            "classname": suite,
+            "name": path_in_suite,
+            "time": "{:.3f}".format(result.get("elapsed") or 0.0),
+        })
+    if result["code"] in FAILING_CODES:
+      failure = ElementTree.SubElement(case, "failure",
+                                       {"message": result["code"]})
+      failure.text = result.get("output", "")
+    elif result["code"] == "UNSUPPORTED":
+      ElementTree.SubElement(case, "skipped", {"message": "UNSUPPORTED"})
+    if result.get("cached"):
+      ElementTree.SubElement(
+          case,
+          "system-out").text = ("Not run: passed before with identical inputs")
+  os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+  ElementTree.ElementTree(suite_element).write(str(path),
+                                               encoding="UTF-8",
+                                               xml_declaration=True)
+
+
+def run_tests(command,
+              build_dir,
+              *,
+              name,
+              junit_path,
+              log_root,
+              shard_count=None):
+  """Runs the lit tests of a command, skipping those passed before.
+
+  Returns a dict of {test name: result}. Raises RuntimeError if any failed.
+  """
+  if shard_count is None:
+    shard_count = get_shard_count()
+  tests, suites = discover_tests(command)
+  keyer = TestKeyer(build_dir, suites)
+  previous = load_results(build_dir)
+  results = dict()
+  to_run = []
+  keys = dict()
+  for test in tests:
+    key = keyer.get_key(test)
+    keys[test.name] = key
+    entry = previous.get(test.name)
+    if (key is not None and entry is not None and entry.get("key") == key and
+        entry.get("code") in PASSING_CODES):
+      results[test.name] = dict(entry, cached=True)
+    else:
+      to_run.append(test)
+  durations = {
+      name: entry["elapsed"]
+      for name, entry in previous.items()
+      if entry.get("elapsed") is not None
+  }
+  shards = make_shards(to_run, durations, shard_count)
+  print("lit: {} tests, {} unchanged, {} to run in {} shards "
+        "(predicted {:.1f}s)".format(len(tests), len(results), len(to_run),
+                                     len(shards),
+                                     max([s[0] for s in shards], default=0.0)))
+
+  start_time = time.time()
+  if shards:
+    output_dir = Path(build_dir).joinpath(".lit_shards")
+    os.makedirs(output_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+      futures = [
+          executor.submit(
+              run_shard, command, shard_tests,
+              output_dir.joinpath("shard_{}.json".format(i)),
+              logcapture.get_next_log_path(log_root, ["lit_shard_{}".format(i)],
+                                           command.cwd))
+          for i, (_, shard_tests) in enumerate(shards)
+      ]
+      for future in futures:
+        for result in future.result():
+          results[result["name"]] = {
+              "code": result["code"],
+              "elapsed": result.get("elapsed"),
+              "output": result.get("output", ""),
+              "key": keys.get(result["name"]),
+          }
+  print("lit: ran {} tests in {:.1f}s".format(len(to_run),
+                                              time.time() - start_time))
+
+  # Only persist what is needed to skip and balance (not outputs).
+  save_results(
+      build_dir, {
+          test_name: {
+              "code": r["code"],
+              "elapsed": r.get("elapsed"),
+              "key": r.get("key"),
+          } for test_name, r in results.items()
+      })
+  write_junit(junit_path, name, results)
+  print("lit: JUnit results written to", junit_path)
+  failed = sorted(n for n, r in results.items() if r["code"] in FAILING_CODES)
+  if failed:
+    for test_name in failed:
+      print("  {}: {}".format(results[test_name]["code"], test_name))
+    raise RuntimeError("{} lit tests failed".format(len(failed)))
+  return results
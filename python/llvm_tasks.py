@@ -15,6 +15,11 @@
 import builder
 import cacher
 
+# Dirs of llvm-project needed whatever projects are enabled. Besides LLVM
+# itself, llvm/ has lit (llvm/utils/lit), which other projects test with
+# (see npcomp_tasks.get_llvm_lit_path).
+SPARSE_CHECKOUT_BASE_DIRS = ("llvm", "cmake", "third-party")
+
 __all__ = [
     "task_llvm",
     "task_build_llvm",
@@ -31,18 +36,74 @@ def _get_configs():
     yield config_name, config_file, identifier
 
 
-def _get_source_dir():
+def get_source_dir():
   return builder.TOP_DIR.joinpath("external/llvm-project")
 
 
-def task_llvm():
-  """Installs a cached LLVM build or builds locally."""
+def get_enabled_projects(build_config):
+  """Gets the projects (and runtimes) enabled by an LLVM build config.
+
+  Returns None if all are enabled.
+  """
+  projects = []
+  for arg in build_config.canonical_cmake_args:
+    for name in ("LLVM_ENABLE_PROJECTS", "LLVM_ENABLE_RUNTIMES"):
+      prefix = "-D{}=".format(name)
+      if arg.startswith(prefix):
+        projects.extend(p for p in arg[len(prefix):].split(";") if p)
+  if "all" in projects:
+    return None
+  return projects
+
+
+def get_sparse_checkout_dirs():
+  """Gets the dirs of llvm-project needed by all configs in llvm-configs/.
+
+  These are the cone of a sparse checkout, which saves checking out (and
+  diffing, for cache keys) clang, lldb, libcxx, flang and the rest. Returns
+  None if the whole tree is needed.
+  """
+  dirs = set(SPARSE_CHECKOUT_BASE_DIRS)
   for config_name, config_file, identifier in _get_configs():
-    ic = cacher.InstallCache(
-        identifier=identifier,
+    projects = get_enabled_projects(get_build_config(config_name))
+    if projects is None:
+      return None
+    dirs.update(projects)
+  return sorted(dirs)
+
+
+_INSTALL_CACHES = dict()
+
+
+def get_build_config(config_name):
+  """Gets the CMakeBuildConfig of an LLVM config in llvm-configs/."""
+  config_file = builder.TOP_DIR.joinpath("llvm-configs",
+                                         config_name + ".config.json")
+  source_dir = get_source_dir()
+  return builder.CMakeBuildConfig.load(
+      identifier="llvm-project/{}".format(config_name),
+      config_file=config_file,
+      source_dir=source_dir,
+      configure_dir=source_dir.joinpath("llvm"))
+
+
+def get_install_cache(config_name):
+  """Gets the (shared) InstallCache for an LLVM config."""
+  if config_name not in _INSTALL_CACHES:
+    _INSTALL_CACHES[config_name] = cacher.InstallCache(
+        identifier="llvm-project/{}".format(config_name),
         cache_key="llvm-project__{}".format(config_name),
         install_task="build_llvm:{}:install".format(config_name),
-        version_data_lambda=lambda: cacher.read_git_state(_get_source_dir()))
+        version_data_lambda=lambda: cacher.read_git_state(get_source_dir()),
+        source_dir=get_source_dir(),
+        build_config=get_build_config(config_name))
+  return _INSTALL_CACHES[config_name]
+
+
+def task_llvm():
+  """Installs a cached LLVM build or builds locally."""
+  for config_name, config_file, identifier in _get_configs():
+    ic = get_install_cache(config_name)
     yield ic.yield_tasks(taskname="llvm", basename=config_name)
 
 
@@ -58,12 +119,7 @@ def task_build_llvm():
     :install
   """
   for config_name, config_file, identifier in _get_configs():
-    source_dir = _get_source_dir()
-    bc = builder.CMakeBuildConfig.load(
-        identifier=identifier,
-        config_file=config_file,
-        source_dir=source_dir,
-        configure_dir=source_dir.joinpath("llvm"))
+    bc = get_build_config(config_name)
     yield bc.yield_tasks(taskname="build_llvm",
                          basename=config_name,
                          install_target="install")
@@ -0,0 +1,246 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Captures subprocess output to compressed logs.
+
+Full builds emit hundreds of MB of output, which slows down both CI log
+viewers and the builds themselves (blocking on a pipe or terminal). Instead,
+output is read asynchronously and:
+  - Written to a gzip compressed log file per step.
+  - Kept in a ring buffer of the last lines.
+  - Scanned for error blocks (compiler diagnostics, ninja 'FAILED:' steps,
+    bazel 'ERROR:' lines) with the lines following them.
+  - Summarized as a rate limited progress line (overwritten in place on a
+    terminal, else printed every MRT_LOG_PROGRESS_SECONDS).
+On failure, the error blocks and the tail of the output are printed.
+"""
+
+from collections import deque
+import gzip
+import os
+from pathlib import Path
+import re
+import subprocess
+import sys
+import threading
+import time
+
+TAIL_LINES_ENV_VAR = "MRT_LOG_TAIL_LINES"
+DEFAULT_TAIL_LINES = 100
+PROGRESS_SECONDS_ENV_VAR = "MRT_LOG_PROGRESS_SECONDS"
+DEFAULT_PROGRESS_SECONDS = 30.0
+# Terminals get a line overwritten in place, so can be updated more often.
+TTY_PROGRESS_SECONDS = 1.0
+
+MAX_ERROR_BLOCKS = 20
+MAX_ERROR_BLOCK_LINES = 30
+
+_ERROR_START_RE = re.compile(
+    r"(^FAILED: )|(: (fatal )?error[:\s])|(^ERROR: )|(^CMake Error)|"
+    r"(^ld(\.\w+)?: error)|(undefined reference to)")
+# Lines which end an error block (the start of a new build step).
+_STEP_RE = re.compile(r"^\[\d+/\d+\] |^INFO: |^-- ")
+
+_RUN_DIR = None
+_RUN_DIR_LOCK = threading.Lock()
+_LOG_COUNTER = 0
+
+
+def _get_int_env(name, default):
+  env_value = os.environ.get(name)
+  return int(env_value) if env_value else default
+
+
+def _get_float_env(name, default):
+  env_value = os.environ.get(name)
+  return float(env_value) if env_value else default
+
+
+def get_next_log_path(log_root, args, cwd):
+  """Gets a new log file path for a command, under a per-run directory."""
+  global _RUN_DIR, _LOG_COUNTER
+  with _RUN_DIR_LOCK:
+    if _RUN_DIR is None:
+      _RUN_DIR = Path(log_root).joinpath("{}_{}".format(
+          time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+    _LOG_COUNTER += 1
+    counter = _LOG_COUNTER
+  name = "{}_{}".format(Path(str(args[0])).name, Path(str(cwd)).resolve().name)
+  name = re.sub(r"[^\w.-]+", "_", name)
+  return _RUN_DIR.joinpath("{:04d}_{}.log.gz".format(counter, name))
+
+
+class ErrorBlockExtractor:
+  """Collects error blocks (an error line and the lines following it)."""
+
+  def __init__(self,
+               max_blocks=MAX_ERROR_BLOCKS,
+               max_block_lines=MAX_ERROR_BLOCK_LINES):
+    self.max_blocks = max_blocks
+    self.max_block_lines = max_block_lines
+    self.blocks = []
+    self.dropped_blocks = 0
+    self._current = None
+
+  def add_line(self, line):
+    if _ERROR_START_RE.search(line):
+      # Consecutive errors (i.e. a compiler diagnostic under a ninja
+      # 'FAILED:' line) extend the current block.
+      if self._current is not None and len(
+          self._current) < self.max_block_lines:
+        self._current.append(line)
+        return
+      if len(self.blocks) >= self.max_blocks:
+        self.dropped_blocks += 1
+        self._current = None
+        return
+      self._current = [line]
+      self.blocks.append(self._current)
+    elif self._current is not None:
+      if _STEP_RE.search(line) or len(self._current) >= self.max_block_lines:
+        self._current = None
+      else:
+        self._current.append(line)
+
+
+class LogCapture:
+  """Asynchronously captures the output of a process."""
+
+  def __init__(self,
+               log_path,
+               *,
+               label,
+               tail_lines=None,
+               progress_seconds=None):
+    self.log_path = Path(log_path)
+    self.label = label
+    self.tail = deque(maxlen=tail_lines if tail_lines is not None else
+                      _get_int_env(TAIL_LINES_ENV_VAR, DEFAULT_TAIL_LINES))
+    self.errors = ErrorBlockExtractor()
+    self.is_tty = sys.stdout.isatty()
+    if progress_seconds is None:
+      progress_seconds = (TTY_PROGRESS_SECONDS if self.is_tty else
+                          _get_float_env(PROGRESS_SECONDS_ENV_VAR,
+                                         DEFAULT_PROGRESS_SECONDS))
+    self.progress_seconds = progress_seconds
+    self.line_count = 0
+    self.byte_count = 0
+    self.start_time = None
+    # Resource use of the process (and its descendants), once it exited.
+    self.rusage = None
+    self._last_progress_time = 0.0
+    self._progress_printed = False
+    self._thread = None
+
+  def start(self, stream):
+    self.start_time = time.time()
+    self._last_progress_time = self.start_time
+    os.makedirs(self.log_path.parent, exist_ok=True)
+    self._thread = threading.Thread(target=self._run,
+                                    args=(stream,),
+                                    daemon=True)
+    self._thread.start()
+
+  def join(self):
+    self._thread.join()
+    if self.is_tty and self._progress_printed:
+      # Finish the in-place progress line.
+      sys.stdout.write("\n")
+      sys.stdout.flush()
+
+  def _run(self, stream):
+    # Fast compression: this must keep up with the build.
+    with gzip.open(self.log_path, "wb", compresslevel=1) as log_file:
+      for raw_line in iter(stream.readline, b""):
+        log_file.write(raw_line)
+        self.byte_count += len(raw_line)
+        self.line_count += 1
+        line = raw_line.decode("UTF-8", errors="replace").rstrip("\r\n")
+        self.tail.append(line)
+        self.errors.add_line(line)
+        now = time.time()
+        if now - self._last_progress_time >= self.progress_seconds:
+          self._last_progress_time = now
+          self._print_progress(line, now)
+    stream.close()
+
+  def _print_progress(self, line, now):
+    elapsed = int(now - self.start_time)
+    status = "[{}] {:02d}:{:02d}:{:02d} {} lines, {:.1f}MiB: {}".format(
+        self.label, elapsed // 3600, (elapsed // 60) % 60, elapsed % 60,
+        self.line_count, self.byte_count / (1024 * 1024), line)
+    if self.is_tty:
+      width = 120
+      try:
+        width = os.get_terminal_size().columns - 1
+      except OSError:
+        pass
+      sys.stdout.write("\r" + status[:width].ljust(width))
+      self._progress_printed = True
+    else:
+      sys.stdout.write(status[:400] + "\n")
+    sys.stdout.flush()
+
+  def format_failure(self):
+    """Formats the error blocks and tail for printing on failure."""
+    lines = ["Log: {} ({} lines)".format(self.log_path, self.line_count)]
+    if self.errors.blocks:
+      lines.append("---- Errors ({} blocks{}) ----".format(
+          len(self.errors.blocks),
+          ", {} more not shown".format(self.errors.dropped_blocks)
+          if self.errors.dropped_blocks else ""))
+      for block in self.errors.blocks:
+        lines.extend(block)
+        lines.append("")
+    lines.append("---- Last {} lines ----".format(len(self.tail)))
+    lines.extend(self.tail)
+    return "\n".join(lines)
+
+
+def check_call_captured(args, *, cwd, log_path, env=None):
+  """Runs a command like subprocess.check_call, capturing its output.
+
+  Raises subprocess.CalledProcessError on failure (after printing the error
+  blocks and tail of the output). Returns the LogCapture, with the resource
+  use of the command.
+  """
+  capture = LogCapture(log_path, label=Path(args[0]).name)
+  print("++ LOG:", log_path)
+  sys.stdout.flush()
+  process = subprocess.Popen(args,
+                             cwd=cwd,
+                             env=env,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+  capture.start(process.stdout)
+  try:
+    # Like process.wait(), but also gets the resource use.
+    _, status, capture.rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+      returncode = -os.WTERMSIG(status)
+    else:
+      returncode = os.WEXITSTATUS(status)
+    process.returncode = returncode
+  except:
+    process.kill()
+    process.wait()
+    raise
+  finally:
+    capture.join()
+  if returncode != 0:
+    print("++ FAILED (exit {}): {}".format(returncode, " ".join(args)))
+    print(capture.format_failure())
+    sys.stdout.flush()
+    raise subprocess.CalledProcessError(returncode, args)
+  return capture
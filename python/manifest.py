@@ -0,0 +1,182 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Manifests of installed file trees, for fast integrity verification.
+
+A manifest records, for every file under a root directory, its relative
+path, size, mtime (in whole seconds, which is what tar preserves) and
+optionally a sha256 of its contents. Symlinks are recorded by target.
+
+Verification comes in two tiers:
+  stat: Compares size/mtime/link target only. A single lstat per entry.
+  content: Additionally re-hashes every file (in parallel).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+VERIFY_NONE = "none"
+VERIFY_STAT = "stat"
+VERIFY_CONTENT = "content"
+VERIFY_MODES = (VERIFY_NONE, VERIFY_STAT, VERIFY_CONTENT)
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while True:
+      block = f.read(_HASH_BLOCK_SIZE)
+      if not block:
+        break
+      h.update(block)
+  return h.hexdigest()
+
+
+def _walk(root_dir):
+  """Yields (relpath, DirEntry) for all files and symlinks under root_dir."""
+  stack = [""]
+  while stack:
+    rel_dir = stack.pop()
+    with os.scandir(os.path.join(root_dir, rel_dir)) as it:
+      for entry in it:
+        rel_path = entry.name if not rel_dir else rel_dir + "/" + entry.name
+        if entry.is_symlink() or entry.is_file(follow_symlinks=False):
+          yield rel_path, entry
+        elif entry.is_dir(follow_symlinks=False):
+          stack.append(rel_path)
+
+
+def hash_files(root_dir, rel_paths, max_workers=None):
+  """Hashes files in parallel. hashlib releases the GIL on large updates."""
+
+  def hash_one(rel_path):
+    try:
+      return hash_file(os.path.join(root_dir, rel_path))
+    except OSError:
+      return None
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return dict(zip(rel_paths, executor.map(hash_one, rel_paths)))
+
+
+class Manifest:
+  """Manifest of a file tree.
+
+  files: {relpath: [size, mtime, sha256 or None]}
+  links: {relpath: link target}
+  """
+
+  def __init__(self, files=None, links=None):
+    self.files = files if files is not None else dict()
+    self.links = links if links is not None else dict()
+
+  def __len__(self):
+    return len(self.files) + len(self.links)
+
+  @classmethod
+  def create(cls, root_dir, *, hash_contents=True, max_workers=None):
+    """Creates a manifest from the current state of root_dir."""
+    files = dict()
+    links = dict()
+    for rel_path, entry in _walk(root_dir):
+      if entry.is_symlink():
+        links[rel_path] = os.readlink(entry.path)
+      else:
+        st = entry.stat(follow_symlinks=False)
+        files[rel_path] = [st.st_size, int(st.st_mtime), None]
+    if hash_contents:
+      hashes = hash_files(root_dir, list(files.keys()), max_workers)
+      for rel_path, digest in hashes.items():
+        files[rel_path][2] = digest
+    return cls(files, links)
+
+  def clamp_mtimes(self, mtime_epoch):
+    """Returns a copy with mtimes clamped to mtime_epoch (as archived)."""
+    mtime_epoch = int(mtime_epoch)
+    files = {
+        rel_path: [size, min(mtime, mtime_epoch), digest]
+        for rel_path, (size, mtime, digest) in self.files.items()
+    }
+    return Manifest(files, dict(self.links))
+
+  @classmethod
+  def load(cls, path):
+    d = json.loads(Path(path).read_text(encoding="UTF-8"))
+    if d.get("version") != MANIFEST_VERSION:
+      raise ValueError("Unsupported manifest version in {}".format(path))
+    return cls(d["files"], d["links"])
+
+  def save(self, path):
+    path = Path(path)
+    tmp_path = path.parent.joinpath("." + path.name + ".tmp")
+    os.makedirs(path.parent, exist_ok=True)
+    d = {
+        "version": MANIFEST_VERSION,
+        "files": self.files,
+        "links": self.links,
+    }
+    tmp_path.write_text(json.dumps(d, sort_keys=True), encoding="UTF-8")
+    tmp_path.rename(path)
+
+  def verify_stat(self, root_dir):
+    """Returns the sorted list of relpaths which are missing or changed."""
+    damaged = []
+    join = os.path.join
+    for rel_path, (size, mtime, _) in self.files.items():
+      try:
+        st = os.lstat(join(root_dir, rel_path))
+      except OSError:
+        damaged.append(rel_path)
+        continue
+      if st.st_size != size or int(st.st_mtime) != mtime:
+        damaged.append(rel_path)
+    for rel_path, target in self.links.items():
+      try:
+        if os.readlink(join(root_dir, rel_path)) != target:
+          damaged.append(rel_path)
+      except OSError:
+        damaged.append(rel_path)
+    damaged.sort()
+    return damaged
+
+  def verify_content(self, root_dir, *, max_workers=None):
+    """Verifies stat and content hashes.
+
+    Files without a recorded hash are verified by stat only.
+    """
+    damaged = set(self.verify_stat(root_dir))
+    to_hash = [
+        rel_path for rel_path, (_, _, digest) in self.files.items()
+        if digest is not None and rel_path not in damaged
+    ]
+    hashes = hash_files(root_dir, to_hash, max_workers)
+    for rel_path in to_hash:
+      if hashes[rel_path] != self.files[rel_path][2]:
+        damaged.add(rel_path)
+    return sorted(damaged)
+
+  def verify(self, root_dir, mode):
+    if mode == VERIFY_NONE:
+      return []
+    elif mode == VERIFY_STAT:
+      return self.verify_stat(root_dir)
+    elif mode == VERIFY_CONTENT:
+      return self.verify_content(root_dir)
+    else:
+      raise ValueError("Unknown verify mode: {}".format(mode))
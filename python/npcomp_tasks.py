@@ -12,16 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import os
 import sys
 
 import builder
 import cacher
+import common_tasks
+import llvm_tasks
+import pyextbuild
 import pythonenv
 
 LLVM_CONFIG = "mlir-generic-rtti"
+# Set to 0 to only build for the first python target config.
+PYTHON_VARIANTS_ENV_VAR = "MRT_NPCOMP_PYTHON_VARIANTS"
 
 __all__ = [
     "task_npcomp_default",
+    "task_build_npcomp_default",
 ]
 
 
@@ -30,10 +38,12 @@ def get_src_dir():
 
 
 def get_llvm_lit_path():
-  lit_path = builder.TOP_DIR.joinpath("external", "llvm-project", "llvm",
-                                      "utils", "lit", "lit.py")
-  assert lit_path.exists(), "Could not find lit ({})".format(lit_path)
-  return lit_path
+  """Gets the path of lit in the llvm-project sources.
+
+  Not checked for existence: this is part of the cache key, which must be
+  derivable before checking out (see cacher.get_required_source_dirs).
+  """
+  return llvm_tasks.get_source_dir().joinpath("llvm", "utils", "lit", "lit.py")
 
 
 def get_llvm_install_dir():
@@ -57,7 +67,7 @@ def add_cmake_args(config, *args):
 
 def get_base_cmake_config():
   llvm_install_path = get_llvm_install_dir().joinpath("lib/cmake/mlir")
-  config = dict(BASE_CMAKE_PROTOTYPE)
+  config = copy.deepcopy(BASE_CMAKE_PROTOTYPE)
   add_cmake_args(
       config,  # Base args
       "-DMLIR_DIR={}".format(llvm_install_path),
@@ -67,41 +77,123 @@ def get_base_cmake_config():
   return config
 
 
+def get_primary_python_config():
+  """Gets the python target config that the CMake build is configured for."""
+  return pythonenv.get_python_target_configs()[0]
+
+
+def get_python_variant_configs():
+  """Gets the other python target configs.
+
+  Only the extension modules are built for these (see pyextbuild), reusing
+  the C++ core of the primary build.
+  """
+  if os.environ.get(PYTHON_VARIANTS_ENV_VAR, "1") == "0":
+    return ()
+  return pythonenv.get_python_target_configs()[1:]
+
+
 def get_python_cmake_config():
   config = get_base_cmake_config()
 
-  python_configs = pythonenv.get_python_target_configs()
-  for python_config in python_configs:
-    add_cmake_args(
-        config,  # Python args
-        "-DPYTHON_EXECUTABLE={}".format(python_config.exe),
-        "-DPYTHON_LIBRARIES={}".format(";".join(python_config.libraries)),
-        "-DPYTHON_INCLUDE_DIRS={}".format(";".join(python_config.include_dirs)),
-        "-DPYTHON_MODULE_PREFIX=",
-        "-DPYTHON_MODULE_EXTENSION={}".format(python_config.extension))
-    if not python_config.libraries:
-      # Disable version-specific shared linkage if the python environment
-      # does not report libraries to link against (avoids a race where the
-      # CMake python configuration "tries harder" to find libraries, but we
-      # need to respect what the environment reports for distribution).
-      add_cmake_args(config, "-DNPCOMP_PYTHON_BINDINGS_VERSION_LOCKED=0")
-
-    # TODO: Enable multiple python configs
-    break
+  python_config = get_primary_python_config()
+  add_cmake_args(
+      config,  # Python args
+      "-DPYTHON_EXECUTABLE={}".format(python_config.exe),
+      "-DPYTHON_LIBRARIES={}".format(";".join(python_config.libraries)),
+      "-DPYTHON_INCLUDE_DIRS={}".format(";".join(python_config.include_dirs)),
+      "-DPYTHON_MODULE_PREFIX=",
+      "-DPYTHON_MODULE_EXTENSION={}".format(python_config.extension))
+  if not python_config.libraries:
+    # Disable version-specific shared linkage if the python environment
+    # does not report libraries to link against (avoids a race where the
+    # CMake python configuration "tries harder" to find libraries, but we
+    # need to respect what the environment reports for distribution).
+    add_cmake_args(config, "-DNPCOMP_PYTHON_BINDINGS_VERSION_LOCKED=0")
   return config
 
 
+def get_version_data():
+  """Gets version data: the source state and python variants built."""
+  version_data = cacher.read_git_state(get_src_dir())
+  for python_config in get_python_variant_configs():
+    version_data += "\npython_variant={}".format(python_config.ident)
+  return version_data
+
+
+def install_python_variants():
+  """Builds and installs extension modules for the python variants."""
+  variant_configs = get_python_variant_configs()
+  if not variant_configs:
+    return
+  bc = get_build_config()
+  primary_config = get_primary_python_config()
+  print("Building python variants: {}".format(", ".join(
+      c.ident for c in variant_configs)))
+  variant_modules = pyextbuild.build_variants(bc.build_dir, primary_config,
+                                              variant_configs)
+  for path in pyextbuild.install_variants(bc.install_dir, primary_config,
+                                          variant_configs, variant_modules):
+    print("Installed", path)
+
+
+_BUILD_CONFIG = None
+_INSTALL_CACHE = None
+
+
+def get_build_config():
+  global _BUILD_CONFIG
+  if _BUILD_CONFIG is None:
+    _BUILD_CONFIG = builder.CMakeBuildConfig(
+        identifier="npcomp_default",
+        source_dir=get_src_dir(),
+        json_dict_lambda=get_python_cmake_config)
+  return _BUILD_CONFIG
+
+
+def get_install_cache():
+  """Gets the (shared) InstallCache for the npcomp default build.
+
+  The key covers the LLVM and pybind11 installs it builds against.
+  """
+  global _INSTALL_CACHE
+  if _INSTALL_CACHE is None:
+    _INSTALL_CACHE = cacher.InstallCache(
+        identifier="npcomp_default",
+        cache_key="npcomp_default",
+        install_task="build_npcomp_default:install",
+        version_data_lambda=get_version_data,
+        source_dir=get_src_dir(),
+        build_config=get_build_config(),
+        build_source_dirs=[llvm_tasks.get_source_dir()],
+        deps=[
+            llvm_tasks.get_install_cache(LLVM_CONFIG),
+            common_tasks.get_pybind11_install_cache(),
+        ])
+  return _INSTALL_CACHE
+
+
 def task_npcomp_default():
-  """A default build of npcomp."""
-  taskname = "npcomp_default"
-  config = get_python_cmake_config()
-  bc = builder.CMakeBuildConfig(identifier=taskname,
-                                source_dir=get_src_dir(),
-                                json_dict=config)
+  """Installs a cached npcomp default build or builds locally."""
+  ic = get_install_cache()
+  yield ic.yield_tasks(taskname="npcomp_default")
+
+
+def task_build_npcomp_default():
+  """A default build of npcomp.
+
+  The C++ core is built once (for the first python target config). Only the
+  python extension modules are rebuilt for the other configs, concurrently,
+  and installed alongside.
+  """
+  taskname = "build_npcomp_default"
+  bc = get_build_config()
   yield bc.yield_tasks(taskname=taskname,
                        install_target="install",
                        test_target="check-npcomp",
-                       task_dep=[
-                           "llvm:" + LLVM_CONFIG,
-                           "pybind11:default",
-                       ])
+                       post_install_actions=[(install_python_variants, [])],
+                       task_dep=cacher.declare_cache_deps(
+                           taskname, [
+                               "llvm:" + LLVM_CONFIG,
+                               "pybind11:default",
+                           ]))
@@ -0,0 +1,269 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Estimates the cost of providing cached installs, without providing them.
+
+Each InstallCache needed by the given tasks is resolved (without side
+effects) to one of:
+  installed: Already installed with the right version. Free.
+  local: The archive is in the local cache. Must be extracted.
+  shared: The archive is in the shared cache dir (see workqueue). Must be
+    fetched and extracted.
+  build: Must be built locally, which needs its deps in turn.
+  unresolved: The version cannot be resolved (i.e. its source dir is
+    neither checked out nor pinned), so it is planned as a build.
+
+Fetch/extract times are estimated from the throughput recorded in the cache
+stats (per archive byte), build times from the mean recorded build duration
+of the cache key or else from the task history of its install task. Only
+archive indexes are read: nothing is fetched, extracted, configured or built.
+"""
+
+import os
+
+import archive
+import builder
+import cacher
+import scheduler
+import taskhistory
+import workqueue
+
+STATE_INSTALLED = "installed"
+STATE_LOCAL = "local"
+STATE_SHARED = "shared"
+STATE_BUILD = "build"
+STATE_UNRESOLVED = "unresolved"
+
+# Throughputs used before any have been recorded.
+DEFAULT_FETCH_BYTES_PER_SECOND = 100 * 1024 * 1024
+DEFAULT_EXTRACT_BYTES_PER_SECOND = 50 * 1024 * 1024
+
+
+def get_throughputs(stats_summary):
+  """Gets (fetch, extract) archive bytes per second from cache stats."""
+  bytes_fetched = sum(f["bytes_fetched"] for f in stats_summary.values())
+  fetch_seconds = sum(f["fetch_seconds"] for f in stats_summary.values())
+  extract_seconds = sum(f["extract_seconds"] for f in stats_summary.values())
+  fetch_rate = DEFAULT_FETCH_BYTES_PER_SECOND
+  extract_rate = DEFAULT_EXTRACT_BYTES_PER_SECOND
+  if bytes_fetched and fetch_seconds > 0:
+    fetch_rate = bytes_fetched / fetch_seconds
+  if bytes_fetched and extract_seconds > 0:
+    extract_rate = bytes_fetched / extract_seconds
+  return fetch_rate, extract_rate
+
+
+def get_build_seconds(install_cache, stats_summary, history):
+  """Estimates the seconds to build an install locally (None if unknown)."""
+  family = stats_summary.get(install_cache.cache_key)
+  if family is not None and family["mean_build_seconds"] is not None:
+    return family["mean_build_seconds"]
+  # Sum the recorded tasks building it (i.e. 'build_llvm:<config>:*').
+  seconds = [
+      s for name, s in history.task_seconds.items()
+      if install_cache.is_build_task(name)
+  ]
+  return sum(seconds) if seconds else None
+
+
+def read_archive_sizes(cache_dir, archive_name, local_cache_dir=None):
+  """Reads the sizes of an archive (and its delta bases) in a cache dir.
+
+  Only the indexes are read. Bases already in local_cache_dir need not be
+  fetched. Returns (fetch bytes, extract bytes), where extract bytes are the
+  uncompressed size of the install.
+  """
+  fetch_bytes = 0
+  extract_bytes = None
+  names = []
+  name = archive_name
+  while name is not None and name not in names:
+    names.append(name)
+    path = os.path.join(cache_dir, name)
+    if (local_cache_dir is None or
+        not os.path.exists(os.path.join(local_cache_dir, name))):
+      fetch_bytes += os.path.getsize(path)
+    with archive.ArchiveReader(path) as reader:
+      if extract_bytes is None:
+        extract_bytes = sum(
+            m.get("size", 0)
+            for m in reader.list()
+            if m["type"] == archive.TYPE_FILE)
+      name = reader.base_name
+  return fetch_bytes, extract_bytes or 0
+
+
+def is_installed(install_cache):
+  """Checks (without side effects) if the right version is installed."""
+  try:
+    marker_version_hash = install_cache.marker_file.read_text(encoding="UTF-8")
+  except OSError:
+    return False
+  return (marker_version_hash == install_cache.version_hash and
+          install_cache.install_dir.exists())
+
+
+def plan_install(install_cache, stats_summary, history, throughputs):
+  """Resolves the state of an install and estimates its cost.
+
+  Returns a dict with its state, bytes and seconds (None if unknown).
+  """
+  fetch_rate, extract_rate = throughputs
+  entry = {
+      "identifier": install_cache.identifier,
+      "cache_key": install_cache.cache_key,
+      "version_hash": install_cache.version_hash,
+      "fetch_bytes": 0,
+      "extract_bytes": 0,
+      "seconds": 0.0,
+  }
+  if is_installed(install_cache):
+    entry["state"] = STATE_INSTALLED
+    return entry
+
+  archive_name = install_cache.cache_archive_file.name
+  local_cache_dir = cacher.get_cache_root()
+  shared_cache_dir = workqueue.get_shared_cache_dir()
+  sizes = None
+  if install_cache.cache_archive_file.exists():
+    entry["state"] = STATE_LOCAL
+    sizes = read_archive_sizes(local_cache_dir, archive_name)
+    # Only archive bytes fetched from the shared cache dir cost a fetch.
+    sizes = (0, sizes[1])
+    archive_bytes = os.path.getsize(install_cache.cache_archive_file)
+  elif (workqueue.is_enabled() and
+        shared_cache_dir.joinpath(archive_name).exists()):
+    entry["state"] = STATE_SHARED
+    sizes = read_archive_sizes(shared_cache_dir, archive_name, local_cache_dir)
+    archive_bytes = shared_cache_dir.joinpath(archive_name).stat().st_size
+  if sizes is not None:
+    entry["fetch_bytes"], entry["extract_bytes"] = sizes
+    entry["seconds"] = (entry["fetch_bytes"] / fetch_rate +
+                        archive_bytes / extract_rate)
+    return entry
+
+  entry["state"] = STATE_BUILD
+  entry["seconds"] = get_build_seconds(install_cache, stats_summary, history)
+  queue = cacher.get_work_queue()
+  if queue is not None:
+    lease = queue.read_lease(install_cache.queue_job_name)
+    if lease is not None:
+      entry["building_on"] = lease["owner"]
+  return entry
+
+
+def make_plan(install_caches):
+  """Plans providing the given caches ({task_name: InstallCache}).
+
+  Deps are only needed by installs which must be built, so only those are
+  followed. Returns a dict of the installs (by task name), the totals and
+  the critical path.
+  """
+  stats_summary = cacher.get_stats_store().summarize()
+  history = builder.get_task_history_store().summarize()
+  throughputs = get_throughputs(stats_summary)
+  installs = dict()
+  graph = dict()
+  pending = list(install_caches.items())
+  while pending:
+    task_name, install_cache = pending.pop()
+    if task_name in installs:
+      continue
+    try:
+      entry = plan_install(install_cache, stats_summary, history, throughputs)
+    except RuntimeError as e:
+      entry = {
+          "identifier": install_cache.identifier,
+          "cache_key": install_cache.cache_key,
+          "state": STATE_UNRESOLVED,
+          "error": str(e),
+          "fetch_bytes": 0,
+          "extract_bytes": 0,
+          "seconds": get_build_seconds(install_cache, stats_summary, history),
+      }
+    installs[task_name] = entry
+    graph[task_name] = []
+    if entry["state"] not in (STATE_BUILD, STATE_UNRESOLVED):
+      continue
+    for dep in install_cache.deps:
+      dep_name = dep.task_name or dep.identifier
+      graph[task_name].append(dep_name)
+      pending.append((dep_name, dep))
+
+  seconds = {
+      task_name: entry["seconds"] or 0.0
+      for task_name, entry in installs.items()
+  }
+  critical_path_seconds, critical_path = scheduler.get_critical_path(
+      graph, seconds)
+  # Installs with nothing to do take no time, so leave them off the path.
+  critical_path = [name for name in critical_path if seconds[name] > 0]
+  unknown = [
+      task_name for task_name, entry in installs.items()
+      if entry["seconds"] is None
+  ]
+  return {
+      "installs": installs,
+      "fetch_bytes": sum(e["fetch_bytes"] for e in installs.values()),
+      "extract_bytes": sum(e["extract_bytes"] for e in installs.values()),
+      "total_seconds": sum(seconds.values()),
+      "critical_path": critical_path,
+      "critical_path_seconds": critical_path_seconds,
+      "unknown": sorted(unknown),
+  }
+
+
+def format_plan_text(plan):
+  """Formats a plan from make_plan() for humans."""
+
+  def fmt_bytes(n):
+    return "{:.1f}MiB".format(n / (1024 * 1024))
+
+  def fmt_seconds(s):
+    return "unknown" if s is None else taskhistory.format_seconds(s)
+
+  lines = []
+  installs = plan["installs"]
+  for task_name in sorted(installs):
+    entry = installs[task_name]
+    state = entry["state"]
+    if state == STATE_INSTALLED:
+      detail = ""
+    elif state == STATE_BUILD:
+      detail = " {}".format(fmt_seconds(entry["seconds"]))
+      if entry.get("building_on"):
+        detail += " (being built on {})".format(entry["building_on"])
+    elif state == STATE_UNRESOLVED:
+      detail = ", build {} ({})".format(fmt_seconds(entry["seconds"]),
+                                        entry["error"])
+    else:
+      detail = ", fetch {}, extract {} ({})".format(
+          fmt_bytes(entry["fetch_bytes"]), fmt_bytes(entry["extract_bytes"]),
+          fmt_seconds(entry["seconds"]))
+    lines.append("  {}: {}{}".format(task_name, state, detail))
+  builds = [
+      e for e in installs.values()
+      if e["state"] in (STATE_BUILD, STATE_UNRESOLVED)
+  ]
+  lines.append("Fetch {}, extract {}, build {} of {} installs".format(
+      fmt_bytes(plan["fetch_bytes"]), fmt_bytes(plan["extract_bytes"]),
+      len(builds), len(installs)))
+  if plan["critical_path"]:
+    lines.append("Critical path {}: {}".format(
+        fmt_seconds(plan["critical_path_seconds"]),
+        " -> ".join(plan["critical_path"])))
+  lines.append("Total cost {}".format(fmt_seconds(plan["total_seconds"])))
+  if plan["unknown"]:
+    lines.append("No recorded build duration (counted as 0): {}".format(
+        ", ".join(plan["unknown"])))
+  return "\n".join(lines)
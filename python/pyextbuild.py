@@ -0,0 +1,273 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Builds python extension modules of a CMake build for more interpreters.
+
+A CMake build is configured for a single (primary) python interpreter, and
+almost all of it (i.e. the C++ core libraries) does not depend on which. So
+rather than configuring and building everything again per interpreter, the
+primary build is built once, then only the commands which depend on the
+interpreter are replayed for each other one:
+  - The commands are taken from the primary build ('ninja -t commands').
+  - Compile commands referencing the primary include dirs and link commands
+    producing modules with the primary extension suffix (or linking its
+    libraries) are selected.
+  - They are rewritten for the target interpreter, with outputs redirected
+    to a per-version output dir, and run concurrently (compiles across all
+    interpreters first, then links per interpreter in the original order).
+
+Everything else (objects and libraries of the core) is linked from the
+primary build as is.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shlex
+import shutil
+import subprocess
+
+import builder
+
+# Flags producing dependency files, which are not needed for a replay.
+_DEPFILE_FLAGS = ("-MD", "-MMD")
+_DEPFILE_ARG_FLAGS = ("-MT", "-MF", "-MQ")
+
+
+class ExtensionCommand:
+  """A command of the primary build which depends on the interpreter.
+
+  Commands may be compound (CMake link rules are ': && c++ ... && :'), so
+  are kept as a list of argument lists, run in order.
+  """
+
+  def __init__(self, parts, outputs, is_compile):
+    self.parts = parts
+    self.outputs = outputs
+    self.is_compile = is_compile
+
+  def __repr__(self):
+    return "ExtensionCommand({}, compile={})".format(self.outputs,
+                                                     self.is_compile)
+
+
+def get_variant_output_dir(build_dir, python_config):
+  """Gets the per-version output dir for an interpreter."""
+  return Path(build_dir).joinpath("python_variants", python_config.ident)
+
+
+def _get_outputs(args):
+  """Gets the outputs of a compile, link or archive command."""
+  for i, arg in enumerate(args[:-1]):
+    if arg == "-o":
+      return [args[i + 1]]
+  if os.path.basename(args[0]).endswith("ar") and len(args) > 2:
+    return [args[2]]
+  return []
+
+
+def _split_command(line):
+  """Splits a ninja command line into argument lists (None if unsupported)."""
+  parts = []
+  for part in line.split(" && "):
+    part = part.strip()
+    if part == ":":
+      continue
+    args = shlex.split(part)
+    # Custom commands (cd, shell constructs) are not compiles or links.
+    if not args or args[0] == "cd" or any(
+        token in part for token in (";", "|", ">", "<")):
+      return None
+    parts.append(args)
+  return parts
+
+
+def find_extension_commands(build_dir, primary_config):
+  """Finds the commands of the primary build which depend on its interpreter.
+
+  These are compiles with the primary include dirs, links with its
+  libraries or producing modules with its extension suffix, and anything
+  consuming their outputs (i.e. static archives). Returns a list of
+  ExtensionCommand in build order.
+  """
+  output = subprocess.check_output(
+      ["ninja", "-C", str(build_dir), "-t", "commands"]).decode("UTF-8")
+  include_dirs = [d for d in primary_config.include_dirs if d]
+  libraries = [l for l in primary_config.libraries if l]
+  extension = primary_config.extension
+  commands = []
+  rewritten_outputs = set()
+  for line in output.splitlines():
+    parts = _split_command(line)
+    if not parts:
+      continue
+    outputs = [o for args in parts for o in _get_outputs(args)]
+    if not outputs:
+      continue
+    is_compile = any("-c" in args for args in parts)
+    tokens = set(arg for args in parts for arg in args)
+    if is_compile:
+      selected = any(d in line for d in include_dirs)
+    else:
+      selected = (any(o.endswith(extension) for o in outputs) or
+                  any(l in line for l in libraries) or
+                  not tokens.isdisjoint(rewritten_outputs))
+    if selected:
+      commands.append(ExtensionCommand(parts, outputs, is_compile))
+      rewritten_outputs.update(outputs)
+  return commands
+
+
+def rewrite_command(command, build_dir, primary_config, target_config,
+                    rewritten_outputs):
+  """Rewrites a command of the primary build for the target interpreter.
+
+  Outputs of rewritten commands (in rewritten_outputs) are redirected to
+  the target's output dir, wherever they appear. Returns (parts, outputs).
+  """
+  out_dir = get_variant_output_dir(build_dir, target_config)
+  replacements = list(
+      zip(primary_config.include_dirs, target_config.include_dirs))
+  replacements.append(
+      (";".join(primary_config.libraries), ";".join(target_config.libraries)))
+  replacements.extend(zip(primary_config.libraries, target_config.libraries))
+  replacements.append((primary_config.extension, target_config.extension))
+  replacements = [(a, b) for a, b in replacements if a and a != b]
+
+  def rewrite_path(path):
+    rel_path = path
+    if os.path.isabs(path):
+      rel_path = os.path.relpath(path, build_dir)
+    for a, b in replacements:
+      rel_path = rel_path.replace(a, b)
+    return str(out_dir.joinpath(rel_path))
+
+  def rewrite_arg(arg):
+    if arg in rewritten_outputs:
+      return rewrite_path(arg)
+    for a, b in replacements:
+      arg = arg.replace(a, b)
+    return arg
+
+  parts = []
+  for part in command.parts:
+    args = []
+    skip_next = False
+    for arg in part:
+      if skip_next:
+        skip_next = False
+        continue
+      if arg in _DEPFILE_FLAGS:
+        continue
+      if arg in _DEPFILE_ARG_FLAGS:
+        skip_next = True
+        continue
+      args.append(rewrite_arg(arg))
+    parts.append(args)
+  return parts, [rewrite_path(o) for o in command.outputs]
+
+
+def build_variants(build_dir, primary_config, target_configs, max_workers=None):
+  """Builds the extension modules for each target interpreter.
+
+  Returns a dict of {target ident: [module paths]}.
+  """
+  build_dir = Path(build_dir)
+  commands = find_extension_commands(build_dir, primary_config)
+  if not any(
+      o.endswith(primary_config.extension)
+      for c in commands
+      for o in c.outputs):
+    raise RuntimeError(
+        "No python extension modules (*{}) found in build {}".format(
+            primary_config.extension, build_dir))
+  rewritten_outputs = set(o for c in commands for o in c.outputs)
+
+  plans = dict()
+  for target_config in target_configs:
+    out_dir = get_variant_output_dir(build_dir, target_config)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    plan = []
+    for command in commands:
+      parts, outputs = rewrite_command(command, build_dir, primary_config,
+                                       target_config, rewritten_outputs)
+      for output in outputs:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+      plan.append((command, parts, outputs))
+    plans[target_config.ident] = plan
+
+  def run(parts):
+    for args in parts:
+      builder.subcommand(args, cwd=build_dir)
+
+  with ThreadPoolExecutor(
+      max_workers=max_workers or os.cpu_count()) as executor:
+    # All compiles (of all interpreters) are independent.
+    compiles = [
+        executor.submit(run, parts)
+        for plan in plans.values()
+        for command, parts, _ in plan
+        if command.is_compile
+    ]
+    for future in compiles:
+      future.result()
+
+    # Links may depend on each other, so run in order per interpreter.
+    def link(plan):
+      outputs = []
+      for command, parts, command_outputs in plan:
+        if not command.is_compile:
+          run(parts)
+          outputs.extend(command_outputs)
+      return outputs
+
+    futures = {
+        ident: executor.submit(link, plan) for ident, plan in plans.items()
+    }
+    outputs = {ident: future.result() for ident, future in futures.items()}
+
+  # Only report extension modules (not intermediate libraries).
+  return {
+      target_config.ident: [
+          o
+          for o in outputs[target_config.ident]
+          if o.endswith(target_config.extension)
+      ] for target_config in target_configs
+  }
+
+
+def install_variants(install_dir, primary_config, target_configs,
+                     variant_modules):
+  """Installs variant modules next to the installed primary modules.
+
+  Extension suffixes differ per interpreter, so the modules for all of
+  them can live side by side in one install tree. Returns the installed
+  paths.
+  """
+  install_dir = Path(install_dir)
+  primary_modules = list(install_dir.rglob("*" + primary_config.extension))
+  installed = []
+  for target_config in target_configs:
+    built = {
+        os.path.basename(m): m for m in variant_modules[target_config.ident]
+    }
+    for primary_path in primary_modules:
+      stem = primary_path.name[:-len(primary_config.extension)]
+      module_name = stem + target_config.extension
+      if module_name not in built:
+        raise RuntimeError("No {} module built for {}".format(
+            module_name, target_config.ident))
+      dest = primary_path.parent.joinpath(module_name)
+      shutil.copy2(built[module_name], dest)
+      installed.append(dest)
+  return installed
@@ -96,6 +96,35 @@ def get_python_target_configs():
   return _PYTHON_TARGET_CONFIGS
 
 
+def get_python_target_names():
+  """Gets the names of the python targets, without probing interpreters.
+
+  Returns a list of (name, exe) with one entry per config that
+  get_python_target_configs() will return (when probed): On manylinux, the
+  name is that of the /opt/python dir (i.e. 'cp38-cp38'), and the enabled
+  ones are picked by their ABI tag. Otherwise, the only target is 'default'.
+  This is cheap enough to call when creating tasks.
+  """
+  if not is_manylinux_image():
+    return [("default", sys.executable)]
+  names = []
+  for exe in _get_manylinux_python_exes():
+    name = exe.parent.parent.name
+    # The ABI tag (i.e. 'cp37m') corresponds to the SOABI ('cpython-37m-...').
+    abi_tag = name.split("-")[-1]
+    if _MANYLINUX_IDENT_ENABLED.search(abi_tag.replace("cp", "cpython-", 1)):
+      names.append((name, str(exe)))
+  return names
+
+
+def get_python_target_config(exe):
+  """Gets the PythonTargetConfig of an exe from get_python_target_names()."""
+  for config in get_python_target_configs():
+    if os.path.realpath(config.exe) == os.path.realpath(exe):
+      return config
+  raise RuntimeError("No python target config for {}".format(exe))
+
+
 def pip_install(*packages):
   """Installs pip packages on all targets."""
   for config in get_python_target_configs():
@@ -0,0 +1,269 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schedules doit tasks on the longest dependency chain first.
+
+doit starts ready tasks in the order it discovers them (the order of the
+selected tasks and of each task_dep list), so with 'doit -n N' a short task
+can take a slot while a long chain (i.e. the LLVM build under an IREE build)
+waits. The SchedulingReporter (set as the reporter in DOIT_CONFIG):
+  - Estimates task durations from the task history (see taskhistory).
+  - Before any task starts, orders the selected tasks and every task_dep list
+    by the length of the longest chain through each task, so that doit
+    discovers (and starts) tasks on the critical path first.
+  - Records the duration of each executed task, and reports the predicted
+    (critical path) versus actual makespan of the run.
+
+Ordering from the reporter works because doit's TaskDispatcher only reads
+the selected tasks and task_dep lists once tasks start, which is after the
+reporter is initialized. That is checked for the doit versions in
+SUPPORTED_DOIT_VERSIONS (see tests/scheduler_test.py), and the build
+scripts pin one of them where they can. With other versions, doit's order is
+kept.
+
+Set MRT_SCHEDULER=0 to keep doit's order (history is still recorded).
+"""
+
+import os
+import time
+import traceback
+
+import doit
+from doit.reporter import ConsoleReporter
+
+import builder
+import taskhistory
+
+SCHEDULER_ENV_VAR = "MRT_SCHEDULER"
+# (major, minor) versions of doit which dispatch tasks in the order left by
+# SchedulingReporter.initialize.
+SUPPORTED_DOIT_VERSIONS = ((0, 36), (0, 37))
+
+
+def is_enabled():
+  return os.environ.get(SCHEDULER_ENV_VAR) != "0"
+
+
+def is_doit_version_supported():
+  return tuple(doit.__version__[:2]) in SUPPORTED_DOIT_VERSIONS
+
+
+def get_task_graph(tasks, selected_tasks, history):
+  """Gets the deps of the selected tasks and all they depend on.
+
+  Deps added by a calc_dep are only known once it ran, so the deps a task
+  ended up with last time are included. Returns {task name: [dep names]}.
+  """
+  graph = dict()
+  pending = list(selected_tasks)
+  while pending:
+    name = pending.pop()
+    if name in graph or name not in tasks:
+      continue
+    task = tasks[name]
+    deps = []
+    for dep in (list(task.task_dep) + list(task.setup_tasks) +
+                sorted(task.calc_dep) + list(history.task_deps.get(name, ()))):
+      if dep in tasks and dep not in deps:
+        deps.append(dep)
+    graph[name] = deps
+    pending.extend(deps)
+  return graph
+
+
+def _get_longest_chains(graph, seconds):
+  """Gets the longest chain of deps ending in each task.
+
+  Returns ({name: seconds}, {name: dep on that chain or None}).
+  """
+  lengths = dict()
+  next_deps = dict()
+  visiting = set()
+
+  def visit(name):
+    if name in lengths:
+      return lengths[name]
+    if name in visiting:
+      # A cycle, which doit reports itself.
+      return 0.0
+    visiting.add(name)
+    longest, longest_dep = 0.0, None
+    for dep in graph.get(name, ()):
+      length = visit(dep)
+      if length > longest:
+        longest, longest_dep = length, dep
+    visiting.discard(name)
+    lengths[name] = seconds.get(name, 0.0) + longest
+    next_deps[name] = longest_dep
+    return lengths[name]
+
+  for name in graph:
+    visit(name)
+  return lengths, next_deps
+
+
+def get_priorities(graph, seconds):
+  """Gets the length of the longest dependency chain through each task."""
+  down, _ = _get_longest_chains(graph, seconds)
+  dependents = dict()
+  for name, deps in graph.items():
+    for dep in deps:
+      dependents.setdefault(dep, []).append(name)
+  up, _ = _get_longest_chains(dependents, seconds)
+  return {
+      name: down[name] + up.get(name, 0.0) - seconds.get(name, 0.0)
+      for name in graph
+  }
+
+
+def get_critical_path(graph, seconds):
+  """Gets the longest chain of tasks, as (seconds, [names in run order])."""
+  lengths, next_deps = _get_longest_chains(graph, seconds)
+  if not lengths:
+    return 0.0, []
+  name = max(lengths, key=lambda n: lengths[n])
+  total = lengths[name]
+  path = []
+  while name is not None:
+    path.append(name)
+    name = next_deps[name]
+  path.reverse()
+  return total, path
+
+
+def order_tasks(tasks, selected_tasks, graph, priorities):
+  """Orders the selected tasks and task_dep lists by priority, in place."""
+
+  def key(name):
+    return -priorities.get(name, 0.0)
+
+  # Stable, so ties keep the order of the dodo file.
+  selected_tasks.sort(key=key)
+  for name in graph:
+    tasks[name].task_dep.sort(key=key)
+
+
+class SchedulingReporter(ConsoleReporter):
+  """Console reporter which schedules the critical path first.
+
+  See the module docstring.
+  """
+
+  desc = "console output, scheduling the critical path first"
+
+  def __init__(self, outstream, options):
+    super().__init__(outstream, options)
+    self._tasks = None
+    self._graph = dict()
+    self._history = None
+    self._predicted_seconds = None
+    self._start_time = None
+    self._task_start_times = dict()
+    self._task_seconds = dict()
+
+  def initialize(self, tasks, selected_tasks):
+    super().initialize(tasks, selected_tasks)
+    self._start_time = time.time()
+    self._tasks = tasks
+    try:
+      self._history = builder.get_task_history_store().summarize()
+    except:
+      print("Failed to read the task history (ignoring)")
+      traceback.print_exc()
+      self._history = taskhistory.TaskHistory(dict(), dict(), dict())
+    seconds = self._history.task_seconds
+    self._graph = get_task_graph(tasks, selected_tasks, self._history)
+    if is_enabled():
+      if is_doit_version_supported():
+        order_tasks(tasks, selected_tasks, self._graph,
+                    get_priorities(self._graph, seconds))
+      else:
+        self.write("Not scheduling: doit {} is not one of the tested "
+                   "versions {}\n".format(
+                       ".".join(str(v) for v in doit.__version__),
+                       SUPPORTED_DOIT_VERSIONS))
+    self._predicted_seconds, path = get_critical_path(self._graph, seconds)
+    unknown = [
+        name for name in self._graph
+        if tasks[name].actions and name not in seconds
+    ]
+    # Group tasks (without actions) take no time.
+    path = [name for name in path if tasks[name].actions]
+    if path and self._predicted_seconds > 0:
+      self.write("Predicted makespan {} (critical path: {})\n".format(
+          taskhistory.format_seconds(self._predicted_seconds),
+          " -> ".join(path)))
+    if unknown:
+      self.write("{} tasks have no recorded duration\n".format(len(unknown)))
+
+  def execute_task(self, task):
+    self._task_start_times[task.name] = time.time()
+    super().execute_task(task)
+
+  def _record_task(self, task, succeeded):
+    start_time = self._task_start_times.pop(task.name, None)
+    if start_time is None:
+      return
+    seconds = time.time() - start_time
+    self._task_seconds[task.name] = seconds
+    if not task.actions and not task.calc_dep:
+      return
+    fields = dict(name=task.name, seconds=seconds, succeeded=succeeded)
+    if task.calc_dep:
+      fields["task_dep"] = list(task.task_dep)
+    try:
+      builder.get_task_history_store().record("task", **fields)
+    except:
+      print("Failed to record duration of {} (ignoring)".format(task.name))
+      traceback.print_exc()
+
+  def add_success(self, task):
+    self._record_task(task, True)
+    super().add_success(task)
+
+  def add_failure(self, task, fail):
+    self._record_task(task, False)
+    super().add_failure(task, fail)
+
+  def complete_run(self):
+    super().complete_run()
+    if self._start_time is None or not self._task_seconds:
+      return
+    actual_seconds = time.time() - self._start_time
+    try:
+      # Tasks which were up-to-date or fetched from a cache took no time, so
+      # compare with the prediction for the tasks that ran.
+      seconds = {
+          name: s
+          for name, s in self._history.task_seconds.items()
+          if name in self._task_seconds
+      }
+      if not seconds:
+        self.write("Makespan: actual {} (no recorded durations to predict "
+                   "from)\n".format(taskhistory.format_seconds(actual_seconds)))
+        return
+      ran_seconds, _ = get_critical_path(self._graph, seconds)
+      self.write("Makespan: actual {}, predicted {} for the {} tasks that ran "
+                 "({} if all had run)\n".format(
+                     taskhistory.format_seconds(actual_seconds),
+                     taskhistory.format_seconds(ran_seconds),
+                     len(self._task_seconds),
+                     taskhistory.format_seconds(self._predicted_seconds or
+                                                0.0)))
+      builder.get_task_history_store().record("run",
+                                              actual_seconds=actual_seconds,
+                                              predicted_seconds=ran_seconds,
+                                              tasks=len(self._task_seconds))
+    except:
+      print("Failed to report makespan (ignoring)")
+      traceback.print_exc()
@@ -0,0 +1,114 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records the history of task executions.
+
+Events are appended as JSON lines to a history file under the build root
+(like cachestats, so concurrent doit processes can record). There are three
+kinds:
+  task: One per executed doit task, with its duration and the task_dep it
+    ended up with (which for tasks with a calc_dep are only known after it
+    ran).
+  resources: One per build command of an identifier (i.e. a cmake config or
+    build), with its wall and cpu seconds and peak RSS.
+  run: One per doit run, with its predicted and actual makespan.
+
+The scheduler (see scheduler.py) estimates task durations from the history.
+"""
+
+import json
+import os
+from pathlib import Path
+import time
+
+HISTORY_FILE_NAME = ".task_history.jsonl"
+# Durations are estimated from the most recent runs of a task.
+ESTIMATE_RUNS = 3
+
+
+class HistoryStore:
+  """Append-only store of task events."""
+
+  def __init__(self, path):
+    self.path = Path(path)
+
+  def record(self, kind, **fields):
+    event = dict(fields)
+    event["kind"] = kind
+    event["time"] = time.time()
+    line = json.dumps(event, sort_keys=True) + "\n"
+    os.makedirs(self.path.parent, exist_ok=True)
+    # Single appends of a short line are atomic enough for concurrent writers.
+    with open(self.path, "at", encoding="UTF-8") as f:
+      f.write(line)
+
+  def read_events(self):
+    if not self.path.exists():
+      return
+    with open(self.path, "rt", encoding="UTF-8") as f:
+      for line in f:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          # Tolerate a torn trailing line from an interrupted writer.
+          continue
+
+  def summarize(self):
+    """Summarizes events as a TaskHistory."""
+    task_seconds = dict()
+    task_deps = dict()
+    resources = dict()
+    for event in self.read_events():
+      kind = event.get("kind")
+      if kind == "task" and event.get("succeeded"):
+        task_seconds.setdefault(event["name"], []).append(event["seconds"])
+        if event.get("task_dep") is not None:
+          task_deps[event["name"]] = event["task_dep"]
+      elif kind == "resources":
+        r = resources.setdefault(event["identifier"], {
+            "commands": 0,
+            "seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "max_rss_bytes": 0,
+        })
+        r["commands"] += 1
+        r["seconds"] += event.get("seconds") or 0.0
+        r["cpu_seconds"] += event.get("cpu_seconds") or 0.0
+        r["max_rss_bytes"] = max(r["max_rss_bytes"],
+                                 event.get("max_rss_bytes") or 0)
+    return TaskHistory(
+        {
+            name: sum(s[-ESTIMATE_RUNS:]) / len(s[-ESTIMATE_RUNS:])
+            for name, s in task_seconds.items()
+        }, task_deps, resources)
+
+
+class TaskHistory:
+  """Summary of the history.
+
+  Attributes:
+    task_seconds: {task name: estimated seconds}.
+    task_deps: {task name: task_dep of its last successful run}.
+    resources: {identifier: totals of its build commands}.
+  """
+
+  def __init__(self, task_seconds, task_deps, resources):
+    self.task_seconds = task_seconds
+    self.task_deps = task_deps
+    self.resources = resources
+
+
+def format_seconds(seconds):
+  seconds = int(round(seconds))
+  return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60,
+                                   seconds % 60)
@@ -0,0 +1,198 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests checking out local bare repos (with a submodule) through a mirror.
+
+Run with: python -m unittest discover -s python/tests -p '*_test.py'
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import checkout
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+# Registers the sub repo (relative to the main repo's url) in the main repo.
+GITMODULES = """[submodule "sub"]
+	path = third_party/sub
+	url = ../sub.git
+"""
+
+
+def git(args, cwd):
+  env = dict(os.environ)
+  env.update(GIT_ENV)
+  return subprocess.run(["git"] + list(args),
+                        cwd=str(cwd),
+                        env=env,
+                        check=True,
+                        stdout=subprocess.PIPE).stdout.decode("UTF-8").strip()
+
+
+class CheckoutTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    root = Path(self.temp_dir.name)
+    self.upstream_dir = root.joinpath("upstream")
+    self.mirror_root = root.joinpath("mirror")
+    self.top_dir = root.joinpath("top")
+    self.sub_url = str(self.create_repo("sub", {"lib/sub.txt": "sub v1"}))
+    self.sub_rev = git(["rev-parse", "HEAD"], self.work_dir("sub"))
+    main_files = {"main.txt": "main v1", ".gitmodules": GITMODULES}
+    self.main_url = str(
+        self.create_repo("main",
+                         main_files,
+                         gitlinks={"third_party/sub": self.sub_rev}))
+    self.main_rev = git(["rev-parse", "HEAD"], self.work_dir("main"))
+    for name in ("main", "sub"):
+      git([
+          "clone", "--quiet", "--mirror",
+          str(self.upstream_dir.joinpath(name + ".git")),
+          str(self.mirror_root.joinpath(name + ".git"))
+      ], self.temp_dir.name)
+
+  def work_dir(self, name):
+    return self.upstream_dir.joinpath(name)
+
+  def create_repo(self, name, files, gitlinks=None):
+    """Creates a bare repo with one commit, returning its path."""
+    work_dir = self.work_dir(name)
+    bare_dir = self.upstream_dir.joinpath(name + ".git")
+    os.makedirs(work_dir)
+    git(["init", "--quiet", "--bare", str(bare_dir)], self.upstream_dir)
+    git(["init", "--quiet"], work_dir)
+    self.commit(work_dir, files, gitlinks)
+    git(["remote", "add", "origin", str(bare_dir)], work_dir)
+    git(["push", "--quiet", "origin", "HEAD:refs/heads/main"], work_dir)
+    git(["symbolic-ref", "HEAD", "refs/heads/main"], bare_dir)
+    return bare_dir
+
+  def commit(self, work_dir, files, gitlinks=None):
+    for path, text in files.items():
+      file_path = work_dir.joinpath(path)
+      os.makedirs(file_path.parent, exist_ok=True)
+      file_path.write_text(text)
+      git(["add", path], work_dir)
+    for path, rev in (gitlinks or {}).items():
+      git([
+          "update-index", "--add", "--cacheinfo", "160000,{},{}".format(
+              rev, path)
+      ], work_dir)
+    git(["commit", "--quiet", "-m", "update"], work_dir)
+    return git(["rev-parse", "HEAD"], work_dir)
+
+  def main_job(self, rev="main"):
+    return checkout.CheckoutJob(dest_dir=self.top_dir.joinpath("main"),
+                                url=self.main_url,
+                                rev=rev,
+                                label="main")
+
+  def test_resolve_url(self):
+    self.assertEqual(
+        checkout.resolve_url("https://host/org/main.git", "../sub.git"),
+        "https://host/org/sub.git")
+    self.assertEqual(checkout.resolve_url("https://host/org/main", "./sub.git"),
+                     "https://host/org/main/sub.git")
+    self.assertEqual(checkout.resolve_url(self.main_url, "/abs/sub.git"),
+                     "/abs/sub.git")
+
+  def test_list_submodules(self):
+    job = self.main_job()
+    checkout.materialize(job, self.mirror_root)
+    submodules = checkout.list_submodules(job.dest_dir, job.url)
+    self.assertEqual(len(submodules), 1)
+    self.assertEqual(submodules[0].url, self.sub_url)
+    self.assertEqual(submodules[0].rev, self.sub_rev)
+    self.assertEqual(submodules[0].dest_dir,
+                     job.dest_dir.joinpath("third_party", "sub"))
+    # Outside of the sparse checkout dirs.
+    self.assertEqual(checkout.list_submodules(job.dest_dir, job.url, ["docs"]),
+                     [])
+
+  def test_materialize_borrows_from_mirror(self):
+    job = self.main_job()
+    submodules = checkout.materialize(job, self.mirror_root)
+    self.assertEqual(git(["rev-parse", "HEAD"], job.dest_dir), self.main_rev)
+    self.assertEqual(job.dest_dir.joinpath("main.txt").read_text(), "main v1")
+    self.assertEqual(git(["remote", "get-url", "origin"], job.dest_dir),
+                     self.main_url)
+    alternates = job.dest_dir.joinpath(".git", "objects", "info",
+                                       "alternates").read_text()
+    self.assertIn(str(self.mirror_root.joinpath("main.git")), alternates)
+    self.assertEqual([s.label for s in submodules], ["main/third_party/sub"])
+
+  def test_materialize_fetches_rev_missing_from_mirror(self):
+    # Pushed upstream after the mirror was updated.
+    new_rev = self.commit(self.work_dir("main"), {"main.txt": "main v2"})
+    git(["push", "--quiet", "origin", "HEAD:refs/heads/main"],
+        self.work_dir("main"))
+    job = self.main_job(new_rev)
+    checkout.materialize(job, self.mirror_root)
+    self.assertEqual(git(["rev-parse", "HEAD"], job.dest_dir), new_rev)
+    self.assertEqual(job.dest_dir.joinpath("main.txt").read_text(), "main v2")
+
+  def test_checkout_all(self):
+    job = self.main_job()
+    timings = checkout.checkout_all([job],
+                                    mirror_root=self.mirror_root,
+                                    max_workers=2)
+    self.assertEqual(sorted(timings), ["main", "main/third_party/sub"])
+    sub_dir = job.dest_dir.joinpath("third_party", "sub")
+    self.assertEqual(git(["rev-parse", "HEAD"], sub_dir), self.sub_rev)
+    self.assertEqual(sub_dir.joinpath("lib", "sub.txt").read_text(), "sub v1")
+    # The nested clone is registered as the superproject's submodule.
+    self.assertEqual(git(["config", "submodule.sub.url"], job.dest_dir),
+                     self.sub_url)
+    self.assertEqual(
+        git(["submodule", "status"], job.dest_dir).split()[0].lstrip(" +-"),
+        self.sub_rev)
+
+  def test_checkout_all_is_idempotent(self):
+    job = self.main_job()
+    checkout.checkout_all([job], mirror_root=self.mirror_root)
+    timings = checkout.checkout_all([self.main_job()],
+                                    mirror_root=self.mirror_root)
+    self.assertEqual(sorted(timings), ["main", "main/third_party/sub"])
+    self.assertEqual(git(["rev-parse", "HEAD"], job.dest_dir), self.main_rev)
+
+  def test_checkout_all_reports_failures(self):
+    bad_job = checkout.CheckoutJob(
+        dest_dir=self.top_dir.joinpath("bad"),
+        url=str(self.upstream_dir.joinpath("missing.git")),
+        rev="main",
+        label="bad")
+    with self.assertRaisesRegex(checkout.CheckoutError, "bad"):
+      checkout.checkout_all([self.main_job(), bad_job],
+                            mirror_root=self.mirror_root)
+    # The other jobs still finish.
+    sub_dir = self.top_dir.joinpath("main", "third_party", "sub")
+    self.assertEqual(git(["rev-parse", "HEAD"], sub_dir), self.sub_rev)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,88 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks that doit dispatches tasks in the order left by the scheduler.
+
+Run with: python -m unittest discover -s python/tests -p '*_test.py'
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from doit.control import TaskControl
+from doit.dependency import Dependency, JsonDB
+from doit.reporter import ConsoleReporter
+from doit.runner import Runner
+from doit.task import Task
+
+import scheduler
+
+
+class OrderingReporter(ConsoleReporter):
+  """Orders tasks like SchedulingReporter, recording the execution order."""
+
+  def __init__(self, priorities):
+    super().__init__(io.StringIO(), {})
+    self.priorities = priorities
+    self.executed = []
+
+  def initialize(self, tasks, selected_tasks):
+    super().initialize(tasks, selected_tasks)
+    graph = {name: list(task.task_dep) for name, task in tasks.items()}
+    scheduler.order_tasks(tasks, selected_tasks, graph, self.priorities)
+
+  def execute_task(self, task):
+    self.executed.append(task.name)
+    super().execute_task(task)
+
+
+def noop():
+  return True
+
+
+class DispatchOrderTest(unittest.TestCase):
+
+  def run_tasks(self, tasks, selected_tasks, priorities):
+    with tempfile.TemporaryDirectory() as temp_dir:
+      dep_manager = Dependency(JsonDB, os.path.join(temp_dir, "doit.json"))
+      control = TaskControl(tasks)
+      control.process(selected_tasks)
+      reporter = OrderingReporter(priorities)
+      runner = Runner(dep_manager, reporter)
+      self.assertEqual(runner.run_all(control.task_dispatcher()), 0)
+      return reporter.executed
+
+  def test_doit_version_is_supported(self):
+    # A new doit version must be checked (by this test) before being added.
+    self.assertTrue(scheduler.is_doit_version_supported())
+
+  def test_selected_tasks_are_reordered(self):
+    tasks = [Task(name, [noop]) for name in ("a", "b", "c")]
+    executed = self.run_tasks(tasks, ["a", "b", "c"], {"c": 3.0, "b": 2.0})
+    self.assertEqual(executed, ["c", "b", "a"])
+
+  def test_task_deps_are_reordered(self):
+    tasks = [Task(name, [noop]) for name in ("x", "y", "z")]
+    tasks.append(Task("all", None, task_dep=["x", "y", "z"]))
+    executed = self.run_tasks(tasks, ["all"], {"z": 3.0, "x": 2.0})
+    self.assertEqual(executed, ["z", "x", "y", "all"])
+
+
+if __name__ == "__main__":
+  unittest.main()
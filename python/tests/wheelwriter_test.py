@@ -0,0 +1,162 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks wheels assembled by wheelwriter against setup.py bdist_wheel.
+
+Run with: python -m unittest discover -s python/tests -p '*_test.py'
+"""
+
+import importlib.util
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import wheelwriter
+
+# Packages files under TOY_PACKAGE_ROOT, like the pyiree setup.py files do
+# with the cmake build dir.
+SETUP_PY = """
+import os
+from setuptools import setup
+
+setup(name="toy-pkg",
+      version="1.2.3",
+      package_dir={"": os.environ["TOY_PACKAGE_ROOT"]},
+      packages=["toy", "toy.native"],
+      package_data={"toy.native": ["*.so"]},
+      install_requires=["numpy"],
+      extras_require={"test": ["pytest"]},
+      entry_points={"console_scripts": ["toy=toy:main"]},
+      zip_safe=False)
+"""
+TAG = "py3-none-any"
+
+
+def write_toy_wheel(egg_info_dir, package_root, dist_dir, cache_dir):
+  """Assembles the toy wheel, returning (wheel path, cache hits, misses)."""
+  egg_info = wheelwriter.read_egg_info(egg_info_dir)
+  rel_paths = wheelwriter.get_package_sources(egg_info, package_root,
+                                              os.path.dirname(egg_info_dir))
+  member_cache = wheelwriter.MemberCache(cache_dir)
+  wheel_path = wheelwriter.write_wheel(dist_dir,
+                                       name=egg_info.name,
+                                       version=egg_info.version,
+                                       tag=TAG,
+                                       files=wheelwriter.collect_files(
+                                           package_root, rel_paths),
+                                       metadata=egg_info.metadata,
+                                       dist_info_files=egg_info.dist_info_files,
+                                       member_cache=member_cache)
+  return wheel_path, member_cache.hits, member_cache.misses
+
+
+def write_toy_wheel_and_report(results, *args):
+  results.put(write_toy_wheel(*args))
+
+
+class WheelWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.root = Path(self.temp_dir.name)
+    self.package_root = self.root.joinpath("package")
+    self.setup_py = self.root.joinpath("setup.py")
+    self.setup_py.write_text(SETUP_PY)
+    native_dir = self.package_root.joinpath("toy", "native")
+    os.makedirs(native_dir)
+    self.package_root.joinpath(
+        "toy", "__init__.py").write_text("def main():\n  pass\n")
+    native_dir.joinpath("__init__.py").write_text("")
+    so_path = native_dir.joinpath("_toy.so")
+    # Larger than a deflate chunk.
+    so_path.write_bytes(
+        os.urandom(1024) * (wheelwriter.CHUNK_SIZE * 3 // 2 // 1024))
+    os.chmod(so_path, 0o755)
+
+  def setup(self, command, cwd):
+    os.makedirs(cwd, exist_ok=True)
+    env = dict(os.environ)
+    env["TOY_PACKAGE_ROOT"] = str(self.package_root)
+    subprocess.run([sys.executable, str(self.setup_py), "-q"] + command,
+                   cwd=str(cwd),
+                   env=env,
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+  def egg_info(self):
+    setup_dir = self.root.joinpath("egg_info")
+    self.setup(["egg_info", "--egg-base", "."], setup_dir)
+    return str(next(setup_dir.glob("*.egg-info")))
+
+  @unittest.skipUnless(importlib.util.find_spec("wheel"),
+                       "bdist_wheel needs the wheel package")
+  def test_matches_bdist_wheel(self):
+    wheel_path, _, _ = write_toy_wheel(self.egg_info(), str(self.package_root),
+                                       str(self.root.joinpath("direct")), None)
+    bdist_dir = self.root.joinpath("setuptools")
+    self.setup(["bdist_wheel"], bdist_dir)
+    reference_path = next(bdist_dir.joinpath("dist").glob("*.whl"))
+    self.assertEqual(os.path.basename(wheel_path), reference_path.name)
+    self.assertEqual(wheelwriter.compare_contents(wheel_path, reference_path),
+                     [])
+
+  def test_compare_reports_differences(self):
+    wheel_path, _, _ = write_toy_wheel(self.egg_info(), str(self.package_root),
+                                       str(self.root.joinpath("a")), None)
+    os.chmod(self.package_root.joinpath("toy", "native", "_toy.so"), 0o644)
+    self.package_root.joinpath("toy", "__init__.py").write_text("changed\n")
+    other_path, _, _ = write_toy_wheel(self.egg_info(), str(self.package_root),
+                                       str(self.root.joinpath("b")), None)
+    self.assertEqual(wheelwriter.compare_contents(wheel_path, other_path), [
+        "toy/__init__.py: contents differ",
+        "toy/native/_toy.so: executable in one wheel only",
+        "toy_pkg-1.2.3.dist-info/RECORD: contents differ",
+    ])
+
+  def test_member_cache_is_shared_across_processes(self):
+    egg_info_dir = self.egg_info()
+    cache_dir = str(self.root.joinpath("members"))
+    # Like the doit worker building the wheel for another interpreter.
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=write_toy_wheel_and_report,
+                              args=(results, egg_info_dir,
+                                    str(self.package_root),
+                                    str(self.root.joinpath("first")),
+                                    cache_dir))
+    process.start()
+    first_path, first_hits, first_misses = results.get(timeout=60)
+    process.join(10)
+    self.assertEqual((first_hits, first_misses), (0, 3))
+
+    second_path, hits, misses = write_toy_wheel(
+        egg_info_dir, str(self.package_root), str(self.root.joinpath("second")),
+        cache_dir)
+    self.assertEqual((hits, misses), (3, 0))
+    with zipfile.ZipFile(second_path) as z:
+      self.assertIsNone(z.testzip())
+    self.assertEqual(wheelwriter.compare_contents(first_path, second_path), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,131 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests the work queue with several processes sharing a temp directory.
+
+Run with: python -m unittest discover -s python/tests -p '*_test.py'
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import workqueue
+
+JOB_NAME = "llvm_0123"
+# Short, so that tests do not wait long for leases to expire.
+LEASE_SECONDS = 0.5
+
+
+def claim(shared_dir, owner, start_time, results):
+  """Claims the job once start_time is reached, reporting the result."""
+  queue = workqueue.WorkQueue(shared_dir,
+                              owner=owner,
+                              lease_seconds=LEASE_SECONDS)
+  time.sleep(max(start_time - time.time(), 0))
+  results.put((owner, queue.claim(JOB_NAME)))
+
+
+def hold_and_finish(shared_dir, hold_seconds, events):
+  """Claims and holds the job like a build, then finishes with it."""
+  queue = workqueue.WorkQueue(shared_dir,
+                              owner="builder",
+                              lease_seconds=LEASE_SECONDS)
+  claimed = queue.claim(JOB_NAME)
+  if claimed:
+    workqueue.hold_lease(queue, JOB_NAME)
+  events.put(("claimed", claimed))
+  time.sleep(hold_seconds)
+  workqueue.finish_lease(queue, JOB_NAME, "build failed")
+  events.put(("finished", None))
+
+
+class WorkQueueTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.shared_dir = self.temp_dir.name
+    self.context = multiprocessing.get_context("fork")
+    self.queue = workqueue.WorkQueue(self.shared_dir,
+                                     owner="poster",
+                                     lease_seconds=LEASE_SECONDS)
+    self.assertTrue(self.queue.post(JOB_NAME, task="llvm"))
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def start(self, target, *args):
+    process = self.context.Process(target=target, args=args)
+    process.start()
+    self.addCleanup(process.join, 10)
+    return process
+
+  def race_claims(self, count):
+    """Has count processes claim the job at once, returning the winners."""
+    results = self.context.Queue()
+    start_time = time.time() + 0.5
+    processes = [
+        self.start(claim, self.shared_dir, "owner{}".format(i), start_time,
+                   results) for i in range(count)
+    ]
+    outcomes = [results.get(timeout=10) for _ in processes]
+    return [owner for owner, claimed in outcomes if claimed]
+
+  def test_post_once(self):
+    self.assertFalse(self.queue.post(JOB_NAME, task="llvm"))
+
+  def test_one_claim_wins(self):
+    self.assertEqual(len(self.race_claims(8)), 1)
+
+  def test_expired_lease_taken_over_once(self):
+    self.assertTrue(self.queue.claim(JOB_NAME))
+    time.sleep(LEASE_SECONDS * 2)
+    winners = self.race_claims(8)
+    self.assertEqual(len(winners), 1)
+    self.assertEqual(self.queue.read_lease(JOB_NAME)["owner"], winners[0])
+
+  def test_held_lease_is_renewed_then_failed(self):
+    events = self.context.Queue()
+    self.start(hold_and_finish, self.shared_dir, LEASE_SECONDS * 4, events)
+    self.assertEqual(events.get(timeout=10), ("claimed", True))
+    # Well past the lease time, the builder still holds it.
+    time.sleep(LEASE_SECONDS * 2)
+    self.assertFalse(self.queue.claim(JOB_NAME))
+    self.assertEqual(self.queue.read_lease(JOB_NAME)["owner"], "builder")
+    # Finishing without publishing records the attempt and releases it.
+    self.assertEqual(events.get(timeout=10), ("finished", None))
+    job = self.queue.read_job(JOB_NAME)
+    self.assertEqual(job["attempts"], 1)
+    self.assertIn("build failed", job["last_error"])
+    self.assertIsNone(self.queue.read_lease(JOB_NAME))
+    self.assertTrue(self.queue.claim(JOB_NAME))
+
+  def test_completed_elsewhere_is_not_failed(self):
+    events = self.context.Queue()
+    self.start(hold_and_finish, self.shared_dir, LEASE_SECONDS * 2, events)
+    self.assertEqual(events.get(timeout=10), ("claimed", True))
+    # Another process (i.e. the publish task) completes the job.
+    self.queue.complete(JOB_NAME)
+    self.assertEqual(events.get(timeout=10), ("finished", None))
+    self.assertIsNone(self.queue.read_job(JOB_NAME))
+    self.assertIsNone(self.queue.read_lease(JOB_NAME))
+
+
+if __name__ == "__main__":
+  unittest.main()
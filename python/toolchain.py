@@ -0,0 +1,354 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Probes the host toolchain for the fastest working linker.
+
+CMake uses the default linker of the compiler, which on most hosts (i.e.
+dockcross manylinux2014) is GNU ld.bfd, and linking dominates incremental
+rebuilds of LLVM and IREE. The compilers that CMake will use (CC/CXX) are
+probed along with the alternative linkers (mold, lld, gold, fastest first)
+and split DWARF support:
+  - Each linker is verified by building a tiny project (a shared library and
+    an executable using it) with -fuse-ld and running the result.
+  - The result is cached under the build root, keyed by the identity of the
+    compilers and linkers found, so is only probed again when they change.
+The chosen linker is passed to CMake builds (see Toolchain.get_cmake_args).
+Probing only happens when a build is configured: cache keys include the
+toolchain settings (see get_key_data) rather than the probe result, so that
+hosts which only fetch from the cache never run a compiler. The probed
+toolchain is recorded in the metadata stored next to each cache archive.
+
+Set MRT_TOOLCHAIN=0 to build with the CMake defaults, or MRT_LINKER to one
+of the linkers (or 'default') to choose one.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+TOOLCHAIN_ENV_VAR = "MRT_TOOLCHAIN"
+LINKER_ENV_VAR = "MRT_LINKER"
+# Fastest first.
+LINKERS = ("mold", "lld", "gold")
+DEFAULT_LINKER = "default"
+PROBE_FILE_NAME = ".toolchain.json"
+# Bump to invalidate cached probe results.
+PROBE_VERSION = 1
+PROBE_TIMEOUT_SECONDS = 60
+# CMAKE_BUILD_TYPEs which produce debug info (so can split DWARF).
+DEBUG_INFO_BUILD_TYPES = ("Debug", "RelWithDebInfo")
+
+_LIB_SOURCE = r"""
+#include <string>
+std::string probe_message() { return "ok"; }
+"""
+_MAIN_SOURCE = r"""
+#include <iostream>
+#include <string>
+std::string probe_message();
+int main() { std::cout << probe_message() << std::endl; return 0; }
+"""
+
+_TOOLCHAIN = None
+
+
+class Toolchain:
+  """The result of a toolchain probe."""
+
+  def __init__(self,
+               *,
+               c_compiler,
+               cxx_compiler,
+               compiler_version,
+               linker=DEFAULT_LINKER,
+               working_linkers=(),
+               split_dwarf=False):
+    self.c_compiler = c_compiler
+    self.cxx_compiler = cxx_compiler
+    self.compiler_version = compiler_version
+    self.linker = linker
+    self.working_linkers = list(working_linkers)
+    self.split_dwarf = split_dwarf
+
+  def __repr__(self):
+    return "Toolchain({})".format(self.json_dict)
+
+  @property
+  def json_dict(self):
+    return {
+        "c_compiler": self.c_compiler,
+        "cxx_compiler": self.cxx_compiler,
+        "compiler_version": self.compiler_version,
+        "linker": self.linker,
+        "working_linkers": self.working_linkers,
+        "split_dwarf": self.split_dwarf,
+    }
+
+  @classmethod
+  def from_json_dict(cls, d):
+    return cls(**d)
+
+  def get_split_dwarf(self, build_type):
+    """Checks if split DWARF is used for a CMAKE_BUILD_TYPE."""
+    return self.split_dwarf and build_type in DEBUG_INFO_BUILD_TYPES
+
+  def get_cmake_args(self, build_type):
+    """Gets the cmake args selecting the linker and split DWARF.
+
+    LLVM_USE_LINKER is used by LLVM (and projects including its cmake
+    modules), which verifies it. Other projects get the linker through the
+    *_LINKER_FLAGS_INIT variables, which CMake combines with LDFLAGS rather
+    than replacing them. LLVM_USE_SPLIT_DWARF is only passed to build types
+    with debug info.
+    """
+    args = []
+    if self.linker != DEFAULT_LINKER:
+      flag = "-fuse-ld={}".format(self.linker)
+      args.append("-DLLVM_USE_LINKER={}".format(self.linker))
+      for kind in ("EXE", "SHARED", "MODULE"):
+        args.append("-DCMAKE_{}_LINKER_FLAGS_INIT={}".format(kind, flag))
+    if self.get_split_dwarf(build_type):
+      args.append("-DLLVM_USE_SPLIT_DWARF=ON")
+    return args
+
+  def get_version_data(self, build_type):
+    """Gets the part of the toolchain which affects build outputs."""
+    return json.dumps(
+        {
+            "compiler_version": self.compiler_version,
+            "linker": self.linker,
+            "split_dwarf": self.get_split_dwarf(build_type),
+        },
+        sort_keys=True)
+
+
+def is_enabled():
+  return os.environ.get(TOOLCHAIN_ENV_VAR) != "0"
+
+
+def get_key_data(build_type):
+  """Gets the toolchain settings which are part of cache keys.
+
+  Does not probe: the linker is the one chosen by MRT_LINKER, if any, and
+  split DWARF can only differ for build types with debug info.
+  """
+  return json.dumps(
+      {
+          "linker": os.environ.get(LINKER_ENV_VAR) or "auto",
+          "debug_info": build_type in DEBUG_INFO_BUILD_TYPES,
+      },
+      sort_keys=True)
+
+
+def get_compilers():
+  """Gets the (c, cxx) compilers that CMake will use."""
+  return (os.environ.get("CC") or "cc", os.environ.get("CXX") or "c++")
+
+
+def _get_fingerprint(c_compiler, cxx_compiler):
+  """Fingerprints the compilers and linkers on the PATH."""
+  parts = ["version={}".format(PROBE_VERSION)]
+  names = [c_compiler, cxx_compiler] + ["ld." + l for l in LINKERS] + ["ld"]
+  for name in names:
+    path = shutil.which(name)
+    if path is None:
+      parts.append("{}=".format(name))
+      continue
+    real_path = os.path.realpath(path)
+    st = os.stat(real_path)
+    parts.append("{}={}:{}:{}".format(name, real_path, st.st_size,
+                                      int(st.st_mtime)))
+  return hashlib.sha1("\n".join(parts).encode("UTF-8")).hexdigest()
+
+
+def _run(args, cwd):
+  return subprocess.run(args,
+                        cwd=str(cwd),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        timeout=PROBE_TIMEOUT_SECONDS)
+
+
+def get_compiler_version(compiler):
+  """Gets the first line of '--version' of a compiler (None if broken)."""
+  try:
+    result = _run([compiler, "--version"], cwd=".")
+  except (OSError, subprocess.TimeoutExpired):
+    return None
+  if result.returncode != 0:
+    return None
+  lines = result.stdout.decode("UTF-8", errors="replace").splitlines()
+  return lines[0].strip() if lines else None
+
+
+def probe_linker(cxx_compiler, linker, work_dir):
+  """Verifies a linker by building and running a tiny project with it."""
+  work_dir = Path(work_dir).joinpath(linker)
+  os.makedirs(work_dir, exist_ok=True)
+  work_dir.joinpath("lib.cpp").write_text(_LIB_SOURCE, encoding="UTF-8")
+  work_dir.joinpath("main.cpp").write_text(_MAIN_SOURCE, encoding="UTF-8")
+  link_flags = ([]
+                if linker == DEFAULT_LINKER else ["-fuse-ld={}".format(linker)])
+  commands = [
+      [cxx_compiler, "-fPIC", "-shared", "lib.cpp", "-o", "libprobe.so"] +
+      link_flags,
+      [
+          cxx_compiler, "main.cpp", "-o", "probe", "-L.", "-lprobe",
+          "-Wl,-rpath,$ORIGIN"
+      ] + link_flags,
+  ]
+  try:
+    for args in commands:
+      if _run(args, cwd=work_dir).returncode != 0:
+        return False
+    result = _run([str(work_dir.joinpath("probe"))], cwd=work_dir)
+  except (OSError, subprocess.TimeoutExpired):
+    return False
+  return result.returncode == 0 and result.stdout.strip() == b"ok"
+
+
+def probe_split_dwarf(cxx_compiler, linker, work_dir):
+  """Verifies that -gsplit-dwarf produces a .dwo file and links."""
+  work_dir = Path(work_dir).joinpath("split_dwarf")
+  os.makedirs(work_dir, exist_ok=True)
+  work_dir.joinpath("main.cpp").write_text(_LIB_SOURCE +
+                                           "int main() { return 0; }\n",
+                                           encoding="UTF-8")
+  link_flags = ([]
+                if linker == DEFAULT_LINKER else ["-fuse-ld={}".format(linker)])
+  try:
+    if _run([cxx_compiler, "-g", "-gsplit-dwarf", "-c", "main.cpp"],
+            cwd=work_dir).returncode != 0:
+      return False
+    if not work_dir.joinpath("main.dwo").exists():
+      return False
+    return _run([cxx_compiler, "main.o", "-o", "main"] + link_flags,
+                cwd=work_dir).returncode == 0
+  except (OSError, subprocess.TimeoutExpired):
+    return False
+
+
+def probe_toolchain():
+  """Probes the compilers and linkers, returning a Toolchain."""
+  c_compiler, cxx_compiler = get_compilers()
+  c_version = get_compiler_version(c_compiler)
+  cxx_version = get_compiler_version(cxx_compiler)
+  if c_version is None or cxx_version is None:
+    raise RuntimeError("Compilers {} and {} do not work".format(
+        c_compiler, cxx_compiler))
+  with tempfile.TemporaryDirectory(prefix="mrt_toolchain_") as work_dir:
+    if not probe_linker(cxx_compiler, DEFAULT_LINKER, work_dir):
+      raise RuntimeError(
+          "Compiler {} cannot build a trivial program".format(cxx_compiler))
+    working_linkers = [
+        linker for linker in LINKERS
+        if probe_linker(cxx_compiler, linker, work_dir)
+    ]
+    linker = working_linkers[0] if working_linkers else DEFAULT_LINKER
+    split_dwarf = probe_split_dwarf(cxx_compiler, linker, work_dir)
+  return Toolchain(c_compiler=c_compiler,
+                   cxx_compiler=cxx_compiler,
+                   compiler_version=cxx_version,
+                   linker=linker,
+                   working_linkers=working_linkers,
+                   split_dwarf=split_dwarf)
+
+
+def load_or_probe_toolchain(probe_file, force=False):
+  """Gets the toolchain from the probe file, probing if it is stale."""
+  c_compiler, cxx_compiler = get_compilers()
+  fingerprint = _get_fingerprint(c_compiler, cxx_compiler)
+  probe_file = Path(probe_file)
+  if not force:
+    try:
+      d = json.loads(probe_file.read_text(encoding="UTF-8"))
+      if d.get("fingerprint") == fingerprint:
+        return Toolchain.from_json_dict(d["toolchain"])
+    except (OSError, ValueError, KeyError, TypeError):
+      pass
+  print("Probing toolchain ({}, {})".format(c_compiler, cxx_compiler))
+  tc = probe_toolchain()
+  print("Toolchain: linker={} (working: {}), split_dwarf={}".format(
+      tc.linker, ", ".join(tc.working_linkers) or "none", tc.split_dwarf))
+  os.makedirs(probe_file.parent, exist_ok=True)
+  tmp_file = probe_file.parent.joinpath("." + probe_file.name + ".tmp")
+  tmp_file.write_text(json.dumps(
+      {
+          "fingerprint": fingerprint,
+          "toolchain": tc.json_dict
+      },
+      indent=2,
+      sort_keys=True),
+                      encoding="UTF-8")
+  tmp_file.rename(probe_file)
+  return tc
+
+
+def get_toolchain(probe_file):
+  """Gets the (memoized) toolchain, or None if disabled.
+
+  Probing runs compilers, so this must only be called when a task executes,
+  not when tasks are loaded.
+  """
+  global _TOOLCHAIN
+  if not is_enabled():
+    return None
+  if _TOOLCHAIN is None:
+    tc = load_or_probe_toolchain(probe_file)
+    linker = os.environ.get(LINKER_ENV_VAR)
+    if linker:
+      if linker != DEFAULT_LINKER and linker not in tc.working_linkers:
+        raise ValueError("{}={} is not a working linker (of {})".format(
+            LINKER_ENV_VAR, linker, tc.working_linkers))
+      tc.linker = linker
+    _TOOLCHAIN = tc
+  return _TOOLCHAIN
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="toolchain",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--probe-file",
+                      help="Cached probe result",
+                      type=str,
+                      default=os.path.join("build", PROBE_FILE_NAME))
+  parser.add_argument("--build-type",
+                      help="CMAKE_BUILD_TYPE to print the cmake args for",
+                      type=str,
+                      default="Release")
+  parser.add_argument("--force",
+                      help="Probe again, ignoring a cached result",
+                      action="store_true")
+  return parser
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  tc = load_or_probe_toolchain(parser.probe_file, force=parser.force)
+  print(json.dumps(tc.json_dict, indent=2, sort_keys=True))
+  print("CMake args:", " ".join(tc.get_cmake_args(parser.build_type)))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
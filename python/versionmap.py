@@ -0,0 +1,93 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reads the pinned dep versions of VERSION_MAP.txt.
+
+Pipelines resolve the version map once (pipeline_init_version_map.sh), then
+every step checks out exactly those commits. With the commits known up
+front, cache keys of clean checkouts can be derived without checking out
+(see cacher.read_git_state).
+
+The version map is a whitespace separated list of 'name=rev' (or 'name:rev')
+entries, where name is either the path of a dep (i.e.
+'external/llvm-project') or its last component.
+"""
+
+import os
+from pathlib import Path
+import re
+
+import builder
+
+VERSION_MAP_ENV_VAR = "MRT_VERSION_MAP_FILE"
+VERSION_MAP_FILE_NAME = "VERSION_MAP.txt"
+
+_COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+
+_VERSION_MAP = None
+
+
+def get_version_map_file():
+  env_value = os.environ.get(VERSION_MAP_ENV_VAR)
+  if env_value:
+    return Path(env_value)
+  else:
+    return builder.TOP_DIR.joinpath(VERSION_MAP_FILE_NAME)
+
+
+def parse_version_map(text):
+  """Parses version map text into a dict of {name: rev}."""
+  version_map = dict()
+  for token in text.split():
+    m = re.match(r"^([^=:]+)[=:](.+)$", token)
+    if m:
+      version_map[m.group(1)] = m.group(2)
+  return version_map
+
+
+def load_version_map():
+  """Loads the (memoized) version map, which is empty if there is none."""
+  global _VERSION_MAP
+  if _VERSION_MAP is None:
+    try:
+      _VERSION_MAP = parse_version_map(
+          get_version_map_file().read_text(encoding="UTF-8"))
+    except FileNotFoundError:
+      _VERSION_MAP = dict()
+  return _VERSION_MAP
+
+
+def get_pinned_rev(src_dir):
+  """Gets the rev that the version map pins a source dir to (or None)."""
+  version_map = load_version_map()
+  src_dir = Path(src_dir)
+  names = [src_dir.name]
+  try:
+    names.insert(0, src_dir.relative_to(builder.TOP_DIR).as_posix())
+  except ValueError:
+    pass
+  for name in names:
+    if name in version_map:
+      return version_map[name]
+  return None
+
+
+def get_pinned_commit(src_dir):
+  """Gets the full commit hash a source dir is pinned to (or None).
+
+  Symbolic revs (i.e. branch names) are not pinned, as they can move.
+  """
+  rev = get_pinned_rev(src_dir)
+  if rev is not None and _COMMIT_RE.match(rev):
+    return rev
+  return None
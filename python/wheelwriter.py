@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Assembles wheels directly from file manifests.
+
+This replaces 'setup.py bdist_wheel', which copies the package tree into a
+build directory and then deflates every file single threaded, once per
+interpreter. Here:
+  - Files are taken in place, with sizes and sha256 hashes (for RECORD)
+    computed in parallel by manifest.hash_files.
+  - Members are deflated in parallel, in chunks (each chunk is compressed
+    independently and ends on a sync flush, so concatenated they form one
+    valid deflate stream).
+  - Compressed members are remembered by content hash in a MemberCache and
+    copied from the wheel that first contained them (or from the cache dir,
+    when shared between processes), so files shared between the wheels for
+    each interpreter are only compressed once.
+  - Output is deterministic: sorted members, fixed timestamps and
+    normalized permissions, with the .dist-info last and RECORD at the end.
+
+The file list and metadata come from a 'setup.py egg_info' run (which is
+cheap): SOURCES.txt lists the files setuptools would package, PKG-INFO and
+requires.txt are converted to METADATA, and the other metadata files (i.e.
+entry_points.txt) are carried over to the .dist-info, as bdist_wheel does. So
+wheel contents stay in sync with the project's setup.py.
+
+This file can also be run as a script to compare the contents of two wheels
+(i.e. from this writer and from setuptools).
+"""
+
+import argparse
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import csv
+import email.generator
+import email.parser
+import email.policy
+import hashlib
+import io
+import os
+import re
+import struct
+import sys
+import textwrap
+import zipfile
+import zlib
+
+import manifest
+
+GENERATOR = "mlir-release-tools wheelwriter"
+DEFAULT_COMPRESS_LEVEL = 6
+CHUNK_SIZE = 1024 * 1024
+# Zip timestamps can not precede 1980.
+DEFAULT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Egg-info files which bdist_wheel does not carry over to the .dist-info.
+EGG_INFO_SKIPPED_FILES = ("PKG-INFO", "requires.txt", "SOURCES.txt",
+                          "not-zip-safe")
+
+_LOCAL_HEADER_FORMAT = "<4s5HLLLHH"
+_CENTRAL_HEADER_FORMAT = "<4s6HLLLHHHHHLL"
+_END_FORMAT = "<4s4HLLH"
+_ZIP32_LIMIT = 0xFFFFFFFF
+# Header of members stored by a MemberCache (their crc32).
+_MEMBER_HEADER_FORMAT = "<L"
+_MEMBER_HEADER_SIZE = struct.calcsize(_MEMBER_HEADER_FORMAT)
+
+
+def normalize_dist_name(name):
+  """Normalizes a project name as used in wheel and dist-info names."""
+  return re.sub(r"[^\w\d.]+", "_", name, flags=re.UNICODE)
+
+
+def get_wheel_tag_script():
+  """Gets python source printing the wheel tag of the running interpreter.
+
+  Run with each target interpreter (which may not be this one).
+  """
+  return r"""
+import sys
+import sysconfig
+v = "{}{}".format(*sys.version_info[:2])
+abi_flags = ""
+if sysconfig.get_config_var("Py_DEBUG"):
+  abi_flags += "d"
+if sys.version_info < (3, 8) and sysconfig.get_config_var("WITH_PYMALLOC"):
+  abi_flags += "m"
+platform = sysconfig.get_platform().replace("-", "_").replace(".", "_")
+print("cp{}-cp{}{}-{}".format(v, v, abi_flags, platform))
+"""
+
+
+def _urlsafe_digest(hex_digest):
+  return base64.urlsafe_b64encode(
+      bytes.fromhex(hex_digest)).rstrip(b"=").decode("ascii")
+
+
+def _dos_date_time(date_time):
+  year, month, day, hour, minute, second = date_time
+  return ((hour << 11) | (minute << 5) | (second // 2),
+          ((year - 1980) << 9) | (month << 5) | day)
+
+
+def _deflate_chunk(data, level, final):
+  c = zlib.compressobj(level, zlib.DEFLATED, -15)
+  return c.compress(data) + c.flush(
+      zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class MemberCache:
+  """Compressed members of previously written wheels, by content.
+
+  Locations are kept ({(sha256, level): (path, offset, crc32, compressed
+  size)}), so wheels must not be moved or removed while the cache is in use.
+  With a cache_dir, compressed members are also stored there by content (as
+  <level>/<sha256[:2]>/<sha256>: crc32 then the deflated data), which shares
+  them with other processes, i.e. the doit workers building the wheels for
+  other interpreters.
+  """
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self.entries = dict()
+    self.hits = 0
+    self.misses = 0
+
+  def get_member_path(self, sha256, level):
+    return os.path.join(self.cache_dir, str(level), sha256[:2], sha256)
+
+  def get(self, sha256, level):
+    entry = self.entries.get((sha256, level))
+    if entry is None and self.cache_dir is not None:
+      entry = self._load(sha256, level)
+    if entry is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+    return entry
+
+  def put(self, sha256, level, wheel_path, offset, crc, csize, chunks=()):
+    self.entries[(sha256, level)] = (str(wheel_path), offset, crc, csize)
+    if self.cache_dir is not None:
+      self._store(sha256, level, crc, chunks)
+
+  def read(self, entry):
+    wheel_path, offset, _, csize = entry
+    with open(wheel_path, "rb") as f:
+      f.seek(offset)
+      return f.read(csize)
+
+  def _load(self, sha256, level):
+    path = self.get_member_path(sha256, level)
+    try:
+      with open(path, "rb") as f:
+        header = f.read(_MEMBER_HEADER_SIZE)
+        csize = os.fstat(f.fileno()).st_size - _MEMBER_HEADER_SIZE
+    except FileNotFoundError:
+      return None
+    if len(header) != _MEMBER_HEADER_SIZE:
+      return None
+    crc, = struct.unpack(_MEMBER_HEADER_FORMAT, header)
+    entry = (path, _MEMBER_HEADER_SIZE, crc, csize)
+    self.entries[(sha256, level)] = entry
+    return entry
+
+  def _store(self, sha256, level, crc, chunks):
+    path = self.get_member_path(sha256, level)
+    if os.path.exists(path):
+      return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per process, then renamed: Concurrent writers store the same data.
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+      f.write(struct.pack(_MEMBER_HEADER_FORMAT, crc))
+      for chunk in chunks:
+        f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class EggInfo(
+    namedtuple("EggInfo", "name,version,metadata,dist_info_files,sources")):
+  """Information read from an egg-info dir.
+
+  metadata: METADATA text.
+  dist_info_files: {name: text} of other files for the .dist-info (i.e.
+    top_level.txt and entry_points.txt).
+  sources: Paths listed in SOURCES.txt.
+  """
+  pass
+
+
+def collect_files(root_dir, rel_paths, *, max_workers=None):
+  """Collects files under root_dir for a wheel.
+
+  Returns a sorted list of (arcname, path, mode, size, sha256), hashing in
+  parallel.
+  """
+  hashes = manifest.hash_files(root_dir, list(rel_paths), max_workers)
+  files = []
+  for rel_path, sha256 in hashes.items():
+    path = os.path.join(root_dir, rel_path)
+    if sha256 is None:
+      raise OSError("Could not read {}".format(path))
+    st = os.stat(path)
+    mode = 0o755 if st.st_mode & 0o111 else 0o644
+    files.append((rel_path.replace(os.sep,
+                                   "/"), path, mode, st.st_size, sha256))
+  files.sort()
+  return files
+
+
+def get_package_sources(egg_info, package_root, base_dir):
+  """Lists SOURCES.txt entries under package_root, relative to it.
+
+  Relative entries are resolved against base_dir (where setup.py ran).
+  """
+  package_root = os.path.realpath(package_root)
+  rel_paths = []
+  for source in egg_info.sources:
+    path = os.path.realpath(os.path.join(base_dir, source))
+    if path.startswith(package_root + os.sep) and os.path.isfile(path):
+      rel_paths.append(os.path.relpath(path, package_root))
+  return rel_paths
+
+
+def _read_requires_sections(requires_path):
+  """Reads requires.txt as a list of (section, [requirements])."""
+  sections = []
+  section = None
+  requirements = []
+  with open(requires_path, "rt", encoding="UTF-8") as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      m = re.match(r"^\[(.*)\]$", line)
+      if m:
+        if section is not None or requirements:
+          sections.append((section, requirements))
+        section = m.group(1)
+        requirements = []
+      else:
+        requirements.append(line)
+  if section is not None or requirements:
+    sections.append((section, requirements))
+  return sections
+
+
+def read_egg_info(egg_info_dir):
+  """Reads an egg-info dir, converting its metadata to METADATA.
+
+  This follows what bdist_wheel does (see wheel's pkginfo_to_metadata and
+  egg2dist): PKG-INFO headers are kept (with the long description dedented
+  into the body), requires.txt becomes Requires-Dist/Provides-Extra headers
+  (by sorted section) and the other files are carried over, except for an
+  empty dependency_links.txt.
+  """
+  with open(os.path.join(egg_info_dir, "PKG-INFO"), "rt",
+            encoding="UTF-8") as f:
+    pkg_info = email.parser.Parser().parse(f)
+  pkg_info.replace_header("Metadata-Version", "2.1")
+  # Requirements are regenerated from requires.txt.
+  del pkg_info["Provides-Extra"]
+  del pkg_info["Requires-Dist"]
+  requires_path = os.path.join(egg_info_dir, "requires.txt")
+  if os.path.exists(requires_path):
+    sections = _read_requires_sections(requires_path)
+    for section, requirements in sorted(sections, key=lambda s: s[0] or ""):
+      extra, _, marker = (section or "").partition(":")
+      condition = ""
+      if extra:
+        if ("Provides-Extra", extra) not in pkg_info.items():
+          pkg_info["Provides-Extra"] = extra
+        if marker:
+          # As canonicalized by packaging: Only compound markers keep the
+          # parentheses.
+          compound = " and " in marker or " or " in marker
+          condition = ("({}) and " if compound else "{} and ").format(marker)
+        condition += 'extra == "{}"'.format(extra)
+      elif marker:
+        condition = marker
+      for requirement in requirements:
+        if condition:
+          requirement = "{}; {}".format(requirement, condition)
+        if ("Requires-Dist", requirement) not in pkg_info.items():
+          pkg_info["Requires-Dist"] = requirement
+
+  description = pkg_info["Description"]
+  if description:
+    # Older setuptools put the description in a header, with continuation
+    # lines indented.
+    lines = description.splitlines()
+    pkg_info.set_payload("\n".join(
+        (lines[0].lstrip(), textwrap.dedent("\n".join(lines[1:])), "\n")))
+    del pkg_info["Description"]
+  metadata = io.StringIO()
+  policy = email.policy.EmailPolicy(utf8=True,
+                                    mangle_from_=False,
+                                    max_line_length=0)
+  email.generator.Generator(metadata, policy=policy).flatten(pkg_info)
+
+  dist_info_files = dict()
+  sources = []
+  for file_name in sorted(os.listdir(egg_info_dir)):
+    path = os.path.join(egg_info_dir, file_name)
+    if file_name == "SOURCES.txt":
+      with open(path, "rt", encoding="UTF-8") as f:
+        sources = [line.strip() for line in f if line.strip()]
+    if file_name in EGG_INFO_SKIPPED_FILES or not os.path.isfile(path):
+      continue
+    with open(path, "rt", encoding="UTF-8") as f:
+      text = f.read()
+    if file_name == "dependency_links.txt" and not text.strip():
+      continue
+    dist_info_files[file_name] = text
+  return EggInfo(pkg_info["Name"], pkg_info["Version"], metadata.getvalue(),
+                 dist_info_files, sources)
+
+
+class _ZipWriter:
+  """Minimal zip writer for pre-compressed (deflated) members."""
+
+  def __init__(self, f, date_time):
+    self.f = f
+    self.dos_time, self.dos_date = _dos_date_time(date_time)
+    self.central = []
+
+  def write_member(self, arcname, mode, crc, csize, usize, data):
+    name = arcname.encode("UTF-8")
+    offset = self.f.tell()
+    if offset >= _ZIP32_LIMIT or csize >= _ZIP32_LIMIT or usize >= _ZIP32_LIMIT:
+      raise ValueError("Zip64 wheels are not supported: {}".format(arcname))
+    # General purpose flag 0x800: names are UTF-8.
+    self.f.write(
+        struct.pack(_LOCAL_HEADER_FORMAT, b"PK\x03\x04", 20, 0x800,
+                    zipfile.ZIP_DEFLATED, self.dos_time, self.dos_date, crc,
+                    csize, usize, len(name), 0))
+    self.f.write(name)
+    data_offset = self.f.tell()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+      self.f.write(data)
+    else:
+      for chunk in data:
+        self.f.write(chunk)
+    self.central.append((name, mode, crc, csize, usize, offset))
+    return data_offset
+
+  def finish(self):
+    central_offset = self.f.tell()
+    for name, mode, crc, csize, usize, offset in self.central:
+      self.f.write(
+          struct.pack(_CENTRAL_HEADER_FORMAT, b"PK\x01\x02", (3 << 8) | 20, 20,
+                      0x800, zipfile.ZIP_DEFLATED, self.dos_time, self.dos_date,
+                      crc, csize, usize, len(name), 0, 0, 0, 0,
+                      ((0o100000 | mode) << 16), offset))
+      self.f.write(name)
+    central_size = self.f.tell() - central_offset
+    if len(self.central) >= 0xFFFF or central_offset >= _ZIP32_LIMIT:
+      raise ValueError("Zip64 wheels are not supported")
+    self.f.write(
+        struct.pack(_END_FORMAT, b"PK\x05\x06", 0, 0, len(self.central),
+                    len(self.central), central_size, central_offset, 0))
+
+
+def write_wheel(dist_dir,
+                *,
+                name,
+                version,
+                tag,
+                files,
+                metadata,
+                dist_info_files=None,
+                root_is_purelib=None,
+                member_cache=None,
+                level=DEFAULT_COMPRESS_LEVEL,
+                date_time=DEFAULT_DATE_TIME,
+                max_workers=None):
+  """Writes a wheel into dist_dir, returning its path.
+
+  files: As returned by collect_files().
+  metadata: Text of the METADATA file (see read_egg_info).
+  dist_info_files: {name: text} of other .dist-info files (see read_egg_info).
+  root_is_purelib: Defaults to whether the tag is platform independent (as
+    bdist_wheel only tags pure wheels so).
+  """
+  dist_name = normalize_dist_name(name)
+  dist_version = normalize_dist_name(version)
+  dist_info = "{}-{}.dist-info".format(dist_name, dist_version)
+  wheel_path = os.path.join(dist_dir,
+                            "{}-{}-{}.whl".format(dist_name, dist_version, tag))
+  if max_workers is None:
+    max_workers = os.cpu_count() or 1
+  max_pending = 4 * max_workers
+  if root_is_purelib is None:
+    root_is_purelib = tag.endswith("-none-any")
+
+  wheel_text = ("Wheel-Version: 1.0\n"
+                "Generator: {}\n"
+                "Root-Is-Purelib: {}\n"
+                "Tag: {}\n"
+                "\n").format(GENERATOR, "true" if root_is_purelib else "false",
+                             tag)
+  dist_info_texts = dict(dist_info_files or {})
+  dist_info_texts["METADATA"] = metadata
+  dist_info_texts["WHEEL"] = wheel_text
+  dist_info_members = [(dist_info + "/" + file_name, dist_info_texts[file_name])
+                       for file_name in sorted(dist_info_texts)]
+
+  record = io.StringIO()
+  record_writer = csv.writer(record, lineterminator="\n")
+  os.makedirs(dist_dir, exist_ok=True)
+  tmp_path = os.path.join(dist_dir, "." + os.path.basename(wheel_path) + ".tmp")
+  with open(tmp_path, "wb") as f, \
+      ThreadPoolExecutor(max_workers=max_workers) as executor:
+    writer = _ZipWriter(f, date_time)
+    # Members in flight: (file tuple, crc, [futures]) or (file tuple, entry).
+    pending = deque()
+    pending_chunks = 0
+
+    def write_oldest():
+      nonlocal pending_chunks
+      item = pending.popleft()
+      arcname, path, mode, size, sha256 = item[0]
+      if len(item) == 2:
+        _, crc, csize = item[1][1:]
+        if item[1][0] == tmp_path:
+          # Duplicate contents within this wheel.
+          f.flush()
+        data = member_cache.read(item[1])
+        writer.write_member(arcname, mode, crc, csize, size, data)
+      else:
+        _, crc, futures = item
+        pending_chunks -= len(futures)
+        chunks = [future.result() for future in futures]
+        csize = sum(len(chunk) for chunk in chunks)
+        data_offset = writer.write_member(arcname, mode, crc, csize, size,
+                                          chunks)
+        if member_cache is not None:
+          member_cache.put(sha256, level, tmp_path, data_offset, crc, csize,
+                           chunks)
+      record_writer.writerow(
+          [arcname, "sha256=" + _urlsafe_digest(sha256), size])
+
+    for file in files:
+      arcname, path, mode, size, sha256 = file
+      entry = (member_cache.get(sha256, level)
+               if member_cache is not None else None)
+      if entry is not None:
+        pending.append((file, entry))
+      else:
+        crc = 0
+        futures = []
+        with open(path, "rb") as mf:
+          while True:
+            block = mf.read(CHUNK_SIZE)
+            crc = zlib.crc32(block, crc)
+            final = len(block) < CHUNK_SIZE
+            futures.append(executor.submit(_deflate_chunk, block, level, final))
+            if final:
+              break
+        pending.append((file, crc, futures))
+        pending_chunks += len(futures)
+      while pending_chunks > max_pending:
+        write_oldest()
+    while pending:
+      write_oldest()
+
+    for arcname, text in dist_info_members:
+      data = text.encode("UTF-8")
+      compressed = _deflate_chunk(data, level, True)
+      writer.write_member(arcname, 0o644, zlib.crc32(data), len(compressed),
+                          len(data), compressed)
+      record_writer.writerow([
+          arcname,
+          "sha256=" + _urlsafe_digest(hashlib.sha256(data).hexdigest()),
+          len(data)
+      ])
+    record_writer.writerow([dist_info + "/RECORD", "", ""])
+    record_data = record.getvalue().encode("UTF-8")
+    compressed = _deflate_chunk(record_data, level, True)
+    writer.write_member(dist_info + "/RECORD", 0o644, zlib.crc32(record_data),
+                        len(compressed), len(record_data), compressed)
+    writer.finish()
+  os.replace(tmp_path, wheel_path)
+  if member_cache is not None:
+    # Members were recorded against the temporary name.
+    for key, entry in member_cache.entries.items():
+      if entry[0] == tmp_path:
+        member_cache.entries[key] = (wheel_path,) + entry[1:]
+  return wheel_path
+
+
+def compare_contents(wheel_path_a, wheel_path_b):
+  """Compares the contents of two wheels.
+
+  Member data must match, except for the Generator of WHEEL (and so its
+  RECORD line) and the order of RECORD lines, as must whether members are
+  executable. Returns a list of human readable differences.
+  """
+
+  def read_all(wheel_path):
+    contents = dict()
+    executables = set()
+    with zipfile.ZipFile(wheel_path) as z:
+      for info in z.infolist():
+        data = z.read(info)
+        name = info.filename
+        if info.external_attr >> 16 & 0o111:
+          executables.add(name)
+        if name.endswith(".dist-info/WHEEL"):
+          data = b"\n".join(line for line in data.splitlines()
+                            if not line.startswith(b"Generator:"))
+        elif name.endswith(".dist-info/RECORD"):
+          # The WHEEL hash differs with the Generator.
+          data = b"\n".join(
+              sorted(line for line in data.splitlines()
+                     if b".dist-info/WHEEL," not in line))
+        contents[name] = data
+    return contents, executables
+
+  contents_a, executables_a = read_all(wheel_path_a)
+  contents_b, executables_b = read_all(wheel_path_b)
+  differences = []
+  for name in sorted(set(contents_a) | set(contents_b)):
+    if name not in contents_b:
+      differences.append("{}: only in {}".format(name, wheel_path_a))
+    elif name not in contents_a:
+      differences.append("{}: only in {}".format(name, wheel_path_b))
+    elif contents_a[name] != contents_b[name]:
+      differences.append("{}: contents differ".format(name))
+    elif (name in executables_a) != (name in executables_b):
+      differences.append("{}: executable in one wheel only".format(name))
+  return differences
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="wheelwriter",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  compare_parser = subparsers.add_parser(
+      "compare", help="Checks that two wheels have equivalent contents")
+  compare_parser.add_argument("wheel", type=str)
+  compare_parser.add_argument("other_wheel", type=str)
+  return parser
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  if parser.command == "compare":
+    differences = compare_contents(parser.wheel, parser.other_wheel)
+    for difference in differences:
+      print(difference)
+    print("EQUIVALENT" if not differences else "DIFFERENT")
+    return 1 if differences else 0
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
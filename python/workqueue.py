@@ -0,0 +1,391 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Queue of cache builds, shared by builders over the shared cache dir.
+
+With MRT_CACHE_QUEUE=1, builders sharing $MRT_SHARED_CACHE_DIR (i.e. over
+NFS) cooperate on installs that none of them has cached:
+  - A pipeline posts a job for each cache entry it misses, named like the
+    archive it needs ('<cache_key>_<version_hash>').
+  - Whoever gets to a job first claims a lease on it, builds it and
+    publishes the archive to the shared cache dir, which completes the job.
+    A pipeline which needs an entry that is being built elsewhere waits for
+    it to land instead of building it again.
+  - Idle builders run 'doit cache_worker' to claim jobs posted by others.
+
+Jobs live under '.queue' in the shared cache dir:
+  jobs/<name>.json: The job (task name, identifier, version hash, attempts).
+  leases/<name>@<generation>.json: The owner of a claimed job and when its
+    lease expires.
+Files are created with os.link (atomic even over NFS), so exactly one
+builder can post a job or claim a generation of its lease. The process
+which claimed a job renews its lease (see hold_lease) until the job is
+completed or it gives up on it (see finish_lease), so the job is claimed
+again if the owner dies.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+
+SHARED_CACHE_DIR_ENV_VAR = "MRT_SHARED_CACHE_DIR"
+QUEUE_ENV_VAR = "MRT_CACHE_QUEUE"
+# Identifies the lease owner. Set for the doit run of a worker, so that it
+# builds the job its parent claimed instead of waiting for it.
+OWNER_ENV_VAR = "MRT_QUEUE_OWNER"
+LEASE_SECONDS_ENV_VAR = "MRT_QUEUE_LEASE_SECONDS"
+DEFAULT_LEASE_SECONDS = 300
+POLL_SECONDS_ENV_VAR = "MRT_QUEUE_POLL_SECONDS"
+DEFAULT_POLL_SECONDS = 10.0
+# Jobs which failed this many times are left to the pipelines posting them.
+MAX_ATTEMPTS = 2
+QUEUE_DIR_NAME = ".queue"
+
+# (WorkQueue, job name) of leases held by this process, renewed by a
+# background thread until the job is completed (by any process) or
+# finish_lease is called.
+_HELD_LEASES = set()
+_HELD_LEASES_LOCK = threading.Lock()
+_RENEWER = None
+
+
+def get_shared_cache_dir():
+  env_value = os.environ.get(SHARED_CACHE_DIR_ENV_VAR)
+  return Path(env_value) if env_value else None
+
+
+def is_enabled():
+  return (os.environ.get(QUEUE_ENV_VAR) == "1" and
+          get_shared_cache_dir() is not None)
+
+
+def get_owner():
+  env_value = os.environ.get(OWNER_ENV_VAR)
+  if env_value:
+    return env_value
+  return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def get_lease_seconds():
+  env_value = os.environ.get(LEASE_SECONDS_ENV_VAR)
+  return float(env_value) if env_value else DEFAULT_LEASE_SECONDS
+
+
+def get_poll_seconds():
+  env_value = os.environ.get(POLL_SECONDS_ENV_VAR)
+  return float(env_value) if env_value else DEFAULT_POLL_SECONDS
+
+
+def _write_json(path, d):
+  """Writes a JSON file atomically, replacing any existing one."""
+  tmp_path = path.parent.joinpath(".{}.{}.tmp".format(path.name,
+                                                      uuid.uuid4().hex))
+  tmp_path.write_text(json.dumps(d, sort_keys=True), encoding="UTF-8")
+  tmp_path.rename(path)
+
+
+def _create_json(path, d):
+  """Creates a JSON file atomically, returning False if it exists."""
+  tmp_path = path.parent.joinpath(".{}.{}.tmp".format(path.name,
+                                                      uuid.uuid4().hex))
+  tmp_path.write_text(json.dumps(d, sort_keys=True), encoding="UTF-8")
+  try:
+    os.link(str(tmp_path), str(path))
+    return True
+  except FileExistsError:
+    return False
+  finally:
+    tmp_path.unlink()
+
+
+def _read_json(path):
+  try:
+    return json.loads(path.read_text(encoding="UTF-8"))
+  except (OSError, ValueError):
+    return None
+
+
+def copy_file(src_path, dest_dir):
+  """Copies a file into a dir (hardlinking if possible), unless it exists.
+
+  The file appears atomically. Returns whether it was copied.
+  """
+  dest_path = Path(dest_dir).joinpath(Path(src_path).name)
+  if dest_path.exists():
+    return False
+  os.makedirs(dest_path.parent, exist_ok=True)
+  tmp_path = dest_path.parent.joinpath(".{}.{}.tmp".format(
+      dest_path.name,
+      uuid.uuid4().hex))
+  try:
+    os.link(str(src_path), str(tmp_path))
+  except OSError:
+    shutil.copyfile(str(src_path), str(tmp_path))
+  tmp_path.rename(dest_path)
+  return True
+
+
+class WorkQueue:
+  """The queue of cache builds in a shared cache dir."""
+
+  def __init__(self, shared_cache_dir, *, owner=None, lease_seconds=None):
+    self.queue_dir = Path(shared_cache_dir).joinpath(QUEUE_DIR_NAME)
+    self.owner = owner if owner is not None else get_owner()
+    self.lease_seconds = (lease_seconds
+                          if lease_seconds is not None else get_lease_seconds())
+    self.jobs_dir = self.queue_dir.joinpath("jobs")
+    self.leases_dir = self.queue_dir.joinpath("leases")
+    os.makedirs(self.jobs_dir, exist_ok=True)
+    os.makedirs(self.leases_dir, exist_ok=True)
+
+  def _job_path(self, name):
+    return self.jobs_dir.joinpath(name + ".json")
+
+  def _lease_path(self, name, generation):
+    return self.leases_dir.joinpath("{}@{}.json".format(name, generation))
+
+  def _list_lease_generations(self, name):
+    prefix = name + "@"
+    generations = []
+    with os.scandir(self.leases_dir) as it:
+      for entry in it:
+        if entry.name.startswith(prefix) and entry.name.endswith(".json"):
+          try:
+            generations.append(int(entry.name[len(prefix):-len(".json")]))
+          except ValueError:
+            pass
+    return sorted(generations)
+
+  def _read_current_lease(self, name):
+    """Reads the newest lease of a job, as (generation, lease or None)."""
+    for generation in reversed(self._list_lease_generations(name)):
+      lease = _read_json(self._lease_path(name, generation))
+      if lease is not None:
+        return generation, lease
+    return 0, None
+
+  def post(self, name, **fields):
+    """Posts a job, returning False if it was already posted."""
+    job = dict(fields)
+    job.update(name=name, posted_by=self.owner, posted=time.time(), attempts=0)
+    return _create_json(self._job_path(name), job)
+
+  def read_job(self, name):
+    return _read_json(self._job_path(name))
+
+  def list_jobs(self):
+    """Lists job names, oldest first."""
+    jobs = []
+    for path in self.jobs_dir.glob("*.json"):
+      try:
+        jobs.append((path.stat().st_mtime, path.name[:-len(".json")]))
+      except OSError:
+        # Completed meanwhile.
+        pass
+    return [name for _, name in sorted(jobs)]
+
+  def read_lease(self, name):
+    """Reads the live lease of a job (None if unclaimed or expired)."""
+    _, lease = self._read_current_lease(name)
+    if lease is None or lease.get("expires", 0) < time.time():
+      return None
+    return lease
+
+  def claim(self, name):
+    """Claims a job, returning whether this owner holds its lease now.
+
+    A lease which this owner holds already (i.e. claimed by the parent of a
+    worker's doit run) counts as claimed. An expired lease is taken over by
+    creating the next generation of it, which only one claimer can do.
+    """
+    generation, lease = self._read_current_lease(name)
+    if lease is not None:
+      if lease.get("owner") == self.owner:
+        return self.renew(name)
+      if lease.get("expires", 0) >= time.time():
+        return False
+      print("Lease of {} by {} expired".format(name, lease.get("owner")))
+    if not _create_json(self._lease_path(name, generation + 1), {
+        "owner": self.owner,
+        "expires": time.time() + self.lease_seconds,
+    }):
+      return False
+    for old_generation in self._list_lease_generations(name):
+      if old_generation <= generation:
+        try:
+          self._lease_path(name, old_generation).unlink()
+        except FileNotFoundError:
+          pass
+    return True
+
+  def renew(self, name):
+    """Extends the lease of a job, if this owner still holds it."""
+    generation, lease = self._read_current_lease(name)
+    if lease is None or lease.get("owner") != self.owner:
+      return False
+    lease["expires"] = time.time() + self.lease_seconds
+    _write_json(self._lease_path(name, generation), lease)
+    return True
+
+  def release(self, name):
+    """Releases the lease of a job, if this owner holds it."""
+    generation, lease = self._read_current_lease(name)
+    if lease is not None and lease.get("owner") == self.owner:
+      try:
+        self._lease_path(name, generation).unlink()
+      except FileNotFoundError:
+        pass
+
+  def complete(self, name):
+    """Removes a job whose result was published."""
+    paths = [self._job_path(name)] + [
+        self._lease_path(name, generation)
+        for generation in self._list_lease_generations(name)
+    ]
+    for path in paths:
+      try:
+        path.unlink()
+      except FileNotFoundError:
+        pass
+
+  def fail(self, name, message):
+    """Records a failed attempt at a job and releases its lease."""
+    job = self.read_job(name)
+    if job is not None:
+      job["attempts"] = job.get("attempts", 0) + 1
+      job["last_error"] = "{}: {}".format(self.owner, message)
+      _write_json(self._job_path(name), job)
+    self.release(name)
+
+  def is_failed(self, job):
+    return job.get("attempts", 0) >= MAX_ATTEMPTS
+
+
+def _renew_held_leases():
+  while True:
+    with _HELD_LEASES_LOCK:
+      held = list(_HELD_LEASES)
+    for queue, name in held:
+      try:
+        if not queue.renew(name):
+          # Completed (i.e. published by another process of the run) or
+          # taken over.
+          drop_lease(queue, name)
+      except OSError as e:
+        print("Failed to renew lease of {} (ignoring): {}".format(name, e))
+    # Renew well before the shortest lease expires.
+    time.sleep(
+        min([queue.lease_seconds for queue, _ in held],
+            default=DEFAULT_LEASE_SECONDS) / 5.0)
+
+
+def hold_lease(queue, name):
+  """Keeps renewing a claimed lease until it is no longer held.
+
+  Must be called by the process which claimed the job, which must call
+  finish_lease once it is done with the job (successfully or not).
+  """
+  global _RENEWER
+  with _HELD_LEASES_LOCK:
+    _HELD_LEASES.add((queue, name))
+    if _RENEWER is None:
+      _RENEWER = threading.Thread(target=_renew_held_leases, daemon=True)
+      _RENEWER.start()
+
+
+def drop_lease(queue, name):
+  """Stops renewing a lease (without releasing it)."""
+  with _HELD_LEASES_LOCK:
+    _HELD_LEASES.discard((queue, name))
+
+
+def finish_lease(queue, name, message):
+  """Stops renewing a lease held by this process, failing an unfinished job.
+
+  The job is unfinished if it was not completed (by any process), in which
+  case the attempt is recorded and the lease released, so others retry it.
+  A lease inherited from the parent (see OWNER_ENV_VAR) is left to it.
+  """
+  with _HELD_LEASES_LOCK:
+    if (queue, name) not in _HELD_LEASES:
+      return
+    _HELD_LEASES.discard((queue, name))
+  if os.environ.get(OWNER_ENV_VAR) == queue.owner:
+    return
+  if queue.read_job(name) is not None:
+    print("Giving up on {}: {}".format(name, message))
+    queue.fail(name, message)
+
+
+def format_status(queue):
+  """Formats the jobs of a queue for humans."""
+  lines = []
+  for name in queue.list_jobs():
+    job = queue.read_job(name)
+    if job is None:
+      continue
+    lease = queue.read_lease(name)
+    if lease is not None:
+      state = "building on {} (lease {:.0f}s)".format(
+          lease["owner"], lease["expires"] - time.time())
+    elif queue.is_failed(job):
+      state = "failed: {}".format(job.get("last_error"))
+    else:
+      state = "waiting"
+    lines.append("{} [{}] posted by {}, {} attempts: {}".format(
+        name, job.get("task"), job.get("posted_by"), job.get("attempts", 0),
+        state))
+  return "\n".join(lines) if lines else "No jobs"
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="workqueue",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--shared-cache-dir",
+                      help="Shared cache directory",
+                      type=str,
+                      default=os.environ.get(SHARED_CACHE_DIR_ENV_VAR))
+  parser.add_argument("--clear-failed",
+                      help="Removes jobs which failed too often",
+                      action="store_true")
+  return parser
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  if not parser.shared_cache_dir:
+    print("No shared cache dir (set {})".format(SHARED_CACHE_DIR_ENV_VAR))
+    return 1
+  queue = WorkQueue(parser.shared_cache_dir)
+  if parser.clear_failed:
+    for name in queue.list_jobs():
+      job = queue.read_job(name)
+      if job is not None and queue.is_failed(job):
+        print("Removing failed job", name)
+        queue.complete(name)
+  print(format_status(queue))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
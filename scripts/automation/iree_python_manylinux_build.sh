@@ -26,7 +26,7 @@ else
   export PATH=/opt/python/cp38-cp38/bin:$PATH
   # TODO: Revert once https://github.com/google/iree/issues/2645 resolved.
   export IREE_LLVMAOT_LINKER_PATH="$(which ld)"
-  python -m pip install doit
+  python -m pip install doit==0.36.0
   doit iree_python_deps
   doit iree_default
 fi
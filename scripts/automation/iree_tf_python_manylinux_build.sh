@@ -24,7 +24,7 @@ else
   set -x
   df -h
   export PATH=/opt/python/cp38-cp38/bin:$PATH
-  python -m pip install doit
+  python -m pip install doit==0.36.0
   doit iree_python_deps
   doit iree_tf_default
 fi
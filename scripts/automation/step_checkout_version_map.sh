@@ -3,6 +3,14 @@
 # Typically a pipeline will start by running pipeline_init_version_map.sh
 # to resolve concrete revisions for all subsequent steps. Then this script
 # will read the version map from VERSION_MAP.txt and checkout/set it.
+#
+# Arguments are optional doit tasks that the step will run. If given, the
+# checkout is skipped entirely when all of the installs they need are
+# already cached (see the cache_plan_checkout task), and otherwise only the
+# deps needed to build are checked out.
+#
+# Deps are checked out concurrently from the local mirror by
+# python/checkout.py. Set MRT_CHECKOUT_TOOL=mmr to use mmr instead.
 set -e
 
 function die() {
@@ -16,6 +24,28 @@ VERSION_MAP=""
 if [ -f "VERSION_MAP.txt" ]; then
   VERSION_MAP="$(cat VERSION_MAP.txt)"
 fi
+CHECKOUT_PATHS=""
+if [ "$#" -gt 0 ]; then
+  echo "PLANNING CHECKOUT FOR: $@"
+  echo "--------------------------"
+  if python3 -m doit cache_plan_checkout --output ./CHECKOUT_PLAN.txt "$@"; then
+    if [ ! -s ./CHECKOUT_PLAN.txt ]; then
+      echo "All installs are cached: Skipping checkout"
+      exit 0
+    fi
+    CHECKOUT_PATHS="$(cat ./CHECKOUT_PLAN.txt)"
+  fi
+fi
+if [ "${MRT_CHECKOUT_TOOL:-native}" == "native" ]; then
+  echo "CHECKING OUT: ${CHECKOUT_PATHS:-all deps}"
+  echo "-------------"
+  python3 ./python/checkout.py \
+    --mirror="$HOME/.mrtmirror" \
+    --timings-file=./CHECKOUT_TIMINGS.json \
+    --status-file=./VERSION_STATUS.txt \
+    $CHECKOUT_PATHS
+  exit 0
+fi
 echo "INITIALIZING REPO. VERSION_MAP=$VERSION_MAP"
 ./mmr init --local-mirror="$HOME/.mrtmirror"
 echo "CHECKING OUT:"
@@ -30,11 +30,23 @@ on the host which can hold cache artifacts (and is size limited). In the
 more complicated scenario, there is also a cloud repo that changes can
 be pushed to (and will be fetched from opportunistically as needed, as part
 of the build). The latter is not yet implemented.
+
+Cache archives may be deltas against a base archive. Pruning never removes
+a base that a retained delta still needs: a delta is retained together with
+its whole base chain or not at all. The metadata files of an archive are
+pruned together with it.
 """
 
 import argparse
 import os
 import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                 os.pardir, "python"))
+import archive
 
 
 def create_argument_parser():
@@ -101,23 +113,112 @@ def do_push(parser):
   # Prune shared cache dir.
   size_limit_mb = parser.size_limit_mb
   if size_limit_mb > 0:
-    size_limit_bytes = size_limit_mb * 1024 * 1024
-    existing_files = list()
-    with os.scandir(shared_cache_dir) as it:
-      for entry in it:
-        if not entry.is_file():
-          continue
-        file_path = os.path.join(shared_cache_dir, entry.name)
-        stat = entry.stat()
-        existing_files.append((file_path, stat.st_mtime_ns, stat.st_size))
-    # Sort by mtime
-    existing_files.sort(key=lambda t: t[1], reverse=True)
-    cum_size = 0
-    for file_path, _, size in existing_files:
-      cum_size += size
-      if cum_size > size_limit_bytes:
+    prune(shared_cache_dir, size_limit_mb * 1024 * 1024)
+
+
+def read_delta_bases(cache_dir, names):
+  """Reads {archive name: base archive name} for the delta archives."""
+  bases = dict()
+  for name in names:
+    if not name.endswith(".mrta"):
+      continue
+    try:
+      with archive.ArchiveReader(os.path.join(cache_dir, name)) as reader:
+        if reader.base_name is not None:
+          bases[name] = reader.base_name
+    except (OSError, archive.ArchiveError) as e:
+      print("Could not read archive {} (ignoring): {}".format(name, e))
+  return bases
+
+
+# Metadata stored next to each archive (<stem>.mrta), which is useless
+# without it.
+COMPANION_SUFFIXES = (".manifest.json", ".json")
+# Metadata may be published before its archive, so only prune metadata
+# without an archive once it is older than this.
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+
+def get_archive_name(name):
+  """Gets the name of the archive a file belongs to (None if not known)."""
+  if name.endswith(".mrta"):
+    return name
+  for suffix in COMPANION_SUFFIXES:
+    if name.endswith(suffix):
+      return name[:-len(suffix)] + ".mrta"
+  return None
+
+
+def prune(cache_dir, size_limit_bytes):
+  """Prunes least recently used archives over the size limit.
+
+  An archive and its metadata files are a unit: they are retained or pruned
+  together, by the mtime of the archive and their combined size. Units are
+  retained most recent first. A delta archive is retained along with any
+  bases not already retained, and only if all of them fit. Metadata files
+  whose archive is gone are pruned after ORPHAN_GRACE_SECONDS.
+  """
+  existing_files = dict()
+  with os.scandir(cache_dir) as it:
+    for entry in it:
+      if not entry.is_file():
+        continue
+      stat = entry.stat()
+      existing_files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+  bases = read_delta_bases(cache_dir, existing_files.keys())
+
+  # Group files into units keyed by archive name (or by their own name).
+  units = dict()
+  for name in existing_files:
+    archive_name = get_archive_name(name)
+    units.setdefault(archive_name or name, []).append(name)
+
+  def get_unit_mtime(unit_name):
+    if unit_name in existing_files:
+      return existing_files[unit_name][0]
+    return max(existing_files[n][0] for n in units[unit_name])
+
+  # Sort by mtime
+  unit_names = sorted(units, key=get_unit_mtime, reverse=True)
+  retained = set()
+  orphaned = set()
+  now = time.time()
+  cum_size = 0
+  for unit_name in unit_names:
+    if unit_name in retained:
+      continue
+    if unit_name not in existing_files:
+      # Metadata without its archive (yet, if recent).
+      if now - get_unit_mtime(unit_name) / 1e9 > ORPHAN_GRACE_SECONDS:
+        orphaned.add(unit_name)
+      else:
+        retained.add(unit_name)
+      continue
+    chain = [unit_name]
+    while chain[-1] in bases and bases[chain[-1]] not in chain:
+      chain.append(bases[chain[-1]])
+    if chain[-1] not in existing_files:
+      # A delta whose base is gone is useless.
+      orphaned.add(unit_name)
+      continue
+    needed = [n for n in chain if n not in retained]
+    cum_size += sum(existing_files[f][1] for n in needed for f in units[n])
+    if cum_size > size_limit_bytes:
+      break
+    retained.update(needed)
+
+  for unit_name in unit_names:
+    if unit_name in retained:
+      continue
+    for name in sorted(units[unit_name]):
+      file_path = os.path.join(cache_dir, name)
+      if unit_name not in existing_files:
+        print("Pruning cache metadata with missing archive:", file_path)
+      elif unit_name in orphaned:
+        print("Pruning cache file with missing base:", file_path)
+      else:
         print("Pruning cache file over limit:", file_path)
-        os.unlink(file_path)
+      os.unlink(file_path)
 
 
 def do_pull(parser):
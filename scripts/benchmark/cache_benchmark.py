@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the install cache and the cache sync script.
+
+Generates a synthetic install tree shaped like an LLVM install (many small
+headers, a few large static libs and some symlinks) and a cache dir of many
+small (full and delta) archives, then times:
+  version_hash: Computing the version hash of a chain of InstallCaches.
+  manifest: Writing the (content hashed) manifest of the install.
+  archive_create: Creating the cache archive of the install.
+  archive_extract: Expanding the cache archive into the install dir.
+  install_is_ok_stat/_content: Verifying the install, per verify mode.
+  sync_push/sync_pull: sync_cache.py --push/--pull of the cache dir.
+  sync_prune: Pruning the shared cache dir to half its size.
+
+Results are written as JSON (with the git commit of the repo), so that runs
+on different commits can be compared. Each benchmark is timed --runs times,
+after untimed setup.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                 os.pardir))
+sys.path.insert(0, os.path.join(REPO_DIR, "python"))
+sys.path.insert(0, os.path.join(REPO_DIR, "scripts", "automation"))
+
+BENCHMARKS = (
+    "version_hash",
+    "manifest",
+    "archive_create",
+    "archive_extract",
+    "install_is_ok_stat",
+    "install_is_ok_content",
+    "sync_push",
+    "sync_pull",
+    "sync_prune",
+)
+
+# Headers are generated from declarations like these, so that they compress
+# about as well as real ones.
+_HEADER_LINE = ("  virtual const ::llvm::{0}Impl *get{0}{1}(unsigned Index, "
+                "::llvm::ArrayRef<Value *> Operands) const = 0;\n")
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="cache_benchmark",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--headers",
+                      help="Number of headers in the install tree",
+                      type=int,
+                      default=20000)
+  parser.add_argument("--header-kb",
+                      help="Mean size of a header in KiB",
+                      type=int,
+                      default=4)
+  parser.add_argument("--static-libs",
+                      help="Number of static libs in the install tree",
+                      type=int,
+                      default=8)
+  parser.add_argument("--static-lib-mb",
+                      help="Size of a static lib in MiB",
+                      type=int,
+                      default=32)
+  parser.add_argument("--entries",
+                      help="Number of archives in the synced cache dir",
+                      type=int,
+                      default=2000)
+  parser.add_argument("--entry-kb",
+                      help="Size of an archive in the synced cache dir in KiB",
+                      type=int,
+                      default=16)
+  parser.add_argument("--key-depth",
+                      help="Length of the InstallCache chain for version_hash",
+                      type=int,
+                      default=200)
+  parser.add_argument("--runs",
+                      help="Number of timed runs of each benchmark",
+                      type=int,
+                      default=3)
+  parser.add_argument("--only",
+                      help="Comma separated benchmarks to run (default all)",
+                      type=str,
+                      default="")
+  parser.add_argument("--work-dir",
+                      help="Directory to generate trees in (default a temp "
+                      "dir). Benchmarks measure its filesystem.",
+                      type=str,
+                      default="")
+  parser.add_argument("--output",
+                      help="File to write the JSON results to (default "
+                      "stdout)",
+                      type=str,
+                      default="")
+  return parser
+
+
+def read_git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                   cwd=REPO_DIR,
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def generate_install_tree(root_dir, *, headers, header_kb, static_libs,
+                          static_lib_mb):
+  """Generates an LLVM-like install tree, returning (files, bytes)."""
+  files = 0
+  total_bytes = 0
+  # LLVM spreads its headers over a few hundred directories.
+  dirs_count = max(1, headers // 64)
+  for i in range(headers):
+    header_dir = os.path.join(root_dir, "include", "llvm",
+                              "Dir{}".format(i % dirs_count))
+    os.makedirs(header_dir, exist_ok=True)
+    # Vary sizes between 1/4 and 7/4 of the mean.
+    size = header_kb * 1024 * (1 + i % 7) // 4
+    lines = []
+    line_bytes = 0
+    j = 0
+    while line_bytes < size:
+      line = _HEADER_LINE.format("Type{}".format(i), j)
+      lines.append(line)
+      line_bytes += len(line)
+      j += 1
+    data = "".join(lines).encode("UTF-8")
+    with open(os.path.join(header_dir, "Header{}.h".format(i)), "wb") as f:
+      f.write(data)
+    files += 1
+    total_bytes += len(data)
+
+  lib_dir = os.path.join(root_dir, "lib")
+  os.makedirs(lib_dir, exist_ok=True)
+  chunk_size = 1024 * 1024
+  for i in range(static_libs):
+    lib_path = os.path.join(lib_dir, "libLLVMLib{}.a".format(i))
+    with open(lib_path, "wb") as f:
+      for _ in range(static_lib_mb):
+        # Object code compresses to about half.
+        f.write(os.urandom(chunk_size // 2))
+        f.write(bytes(chunk_size // 2))
+    files += 1
+    total_bytes += static_lib_mb * chunk_size
+    os.symlink(os.path.basename(lib_path),
+               os.path.join(lib_dir, "libLLVMLib{}.link.a".format(i)))
+  return files, total_bytes
+
+
+def generate_cache_dir(cache_dir, *, entries, entry_kb):
+  """Generates a cache dir of full archives with delta chains against them.
+
+  Every 4th entry is a full archive, the others are deltas against it.
+  Returns the total bytes.
+  """
+  import archive
+  os.makedirs(cache_dir, exist_ok=True)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    base_path = None
+    for i in range(entries):
+      tree_dir = os.path.join(temp_dir, "tree{}".format(i))
+      os.makedirs(tree_dir)
+      with open(os.path.join(tree_dir, "shared.bin"), "wb") as f:
+        f.write(bytes(entry_kb * 1024))
+      with open(os.path.join(tree_dir, "entry.bin"), "wb") as f:
+        f.write(os.urandom(entry_kb * 1024))
+      archive_path = os.path.join(cache_dir,
+                                  "bench-key{}_{:056x}.mrta".format(i // 4, i))
+      if i % 4 == 0:
+        base_path = archive_path
+        archive.create(archive_path, tree_dir, mtime_epoch=0)
+      else:
+        archive.create(archive_path,
+                       tree_dir,
+                       base_path=base_path,
+                       mtime_epoch=0)
+      with open(archive_path[:-len(".mrta")] + ".json", "wt") as f:
+        json.dump({"identifier": "bench", "version_hash": i}, f)
+      shutil.rmtree(tree_dir)
+  total_bytes = 0
+  # Distinct mtimes, oldest first, so that pruning is deterministic.
+  for i, name in enumerate(sorted(os.listdir(cache_dir))):
+    path = os.path.join(cache_dir, name)
+    os.utime(path, (1000000000 + i, 1000000000 + i))
+    total_bytes += os.path.getsize(path)
+  return total_bytes
+
+
+def time_runs(runs, fn, setup=None):
+  """Times fn(setup()) over runs, discarding output."""
+  times = []
+  for _ in range(runs):
+    with contextlib.redirect_stdout(io.StringIO()):
+      arg = setup() if setup is not None else None
+      start_time = time.perf_counter()
+      fn(arg)
+      times.append(time.perf_counter() - start_time)
+  return {
+      "median_seconds": statistics.median(times),
+      "min_seconds": min(times),
+      "max_seconds": max(times),
+      "runs_seconds": times,
+  }
+
+
+def remove_path(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.unlink(path)
+
+
+def run_benchmarks(parser, selected, work_dir):
+  """Runs the selected benchmarks in work_dir, returning {name: result}."""
+  cwd = os.getcwd()
+  # Roots are derived from the current directory when builder is imported.
+  os.chdir(work_dir)
+  try:
+    # Keep stdout for the results.
+    with contextlib.redirect_stdout(sys.stderr):
+      return _run_benchmarks(parser, selected, work_dir)
+  finally:
+    os.chdir(cwd)
+
+
+def _run_benchmarks(parser, selected, work_dir):
+  os.environ["MRT_CACHE_DIR"] = os.path.join(work_dir, "cache")
+  os.environ["SOURCE_DATE_EPOCH"] = "0"
+  import cacher
+  import sync_cache
+
+  results = dict()
+
+  def report(name, result, **fields):
+    result.update(fields)
+    results[name] = result
+    print("{}: median {:.3f}s, min {:.3f}s, max {:.3f}s".format(
+        name, result["median_seconds"], result["min_seconds"],
+        result["max_seconds"]),
+          file=sys.stderr)
+
+  def make_chain(depth):
+    chain = []
+    for i in range(depth):
+      chain.append(
+          cacher.InstallCache(identifier="bench-{}".format(i),
+                              cache_key="bench-key{}".format(i),
+                              install_task="build_bench",
+                              version_data_lambda=lambda: "v1",
+                              deps=chain[-1:]))
+    return chain[-1]
+
+  if "version_hash" in selected:
+    report("version_hash",
+           time_runs(parser.runs,
+                     lambda top: top.version_hash,
+                     setup=lambda: make_chain(parser.key_depth)),
+           depth=parser.key_depth)
+
+  install_cache = make_chain(1)
+  install_benchmarks = [
+      name for name in selected
+      if name.startswith(("manifest", "archive_", "install_is_ok"))
+  ]
+  if install_benchmarks:
+    print("Generating install tree...", file=sys.stderr)
+    files, tree_bytes = generate_install_tree(
+        str(install_cache.install_dir),
+        headers=parser.headers,
+        header_kb=parser.header_kb,
+        static_libs=parser.static_libs,
+        static_lib_mb=parser.static_lib_mb)
+    tree_fields = dict(files=files, bytes=tree_bytes)
+
+    if "manifest" in selected:
+      report(
+          "manifest",
+          time_runs(parser.runs, lambda _: install_cache.write_manifest_file()),
+          **tree_fields)
+    install_cache.write_manifest_file()
+
+    def remove_archive():
+      remove_path(install_cache.cache_archive_file)
+
+    if "archive_create" in selected:
+      report(
+          "archive_create",
+          time_runs(parser.runs,
+                    lambda _: install_cache.create_cache_archive_file(),
+                    setup=remove_archive), **tree_fields)
+    install_cache.create_cache_archive_file()
+    archive_bytes = os.path.getsize(install_cache.cache_archive_file)
+
+    def remove_install():
+      remove_path(install_cache.install_dir)
+      remove_path(install_cache.marker_file)
+
+    if "archive_extract" in selected:
+      report("archive_extract",
+             time_runs(parser.runs,
+                       lambda _: install_cache.expand_cache_archive_file(),
+                       setup=remove_install),
+             archive_bytes=archive_bytes,
+             **tree_fields)
+    remove_install()
+    install_cache.expand_cache_archive_file()
+
+    for mode in ("stat", "content"):
+      name = "install_is_ok_" + mode
+      if name not in selected:
+        continue
+
+      def set_mode(mode=mode):
+        os.environ[cacher.VERIFY_ENV_VAR] = mode
+
+      def check(_):
+        if not install_cache.install_is_ok():
+          raise RuntimeError("Install is not ok")
+
+      report(name, time_runs(parser.runs, check, setup=set_mode), **tree_fields)
+    os.environ.pop(cacher.VERIFY_ENV_VAR, None)
+
+  sync_benchmarks = [name for name in selected if name.startswith("sync_")]
+  if sync_benchmarks:
+    print("Generating cache dir...", file=sys.stderr)
+    snapshot_dir = os.path.join(work_dir, "sync", "snapshot")
+    shared_dir = os.path.join(work_dir, "sync", "shared")
+    pulled_dir = os.path.join(work_dir, "sync", "pulled")
+    cache_bytes = generate_cache_dir(snapshot_dir,
+                                     entries=parser.entries,
+                                     entry_kb=parser.entry_kb)
+    cache_fields = dict(entries=parser.entries, bytes=cache_bytes)
+
+    def sync(mode, size_limit_mb, src_dir, dest_dir):
+      # sync_cache takes its args as snapshot dir, then shared dir.
+      args = ["--" + mode, "--size-limit-mb", str(size_limit_mb)]
+      if mode == "push":
+        args.extend([src_dir, dest_dir])
+        sync_cache.do_push(sync_cache.create_argument_parser().parse_args(args))
+      else:
+        args.extend([dest_dir, src_dir])
+        sync_cache.do_pull(sync_cache.create_argument_parser().parse_args(args))
+
+    def reset(path):
+      remove_path(path)
+      return path
+
+    if "sync_push" in selected:
+      report(
+          "sync_push",
+          time_runs(parser.runs,
+                    lambda _: sync("push", -1, snapshot_dir, shared_dir),
+                    setup=lambda: reset(shared_dir)), **cache_fields)
+    reset(shared_dir)
+    sync("push", -1, snapshot_dir, shared_dir)
+
+    if "sync_pull" in selected:
+      report(
+          "sync_pull",
+          time_runs(parser.runs,
+                    lambda _: sync("pull", -1, shared_dir, pulled_dir),
+                    setup=lambda: reset(pulled_dir)), **cache_fields)
+
+    if "sync_prune" in selected:
+      prune_dir = os.path.join(work_dir, "sync", "prune")
+
+      def setup_prune():
+        reset(prune_dir)
+        sync("push", -1, snapshot_dir, prune_dir)
+        return prune_dir
+
+      report("sync_prune",
+             time_runs(parser.runs,
+                       lambda d: sync_cache.prune(d, cache_bytes // 2),
+                       setup=setup_prune),
+             size_limit_bytes=cache_bytes // 2,
+             **cache_fields)
+  return results
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  selected = parser.only.split(",") if parser.only else list(BENCHMARKS)
+  for name in selected:
+    if name not in BENCHMARKS:
+      print("Unknown benchmark {} (one of {})".format(name,
+                                                      ", ".join(BENCHMARKS)))
+      return 1
+  output = os.path.abspath(parser.output) if parser.output else None
+  params = {
+      name: getattr(parser, name)
+      for name in ("headers", "header_kb", "static_libs", "static_lib_mb",
+                   "entries", "entry_kb", "key_depth", "runs")
+  }
+
+  if parser.work_dir:
+    work_dir = os.path.abspath(parser.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    results = run_benchmarks(parser, selected, work_dir)
+  else:
+    with tempfile.TemporaryDirectory() as work_dir:
+      results = run_benchmarks(parser, selected, work_dir)
+
+  text = json.dumps(
+      {
+          "commit": read_git_commit(),
+          "python": platform.python_version(),
+          "time": int(time.time()),
+          "params": params,
+          "results": results,
+      },
+      indent=2,
+      sort_keys=True)
+  if output:
+    with open(output, "wt", encoding="UTF-8") as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
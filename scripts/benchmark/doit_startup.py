@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the startup time of doit against a fixed budget.
+
+Every doit invocation loads dodo.py and runs all task generators, so any
+expensive work done at generation time (probing python interpreters,
+reading git state, creating directories) is paid by every command, including
+'doit list'. This runs 'doit list' several times and fails if the median wall
+time exceeds the budget, if task loading created build/install dirs, or if
+it probed python interpreters or read git state (which may be cheap on this
+machine but is not in general).
+
+Must be run from the repo root.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="doit_startup",
+      description=__doc__,
+      add_help=True,
+      formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--budget-ms",
+                      help="Maximum median wall time of 'doit list'",
+                      type=float,
+                      default=1500)
+  parser.add_argument("--runs",
+                      help="Number of timed runs",
+                      type=int,
+                      default=5)
+  return parser
+
+
+def time_doit_list(db_file):
+  args = [
+      sys.executable, "-m", "doit", "list", "--backend", "sqlite3", "--db-file",
+      db_file
+  ]
+  start_time = time.perf_counter()
+  subprocess.check_call(args, stdout=subprocess.DEVNULL)
+  return (time.perf_counter() - start_time) * 1000
+
+
+def find_eager_work():
+  """Loads tasks in-process, returning the names of expensive calls made."""
+  sys.path.insert(0, os.getcwd())
+  sys.path.insert(0, os.path.join(os.getcwd(), "python"))
+  import cacher
+  import pythonenv
+  from doit.cmd_base import ModuleTaskLoader
+  from doit.doit_cmd import DoitMain
+
+  calls = []
+
+  def instrument(module, name):
+    original = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+      calls.append("{}.{}".format(module.__name__, name))
+      return original(*args, **kwargs)
+
+    setattr(module, name, wrapper)
+
+  instrument(pythonenv, "get_python_target_configs")
+  instrument(cacher, "read_git_state")
+  import dodo
+  with tempfile.TemporaryDirectory() as temp_dir, \
+      open(os.devnull, "w") as devnull:
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+      DoitMain(ModuleTaskLoader(dodo)).run([
+          "list", "--backend", "sqlite3", "--db-file",
+          os.path.join(temp_dir, ".doit.db")
+      ])
+    finally:
+      sys.stdout = stdout
+  return sorted(set(calls))
+
+
+def main(args):
+  parser = create_argument_parser().parse_args(args)
+  if not os.path.exists("dodo.py"):
+    print("Must be run from the repo root")
+    return 1
+
+  watched_dirs = ["build", "install"]
+  preexisting = [d for d in watched_dirs if os.path.exists(d)]
+  with tempfile.TemporaryDirectory() as temp_dir:
+    db_file = os.path.join(temp_dir, ".doit.db")
+    # Warm up (i.e. populate __pycache__).
+    time_doit_list(db_file)
+    times = [time_doit_list(db_file) for _ in range(parser.runs)]
+
+  median_ms = statistics.median(times)
+  print("doit list: median {:.1f}ms, min {:.1f}ms, max {:.1f}ms "
+        "(budget {:.1f}ms)".format(median_ms, min(times), max(times),
+                                   parser.budget_ms))
+  ok = True
+  for d in watched_dirs:
+    if d not in preexisting and os.path.exists(d):
+      print("FAIL: task loading created directory:", d)
+      ok = False
+  for call in find_eager_work():
+    print("FAIL: task loading called:", call)
+    ok = False
+  if median_ms > parser.budget_ms:
+    print("FAIL: over budget")
+    ok = False
+  return 0 if ok else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))